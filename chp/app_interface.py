@@ -1,116 +1,315 @@
 from chp.trapi_interface import TrapiInterface
+from chp.curie_store import load_curie_store
+from chp.serializers import trapi_response_serializer
 from chp.apps import *
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
 import time
 from trapi_model.biolink.constants import *
 import json
 
+class TrapiInterfaceRegistry:
+    """ Process wide registry of warm TRAPI interface components keyed by app config.
+
+        The first interface built for an app config loads the base handler, curie store,
+        meta knowledge graph and conflation map from disk. These never change while the app is
+        running so every later request gets a new TrapiInterface (with its own queries, handlers
+        and logger) that is built from the already loaded components. The curies database is
+        only needed to serve the curies endpoint and is loaded on its first request.
+    """
+    def __init__(self):
+        self._components = {}
+        self._curies_dbs = {}
+        self._lock = threading.Lock()
+
+    def get_components(self, chp_config):
+        # Make sure the disease reasoners are materialized
+        chp_config.load()
+        components = self._components.get(chp_config)
+        if components is not None:
+            return components
+        with self._lock:
+            # Another thread may have loaded them while we waited.
+            if chp_config not in self._components:
+                load_time = time.time()
+                curie_store = load_curie_store(
+                        chp_config.bkb_handler.curies_path,
+                        get_chp_setting('CHP_CURIE_STORE_DIR'),
+                        )
+                interface = self._build_interface(chp_config, curie_store=curie_store)
+                self._components[chp_config] = {
+                        "base_handler": interface.base_handler,
+                        "meta_knowledge_graph": interface.meta_knowledge_graph,
+                        "meta_kg_index": interface.meta_kg_index,
+                        "conflation_map": interface.conflation_map,
+                        "curie_store": curie_store,
+                        }
+                logger.info('Loaded TRAPI interface components for {} in {} seconds.'.format(chp_config.name, time.time() - load_time))
+            return self._components[chp_config]
+
+    def get_interface(self, chp_config):
+        return self._build_interface(chp_config, curies_db=self._curies_dbs.get(chp_config), **self.get_components(chp_config))
+
+    def get_curies_db(self, chp_config):
+        curies_db = self._curies_dbs.get(chp_config)
+        if curies_db is None:
+            curies_db = self.get_interface(chp_config).get_curies()
+            self._curies_dbs[chp_config] = curies_db
+        return curies_db
+
+    def clear(self):
+        with self._lock:
+            self._components = {}
+            self._curies_dbs = {}
+
+    @staticmethod
+    def _build_interface(chp_config, **components):
+        return TrapiInterface(
+            hosts_filename=chp_config.hosts_filename,
+            num_processes_per_host=chp_config.num_processes_per_host,
+            bkb_handler=chp_config.bkb_handler,
+            joint_reasoner=chp_config.joint_reasoner,
+            dynamic_reasoner=chp_config.dynamic_reasoner,
+            reasoner_pool=chp_config.reasoner_pool,
+            result_cache=chp_config.result_cache,
+            node_normalizer=get_node_normalizer(),
+            max_result_window=get_chp_setting('CHP_MAX_RESULT_WINDOW'),
+            two_hop_candidates=get_chp_setting('CHP_TWO_HOP_CANDIDATES'),
+            **components,
+            )
+
+trapi_interface_registry = TrapiInterfaceRegistry()
+
 def get_app_config(query):
     return ChpApiConfig
 
 def get_trapi_interface(chp_config=None):
     if chp_config is None:
         chp_config = ChpApiConfig
-    return TrapiInterface(
-        hosts_filename=chp_config.hosts_filename,
-        num_processes_per_host=chp_config.num_processes_per_host,
-        bkb_handler=chp_config.bkb_handler,
-        joint_reasoner=chp_config.joint_reasoner,
-        dynamic_reasoner=chp_config.dynamic_reasoner,
-        )
+    return trapi_interface_registry.get_interface(chp_config)
+
+def get_result_cache_stats():
+    """ Returns the hit and miss counters of the result cache of every loaded configuration.
+    """
+    return {chp_config.name: chp_config.result_cache.stats() for chp_config in DISEASE_CONFIGS if chp_config.result_cache is not None}
 
 def get_curies():
-    interface = get_trapi_interface()
-    return interface.get_curies()
+    return trapi_interface_registry.get_curies_db(ChpApiConfig)
 
 def get_meta_knowledge_graph():
     interface = get_trapi_interface()
     return interface.get_meta_knowledge_graph()
 
-def get_response(consistent_queries):
-    """ Should return app responses plus app_logs, status, and description information.
-    """
-    app_logs:list = []
-    try:
-        interface_dict:defaultdict = setup_queries_based_on_disease_interfaces(consistent_queries)
-    except ValueError as ex:
-        responses = []
-        status = 'Bad request. See description.'
-        description = 'Problem during setup. ' + str(ex)
-        return responses, app_logs, status, description
+# Order in which stage errors are reported when several interfaces fail
+PIPELINE_STAGES = ['setup', 'build', 'reasoning']
 
-    if len(interface_dict.keys()) == 0:
-        responses = []
-        status = 'Bad request. See description.'
-        description = 'Disease Curies are invalid or can not be handled.'
-        return responses, app_logs, status, description
+def _run_interface_pipeline(interface, queries):
+    """ Runs interface setup, CHP query building, reasoning and TRAPI response construction
+    for a single disease interface.
 
+    :return: A tuple of (responses, error) where error is None or a (stage, exception) tuple
+        naming the pipeline stage that failed.
+    :rtype: tuple
+    """
     # Setup for CHP inferencing
     try:
         setup_time = time.time()
-        for interface, queries in interface_dict.items():
-            interface.setup_trapi_queries(queries)
+        interface.setup_trapi_queries(queries)
         logger.info('Trapi Interface setup time: {} seconds.'.format(time.time() - setup_time))
     except Exception as ex:
-        responses = []
-        status = 'Bad request. See description.'
-        description = 'Problem during interface setup. ' + str(ex)
-        return responses, app_logs, status, description
-    
+        return [], ('setup', ex)
+
     # Build CHP queries
     try:
         build_time = time.time()
-        for interface in interface_dict:
-            interface.build_chp_queries()
+        interface.build_chp_queries()
         logger.info('CHP query build time: {} seconds.'.format(time.time() - build_time))
     except Exception as ex:
-        # Add logs from interfaces level
-        for interface in interface_dict:
-            app_logs.extend(interface.logger.to_dict())
-        response = []
-        status = 'Bad request. See description.'
-        description = 'Problem during CHP query building. '+ str(ex)
-        return response, app_logs, status, description
+        return [], ('build', ex)
 
     logger.info('Built Queries.')
     # Run queries
     try:
         reasoning_start_time = time.time()
-        for interface in interface_dict:
-            interface.run_chp_queries()
+        interface.run_chp_queries()
         logger.info('Completed Reasoning in {} seconds.'.format(time.time() - reasoning_start_time))
     except Exception as ex:
+        return [], ('reasoning', ex)
+
+    # Construct Response
+    return interface.construct_trapi_responses(), None
+
+def get_response(consistent_queries, max_workers=None):
+    """ Should return app responses plus app_logs, status, and description information.
+
+    Each disease interface runs its own setup, build, reasoning and construction pipeline.
+    With more than one worker (max_workers or the CHP_MAX_INTERFACE_WORKERS setting) and a
+    reasoner pool for at least one of the interfaces, the interfaces run concurrently on a
+    bounded thread pool: their query batches are reasoned over in the pool processes while
+    the threads wait. Reasoning in the serving process is pure Python and holds the GIL, so
+    without a reasoner pool the interfaces run one after another. Responses and app logs are
+    always merged in interface order and errors are reported by PIPELINE_STAGES order.
+    """
+    app_logs:list = []
+    try:
+        interface_dict:defaultdict = setup_queries_based_on_disease_interfaces(consistent_queries)
+    except ValueError as ex:
+        responses = []
+        status = 'Bad request. See description.'
+        description = 'Problem during setup. ' + str(ex)
+        return responses, app_logs, status, description
+
+    if len(interface_dict.keys()) == 0:
+        responses = []
+        status = 'Bad request. See description.'
+        description = 'Disease Curies are invalid or can not be handled.'
+        return responses, app_logs, status, description
+
+    if max_workers is None:
+        max_workers = get_chp_setting('CHP_MAX_INTERFACE_WORKERS', 1)
+    interface_items = list(interface_dict.items())
+    pipeline_time = time.time()
+    has_reasoner_pool = any(interface.reasoner_pool is not None for interface, _ in interface_items)
+    if max_workers > 1 and len(interface_items) > 1 and has_reasoner_pool:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(interface_items))) as executor:
+            futures = [executor.submit(_run_interface_pipeline, interface, queries) for interface, queries in interface_items]
+            outcomes = [future.result() for future in futures]
+    else:
+        outcomes = [_run_interface_pipeline(interface, queries) for interface, queries in interface_items]
+    logger.info('Ran {} interface pipeline(s) in {} seconds.'.format(len(interface_items), time.time() - pipeline_time))
+
+    # Report the earliest failing stage, just as if every stage ran over all interfaces in turn
+    errors = [error for _, error in outcomes if error is not None]
+    if len(errors) > 0:
+        stage, ex = min(errors, key=lambda error: PIPELINE_STAGES.index(error[0]))
+        responses = []
+        if stage == 'setup':
+            status = 'Bad request. See description.'
+            description = 'Problem during interface setup. ' + str(ex)
+            return responses, app_logs, status, description
         # Add logs from interfaces level
         for interface in interface_dict:
             app_logs.extend(interface.logger.to_dict())
-        response = []
-        status = 'Unexpected error. See description.'
-        description = 'Problem during reasoning. ' + str(ex)
-        # Report critical error to logs
-        logger.critical('Error during reasoning. Check query: {}'.format(query_copy.id))
-        return response, app_logs, status, description
+        if stage == 'build':
+            status = 'Bad request. See description.'
+            description = 'Problem during CHP query building. '+ str(ex)
+        else:
+            status = 'Unexpected error. See description.'
+            description = 'Problem during reasoning. ' + str(ex)
+            # Report critical error to logs
+            logger.critical('Error during reasoning: {}'.format(str(ex)))
+        return responses, app_logs, status, description
 
-    # Construct Response
     responses = []
+    for interface_responses, _ in outcomes:
+        responses.extend(interface_responses)
+
+    # Collect app logs from interfaces level
     for interface in interface_dict:
-        responses.extend(interface.construct_trapi_responses())
-    
+        app_logs.extend(interface.logger.to_dict())
+
     # Check if any responses came back
     if len(responses) == 0:
-        # Add logs from interfaces level
-        for interface in interface_dict:
-            app_logs.extend(interface.logger.to_dict())
         status = 'No results.'
         return responses, app_logs, status, None
 
-    # Collect app logs from interfaces level
-    for interface in interface_dict:
-        app_logs.extend(interface.logger.to_dict())
-
     # Return successful status
     return responses, app_logs, 'Success', None
 
 
+def _get_new_logs(interface, logged_counts):
+    """ Returns the interface logs that were not returned before.
+    """
+    logs = interface.logger.to_dict()
+    new_logs = logs[logged_counts.get(interface, 0):]
+    logged_counts[interface] = len(logs)
+    return new_logs
+
+def iter_response(consistent_queries):
+    """ Streaming version of get_response. Yields a (response, app_logs, status, description)
+    tuple for each TRAPI response as soon as its query is finished, where app_logs are the
+    interface logs added since the previous tuple.
+
+    Interfaces are processed one after another. If setup fails, or if a stage of an interface
+    fails, a single tuple with a None response and the error status is yielded and streaming
+    stops. If no response was yielded, a final 'No results.' tuple is yielded.
+    """
+    try:
+        interface_dict:defaultdict = setup_queries_based_on_disease_interfaces(consistent_queries)
+    except ValueError as ex:
+        yield None, [], 'Bad request. See description.', 'Problem during setup. ' + str(ex)
+        return
+
+    if len(interface_dict.keys()) == 0:
+        yield None, [], 'Bad request. See description.', 'Disease Curies are invalid or can not be handled.'
+        return
+
+    logged_counts = {}
+    num_responses = 0
+    for interface, queries in interface_dict.items():
+        # Setup for CHP inferencing
+        try:
+            interface.setup_trapi_queries(queries)
+        except Exception as ex:
+            yield None, [], 'Bad request. See description.', 'Problem during interface setup. ' + str(ex)
+            return
+        # Build CHP queries
+        try:
+            interface.build_chp_queries()
+        except Exception as ex:
+            yield None, _get_new_logs(interface, logged_counts), 'Bad request. See description.', 'Problem during CHP query building. '+ str(ex)
+            return
+        # Run queries and construct each response as soon as it is ran
+        responses = interface.iter_trapi_responses()
+        while True:
+            try:
+                response = next(responses)
+            except StopIteration:
+                break
+            except Exception as ex:
+                # Report critical error to logs
+                logger.critical('Error during reasoning: {}'.format(str(ex)))
+                yield None, _get_new_logs(interface, logged_counts), 'Unexpected error. See description.', 'Problem during reasoning. ' + str(ex)
+                return
+            num_responses += 1
+            yield response, _get_new_logs(interface, logged_counts), 'Success', None
+
+    if num_responses == 0:
+        app_logs = []
+        for interface in interface_dict:
+            app_logs.extend(_get_new_logs(interface, logged_counts))
+        yield None, app_logs, 'No results.', None
+
+def iter_serialized_response(consistent_queries, serializer=None):
+    """ Streams iter_response as newline delimited JSON. Each (response, app_logs, status,
+    description) tuple becomes one {"response": ..., "logs": ..., "status": ...,
+    "description": ...} line. A TRAPI response is serialized as soon as its query is finished
+    and released before the next query is run, so only one response is held at a time.
+
+    :param serializer: Defaults to the shared chp.serializers.TrapiResponseSerializer.
+    :type serializer: chp.serializers.TrapiResponseSerializer
+    """
+    if serializer is None:
+        serializer = trapi_response_serializer
+    for response, app_logs, status, description in iter_response(consistent_queries):
+        yield from serializer.iter_record(response, logs=app_logs, status=status, description=description)
+        del response
+
+async def aiter_response(consistent_queries):
+    """ Async version of iter_response for asynchronous API layers. Reasoning runs in the
+    default executor so the event loop is not blocked while a query is reasoned over.
+    """
+    loop = asyncio.get_running_loop()
+    responses = iter_response(consistent_queries)
+    done = object()
+    while True:
+        item = await loop.run_in_executor(None, next, responses, done)
+        if item is done:
+            break
+        yield item
+
 def get_disease_nodes(query):
     disease_node_ids = query.message.query_graph.find_nodes(categories=[BIOLINK_DISEASE_ENTITY])
     if disease_node_ids is not None:
@@ -131,7 +330,8 @@ def get_disease_specific_config(disease_node):
     else:
         return None
         #chp_config = ChpApiConfig
-    return chp_config
+    # Lazily load the disease reasoners the first time a query is routed to them
+    return chp_config.load()
 
 def setup_queries_based_on_disease_interfaces(consistent_queries):
     config_dict = defaultdict(list)
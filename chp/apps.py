@@ -2,78 +2,112 @@ from django.apps import AppConfig
 import os
 import multiprocessing
 import logging
+import resource
+import threading
+import time
 
 from chp.reasoner import ChpJointReasoner, ChpDynamicReasoner
+from chp.reasoner_pool import ReasonerPool, ReasonersPool
+from chp.result_cache import ResultCache, PersistentResultStore
+from chp.snapshot import load_snapshot
+from chp.node_normalizer import NodeNormalizer, NodeNormalizerStore, SriNodeNormalizerBackend, FileNodeNormalizerBackend
 from chp_data.bkb_handler import BkbDataHandler
 
 #logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class ChpApiConfig(AppConfig):
-    logger.warning('Running CHP API Configuration. May take a minute.')
-    name = 'chp'
-    default = True
+# Guards reasoner loading so concurrent requests for the same disease only load it once.
+_load_lock = threading.RLock()
+# Persistent result store shared by all configurations of this process, see get_result_store().
+_result_store = None
+# Node normalizer shared by all configurations of this process, see get_node_normalizer().
+_node_normalizer = None
+# Reasoner pool shared by the warmed up configurations, the process that started it and the
+# configurations it serves, see start_reasoner_pool().
+_reasoner_pool = None
+_reasoner_pool_pid = None
+_reasoner_pool_configs = []
+_reasoner_pool_lock = threading.Lock()
 
-    # Used for distrbuted reasoning
-    # Get Hosts File if it exists
-    #parent_dir = os.path.dirname(os.path.realpath(__file__))
-    #HOSTS_FILENAME = os.path.join(parent_dir, 'hosts')
-    #NUM_PROCESSES_PER_HOST = multiprocessing.cpu_count()
-    #if not os.path.exists(HOSTS_FILENAME):
-    hosts_filename = None
-    num_processes_per_host = 0
+def get_chp_setting(name, default=None):
+    """ Returns a CHP setting from the Django settings or the default if it is not set
+    or Django settings are not configured (e.g. when used outside of the API).
+    """
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+    try:
+        return getattr(settings, name, default)
+    except ImproperlyConfigured:
+        return default
 
-    # Instantiate BKB handler
-    bkb_handler = BkbDataHandler(
-        bkb_major_version='darwin',
-        bkb_minor_version='2.0'
-    )
-
-    logger.info('Instantiating reasoners.')
-    # Instantiate Reasoners
-    dynamic_reasoner = ChpDynamicReasoner(
-        bkb_handler=bkb_handler,
-        hosts_filename=hosts_filename,
-        num_processes_per_host=num_processes_per_host)
-    joint_reasoner = ChpJointReasoner(
-        bkb_handler=bkb_handler,
-        hosts_filename=hosts_filename,
-        num_processes_per_host=num_processes_per_host)
-
-class ChpBreastApiConfig(AppConfig):
-    logger.warning('Running CHP Breast API Configuration. May take a minute.')
-    name = 'chp_breast'
+def get_result_store():
+    """ Returns the persistent result store at the CHP_RESULT_STORE_PATH setting or None if
+    results should only be cached in memory. The store size is bounded by CHP_RESULT_STORE_MAX_MB
+    and stored results expire after CHP_RESULT_CACHE_TTL seconds, like cached ones.
+    """
+    global _result_store
+    result_store_path = get_chp_setting('CHP_RESULT_STORE_PATH')
+    if result_store_path is None:
+        return None
+    with _load_lock:
+        if _result_store is None:
+            _result_store = PersistentResultStore(
+                    result_store_path,
+                    max_bytes=get_chp_setting('CHP_RESULT_STORE_MAX_MB', 1024) * 1024**2,
+                    ttl=get_chp_setting('CHP_RESULT_CACHE_TTL', 3600),
+                    )
+    return _result_store
 
-    # Used for distrbuted reasoning
-    # Get Hosts File if it exists
-    #parent_dir = os.path.dirname(os.path.realpath(__file__))
-    #HOSTS_FILENAME = os.path.join(parent_dir, 'hosts')
-    #NUM_PROCESSES_PER_HOST = multiprocessing.cpu_count()
-    #if not os.path.exists(HOSTS_FILENAME):
-    hosts_filename = None
-    num_processes_per_host = 0
+def get_node_normalizer():
+    """ Returns the node normalizer of the CHP_NODE_NORMALIZER setting or None if unsupported
+    curies should not be normalized. The setting is either 'sri' for the SRI Node Normalizer or
+    the filename of a JSON file of curie -> normalized node for offline use. Up to
+    CHP_NODE_NORMALIZER_CACHE_SIZE results are kept in process, and all of them across restarts
+    in the CHP_NODE_NORMALIZER_CACHE_PATH database if set.
+    """
+    global _node_normalizer
+    node_normalizer_backend = get_chp_setting('CHP_NODE_NORMALIZER')
+    if node_normalizer_backend is None:
+        return None
+    with _load_lock:
+        if _node_normalizer is None:
+            if node_normalizer_backend == 'sri':
+                backend = SriNodeNormalizerBackend()
+            else:
+                backend = FileNodeNormalizerBackend(node_normalizer_backend)
+            store = None
+            node_normalizer_cache_path = get_chp_setting('CHP_NODE_NORMALIZER_CACHE_PATH')
+            if node_normalizer_cache_path is not None:
+                store = NodeNormalizerStore(node_normalizer_cache_path)
+            _node_normalizer = NodeNormalizer(
+                    backend=backend,
+                    store=store,
+                    cache_size=get_chp_setting('CHP_NODE_NORMALIZER_CACHE_SIZE', 4096),
+                    )
+    return _node_normalizer
 
-    # Instantiate BKB handler
-    bkb_handler = BkbDataHandler(
-        disease='tcga_brca',
-        bkb_major_version='darwin',
-        bkb_minor_version='2.0'
-    )
-
-    logger.info('Instantiating reasoners.')
-    # Instantiate Reasoners
-    dynamic_reasoner = ChpDynamicReasoner(
-        bkb_handler=bkb_handler,
-        hosts_filename=hosts_filename,
-        num_processes_per_host=num_processes_per_host)
-    joint_reasoner = ChpJointReasoner(
-        bkb_handler=bkb_handler,
-        hosts_filename=hosts_filename,
-        num_processes_per_host=num_processes_per_host)
-
-class ChpBrainApiConfig(AppConfig):
-    logger.warning('Running CHP Brain API Configuration. May take a minute.')
-    name = 'chp_brain'
+def _get_rss_mb():
+    """ Returns the current resident set size of this process in megabytes. Falls back
+    to the peak resident set size if /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f_:
+            rss_pages = int(f_.read().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class LazyReasonerConfigMixin:
+    """ Loads the BKB data handler and reasoners of a disease configuration the first time
+    they are needed instead of when the module is imported.
+
+    Subclasses only declare their disease and bkb versions. Call load() before accessing
+    bkb_handler, dynamic_reasoner or joint_reasoner. reasoner_pool is only set for
+    configurations warmed up at startup, see warm_up.
+    """
+    disease = None
+    bkb_major_version = 'darwin'
+    bkb_minor_version = '2.0'
 
     # Used for distrbuted reasoning
     # Get Hosts File if it exists
@@ -84,51 +118,196 @@ class ChpBrainApiConfig(AppConfig):
     hosts_filename = None
     num_processes_per_host = 0
 
-    # Instantiate BKB handler
-    bkb_handler = BkbDataHandler(
-        disease='tcga_gbm',
-        bkb_major_version='darwin',
-        bkb_minor_version='2.0'
-    )
-
-    logger.info('Instantiating reasoners.')
-    # Instantiate Reasoners
-    dynamic_reasoner = ChpDynamicReasoner(
-        bkb_handler=bkb_handler,
-        hosts_filename=hosts_filename,
-        num_processes_per_host=num_processes_per_host)
-    joint_reasoner = ChpJointReasoner(
-        bkb_handler=bkb_handler,
-        hosts_filename=hosts_filename,
-        num_processes_per_host=num_processes_per_host)
-
-class ChpLungApiConfig(AppConfig):
-    logger.warning('Running CHP Lung API Configuration. May take a minute.')
+    # Set by load()
+    bkb_handler = None
+    dynamic_reasoner = None
+    joint_reasoner = None
+    result_cache = None
+    # Set by warm_up()
+    reasoner_pool = None
+    load_report = None
+
+    @classmethod
+    def is_loaded(cls):
+        return cls.load_report is not None
+
+    @classmethod
+    def load(cls, share_patient_index=False):
+        """ Instantiates the bkb handler and reasoners for this configuration if they
+        have not been loaded yet.
+
+        :param share_patient_index: Whether to write the patient index file shared by all
+            processes (see chp.reasoner.BaseReasoner.get_patient_index) if it is missing. Only
+            set at warm-up, before any worker processes start.
+        :type share_patient_index: bool
+
+        :return: The loaded configuration class.
+        """
+        if cls.is_loaded():
+            return cls
+        with _load_lock:
+            if cls.is_loaded():
+                return cls
+            logger.warning('Loading {} configuration. May take a minute.'.format(cls.name))
+            start_time = time.time()
+            start_rss = _get_rss_mb()
+
+            # Instantiate BKB handler
+            bkb_handler_kwargs = {
+                    "bkb_major_version": cls.bkb_major_version,
+                    "bkb_minor_version": cls.bkb_minor_version,
+                    }
+            if cls.disease is not None:
+                bkb_handler_kwargs["disease"] = cls.disease
+            cls.bkb_handler = BkbDataHandler(**bkb_handler_kwargs)
+
+            # Use a prebuilt reasoner snapshot if there is one (see chp.snapshot)
+            snapshot = load_snapshot(get_chp_setting('CHP_SNAPSHOT_DIR'), cls.bkb_handler)
+
+            logger.info('Instantiating reasoners.')
+            # Instantiate Reasoners
+            cls.dynamic_reasoner = ChpDynamicReasoner(
+                bkb_handler=cls.bkb_handler,
+                hosts_filename=cls.hosts_filename,
+                num_processes_per_host=cls.num_processes_per_host,
+                snapshot=snapshot,
+                patient_index_dir=get_chp_setting('CHP_PATIENT_INDEX_DIR'))
+            cls.joint_reasoner = ChpJointReasoner(
+                bkb_handler=cls.bkb_handler,
+                hosts_filename=cls.hosts_filename,
+                num_processes_per_host=cls.num_processes_per_host,
+                snapshot=snapshot,
+                joint_engine=get_chp_setting('CHP_JOINT_ENGINE', 'bkb'),
+                interpolation_table_dir=get_chp_setting('CHP_INTERPOLATION_TABLE_DIR'),
+                patient_index_dir=get_chp_setting('CHP_PATIENT_INDEX_DIR'),
+                share_patient_index=share_patient_index)
+            if share_patient_index and get_chp_setting('CHP_PATIENT_INDEX_DIR') is not None:
+                # Write the shared patient index before the reasoner pool is forked
+                cls.joint_reasoner.get_patient_index()
+            # The snapshot stays open: a reasoner that loads patient data (or other sections)
+            # lazily takes the copy the other reasoner already unpickled instead of reading a
+            # second one from disk.
+
+            # Cache reasoning results of repeated queries across requests
+            result_cache_size = get_chp_setting('CHP_RESULT_CACHE_SIZE', 1024)
+            if result_cache_size > 0:
+                cls.result_cache = ResultCache(
+                        maxsize=result_cache_size,
+                        ttl=get_chp_setting('CHP_RESULT_CACHE_TTL', 3600),
+                        store=get_result_store(),
+                        )
+
+            cls.load_report = {
+                    "load_time": time.time() - start_time,
+                    "rss_delta_mb": _get_rss_mb() - start_rss,
+                    }
+            logger.warning('Loaded {} configuration in {:.2f} seconds using {:.1f} MB.'.format(
+                cls.name,
+                cls.load_report["load_time"],
+                cls.load_report["rss_delta_mb"],
+                ))
+        return cls
+
+class ChpApiConfig(LazyReasonerConfigMixin, AppConfig):
+    name = 'chp'
+    default = True
+
+    def ready(self):
+        """ Warms up the configurations named in the CHP_WARMUP_CONFIGS setting, e.g.
+        ['chp', 'chp_breast']. All other configurations load on their first query. The
+        reasoner pool is not forked here, see start_reasoner_pool.
+        """
+        warm_up(get_chp_setting('CHP_WARMUP_CONFIGS', []))
+
+class ChpBreastApiConfig(LazyReasonerConfigMixin, AppConfig):
+    name = 'chp_breast'
+    disease = 'tcga_brca'
+
+class ChpBrainApiConfig(LazyReasonerConfigMixin, AppConfig):
+    name = 'chp_brain'
+    disease = 'tcga_gbm'
+
+class ChpLungApiConfig(LazyReasonerConfigMixin, AppConfig):
     name = 'chp_lung'
+    disease = 'tcga_luad'
 
-    # Used for distrbuted reasoning
-    # Get Hosts File if it exists
-    #parent_dir = os.path.dirname(os.path.realpath(__file__))
-    #HOSTS_FILENAME = os.path.join(parent_dir, 'hosts')
-    #NUM_PROCESSES_PER_HOST = multiprocessing.cpu_count()
-    #if not os.path.exists(HOSTS_FILENAME):
-    hosts_filename = None
-    num_processes_per_host = 0
+DISEASE_CONFIGS = [
+        ChpApiConfig,
+        ChpBreastApiConfig,
+        ChpBrainApiConfig,
+        ChpLungApiConfig,
+        ]
+
+def warm_up(config_names):
+    """ Loads the named configurations up front, writing their shared patient index files if
+    they are missing, sets their reasoner_pool if CHP_REASONER_POOL_PROCESSES is set and logs a
+    load report. The reasoner pool itself is only forked on first use, see start_reasoner_pool.
+    """
+    global _reasoner_pool_configs
+    configs_by_name = {chp_config.name: chp_config for chp_config in DISEASE_CONFIGS}
+    chp_configs = []
+    for config_name in config_names:
+        if config_name not in configs_by_name:
+            raise ValueError('Unknown CHP configuration to warm up: {}'.format(config_name))
+        chp_configs.append(configs_by_name[config_name].load(share_patient_index=True))
+    if len(chp_configs) == 0:
+        return
+    if get_chp_setting('CHP_REASONER_POOL_PROCESSES', 0) > 0:
+        _reasoner_pool_configs = chp_configs
+        for chp_config in chp_configs:
+            chp_config.reasoner_pool = ReasonersPool(start_reasoner_pool, chp_config.name)
+    log_load_report()
+
+def start_reasoner_pool():
+    """ Returns the pool of CHP_REASONER_POOL_PROCESSES reasoning workers for the warmed up
+    configurations of this process, forking it if it is not running yet. Configurations loaded
+    later, on their first query, run their queries in the serving process.
+
+    The pool is started on the first query batch of a warmed up configuration, so it is
+    forked by the process that serves the queries and never from ChpApiConfig.ready, which may
+    run in a parent process only (e.g. under gunicorn --preload). A pool inherited from a parent
+    process can not run queries, so it is discarded and a new one is forked. Every serving
+    process forks its own pool, so with several server worker processes size
+    CHP_REASONER_POOL_PROCESSES per server worker.
+
+    Forking from a process that already serves requests in several threads can leave the pool
+    workers with locks that are held forever. Threaded servers should start the pool before
+    their request threads, e.g. by calling this from the gunicorn post_fork hook::
+
+        def post_fork(server, worker):
+            from chp.apps import start_reasoner_pool
+            start_reasoner_pool()
+
+    :return: The reasoner pool, or None if no configuration was warmed up with a pool.
+    :rtype: chp.reasoner_pool.ReasonerPool
+    """
+    global _reasoner_pool, _reasoner_pool_pid
+    if len(_reasoner_pool_configs) == 0:
+        return None
+    with _reasoner_pool_lock:
+        if _reasoner_pool is not None and _reasoner_pool_pid != os.getpid():
+            logger.info('Discarding the reasoner pool inherited from process {}.'.format(_reasoner_pool_pid))
+            _reasoner_pool.discard()
+            _reasoner_pool = None
+        if _reasoner_pool is None:
+            if threading.active_count() > 1:
+                logger.warning('Forking the reasoner pool while {} threads are running.'.format(threading.active_count()))
+            _reasoner_pool = ReasonerPool(
+                    {chp_config.name: (chp_config.joint_reasoner, chp_config.dynamic_reasoner) for chp_config in _reasoner_pool_configs},
+                    processes=get_chp_setting('CHP_REASONER_POOL_PROCESSES', 0),
+                    )
+            _reasoner_pool_pid = os.getpid()
+        return _reasoner_pool
+
+def get_load_report():
+    """ Returns the load time (seconds) and resident memory growth (MB) of each loaded configuration.
+    """
+    return {chp_config.name: chp_config.load_report for chp_config in DISEASE_CONFIGS if chp_config.is_loaded()}
 
-    # Instantiate BKB handler
-    bkb_handler = BkbDataHandler(
-        disease='tcga_luad',
-        bkb_major_version='darwin',
-        bkb_minor_version='2.0'
-    )
-
-    logger.info('Instantiating reasoners.')
-    # Instantiate Reasoners
-    dynamic_reasoner = ChpDynamicReasoner(
-        bkb_handler=bkb_handler,
-        hosts_filename=hosts_filename,
-        num_processes_per_host=num_processes_per_host)
-    joint_reasoner = ChpJointReasoner(
-        bkb_handler=bkb_handler,
-        hosts_filename=hosts_filename,
-        num_processes_per_host=num_processes_per_host)
+def log_load_report():
+    for config_name, report in get_load_report().items():
+        logger.warning('{}: loaded in {:.2f} seconds, +{:.1f} MB resident.'.format(
+            config_name,
+            report["load_time"],
+            report["rss_delta_mb"],
+            ))
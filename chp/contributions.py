@@ -0,0 +1,221 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import logging
+
+import numpy as np
+import scipy.sparse
+
+from chp.patient_index import CURIES_KEYS
+
+logger = logging.getLogger(__name__)
+
+def get_normalization_weight(normalization, scale=1):
+    """ Returns scale / normalization, or 0 if normalization is 0 so that the contributions of a
+    target with no probability mass are left out (as the ZeroDivisionError handling used to do).
+    """
+    if normalization == 0:
+        return 0
+    return scale / normalization
+
+class ContributionMatrix:
+    """ Dense curies x targets matrix of wildcard contributions.
+
+        :param curies: The wildcard curies (rows).
+        :type curies: list
+        :param targets: The (component, state) targets (columns).
+        :type targets: list
+        :param values: The contributions of shape (len(curies), len(targets)).
+        :type values: numpy.ndarray
+    """
+    def __init__(self, curies, targets, values):
+        self.curies = curies
+        self.targets = targets
+        self.values = values
+
+    @classmethod
+    def from_joint_contributions(cls, contributions, state='True'):
+        """ Builds the matrix from joint reasoner contributions of the form
+        {target: {(curie, state): contribution}}, keeping only the given curie state.
+        """
+        curie_idxs = {}
+        targets = list(contributions.keys())
+        rows = []
+        cols = []
+        contribs = []
+        for col, target in enumerate(targets):
+            for (curie, curie_state), contrib in contributions[target].items():
+                if curie_state != state:
+                    continue
+                row = curie_idxs.setdefault(curie, len(curie_idxs))
+                rows.append(row)
+                cols.append(col)
+                contribs.append(contrib)
+        values = np.zeros((len(curie_idxs), len(targets)))
+        values[rows, cols] = contribs
+        return cls(list(curie_idxs), targets, values)
+
+    @classmethod
+    def from_patient_contributions(cls, patient_contributions, raw_patient_data, curies_key):
+        """ Builds the matrix by adding up patient contributions of the form
+        {target: {patient: contribution}} over the curies (e.g. 'gene_curies') of each patient.
+        """
+        curie_idxs = {}
+        targets = list(patient_contributions.keys())
+        rows = []
+        cols = []
+        contribs = []
+        for col, target in enumerate(targets):
+            for patient, contrib in patient_contributions[target].items():
+                for curie in raw_patient_data[patient][curies_key]:
+                    rows.append(curie_idxs.setdefault(curie, len(curie_idxs)))
+                    cols.append(col)
+                    contribs.append(contrib)
+        values = np.zeros((len(curie_idxs), len(targets)))
+        np.add.at(values, (np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)), contribs)
+        return cls(list(curie_idxs), targets, values)
+
+    def get_truth_mask(self, truth_target):
+        return np.array([target[0] == truth_target[0] and target[1] == truth_target[1] for target in self.targets], dtype=bool)
+
+    def get_relative(self, truth_target, truth_weight, false_weight):
+        """ Returns the relative contribution of every curie: its truth target contributions
+        times truth_weight minus its other contributions times false_weight.
+        """
+        weights = np.where(self.get_truth_mask(truth_target), truth_weight, -false_weight)
+        return self.values @ weights
+
+class PatientCurieMatrix:
+    """ Sparse (CSR) patients x curies matrix of the gene or drug curies each patient carries,
+    built once per dataset. Adding patient contributions over the curies of the patients is then
+    one sparse matrix product with the patient contribution vectors of all targets.
+
+        :param raw_patient_data: The raw patient data of a bkb handler.
+        :type raw_patient_data: dict
+        :param curies_key: The patient curies to index, 'gene_curies' or 'drug_curies'.
+        :type curies_key: str
+    """
+    def __init__(self, raw_patient_data, curies_key):
+        curie_idxs = {}
+        indptr = [0]
+        indices = []
+        for patient_data in raw_patient_data.values():
+            indices.extend(curie_idxs.setdefault(curie, len(curie_idxs)) for curie in patient_data[curies_key])
+            indptr.append(len(indices))
+        self._setup(
+                curies_key,
+                list(raw_patient_data.keys()),
+                list(curie_idxs),
+                np.asarray(indptr, dtype=np.int32),
+                np.asarray(indices, dtype=np.int32),
+                )
+
+    @classmethod
+    def from_patient_index(cls, patient_index, curies_key):
+        """ Builds the matrix on the curie tables and CSR arrays of a
+        chp.patient_index.PatientBitsetIndex, without the raw patient data. The arrays of an
+        attached index stay views of its shared file.
+        """
+        prefix = {key: prefix for prefix, key in CURIES_KEYS.items()}[curies_key]
+        patient_curie_matrix = cls.__new__(cls)
+        patient_curie_matrix._setup(
+                curies_key,
+                patient_index.patients,
+                patient_index.feature_curies[prefix],
+                patient_index.curie_indptr[prefix],
+                patient_index.curie_indices[prefix],
+                )
+        return patient_curie_matrix
+
+    def _setup(self, curies_key, patients, curies, indptr, indices):
+        self.curies_key = curies_key
+        self.patient_idxs = {patient: patient_idx for patient_idx, patient in enumerate(patients)}
+        self.curies = curies
+        # The curies of every patient in the order the patient lists them. Patients carrying a
+        # curie more than once count it each time in the matrix products, as the loops did.
+        self.indptr = indptr
+        self.indices = indices
+        self.matrix = scipy.sparse.csr_matrix(
+                (np.ones(len(indices), dtype=np.int8), indices, indptr),
+                shape=(len(patients), len(curies)),
+                copy=False,
+                )
+
+    def get_contribution_matrix(self, patient_contributions):
+        """ Same as ContributionMatrix.from_patient_contributions over this dataset. Only the
+        curies of the patients that have a contribution are kept, in the order the contributing
+        patients first list them, so tied contributions rank the same as with the loops.
+
+        :param patient_contributions: Contributions of the form {target: {patient: contribution}}.
+        :type patient_contributions: dict
+
+        :rtype: chp.contributions.ContributionMatrix
+        """
+        targets = list(patient_contributions.keys())
+        weights = np.zeros((len(self.patient_idxs), len(targets)))
+        contributing = {}
+        for col, target in enumerate(targets):
+            for patient, contrib in patient_contributions[target].items():
+                weights[self.patient_idxs[patient], col] += contrib
+                contributing.setdefault(self.patient_idxs[patient], None)
+        rows = self._get_first_seen_curies(np.fromiter(contributing, dtype=np.intp, count=len(contributing)))
+        values = np.asarray(self.matrix.T @ weights)[rows]
+        return ContributionMatrix([self.curies[row] for row in rows], targets, values)
+
+    def _get_first_seen_curies(self, patient_idxs):
+        """ Returns the curie columns of the patients, ordered by their first occurrence when
+        the curies of the patients are listed one patient after another.
+        """
+        starts = self.indptr[patient_idxs]
+        lengths = self.indptr[patient_idxs + 1] - starts
+        # Positions of the curies of all patients in self.indices, patient after patient
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        curie_idxs = self.indices[offsets + np.arange(lengths.sum())]
+        columns, first_seen = np.unique(curie_idxs, return_index=True)
+        return columns[np.argsort(first_seen, kind='stable')]
+
+def to_relative_contributions(curies, relative):
+    """ Returns the {curie: {'relative': contribution}} form the handlers rank and cache.
+    """
+    return {curie: {'relative': contrib} for curie, contrib in zip(curies, relative.tolist())}
+
+def get_top_k_indices(scores, k=None):
+    """ Returns the indices of the k scores with the largest absolute value, ordered by
+    decreasing absolute value. Ties keep their original order, like a stable sort would.
+    Selects candidates with a partial partition, so only the k best are sorted.
+
+    :param scores: The scores.
+    :type scores: numpy.ndarray
+    :param k: Number of indices to return. None returns all indices.
+    :type k: int
+
+    :rtype: numpy.ndarray
+    """
+    abs_scores = np.abs(np.asarray(scores, dtype=float))
+    num_scores = len(abs_scores)
+    if k is None or k >= num_scores:
+        candidates = np.arange(num_scores)
+    elif k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    else:
+        # The k-th largest score and every score tied with it are candidates
+        kth_score = np.partition(abs_scores, num_scores - k)[num_scores - k]
+        candidates = np.flatnonzero(abs_scores >= kth_score)
+    order = np.lexsort((candidates, -abs_scores[candidates]))
+    return candidates[order][:k]
+
+def rank_wildcard_contributions(wildcard_contributions, k=None):
+    """ Returns the (relative contribution, curie) tuples of the k curies with the largest
+    absolute relative contribution, best first.
+
+    :param wildcard_contributions: Contributions of the form {curie: {'relative': contribution}}.
+    :type wildcard_contributions: dict
+    """
+    curies = list(wildcard_contributions.keys())
+    relative = np.array([wildcard_contributions[curie]['relative'] for curie in curies], dtype=float)
+    return [(relative[idx].item(), curies[idx]) for idx in get_top_k_indices(relative, k)]
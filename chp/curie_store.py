@@ -0,0 +1,248 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import os
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import tempfile
+from array import array
+
+logger = logging.getLogger(__name__)
+
+CURIE_STORE_MAGIC = b'CHPCURIE'
+CURIE_STORE_FORMAT_VERSION = 1
+CURIE_STORE_EXTENSION = '.chpcuries'
+_PREAMBLE = struct.Struct('<8sII')
+_OFFSET_TYPECODE = 'Q'
+_OFFSET_SIZE = array(_OFFSET_TYPECODE).itemsize
+
+def _get_entity_curie(entity):
+    # Accept biolink entity objects as well as their curies, e.g. 'biolink:Gene'.
+    if isinstance(entity, str):
+        return entity
+    return entity.get_curie()
+
+def _get_source_version(curies_path):
+    stat = os.stat(curies_path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+def _align(offset):
+    return -(-offset // _OFFSET_SIZE) * _OFFSET_SIZE
+
+def _pack_strings(strings):
+    """ Returns the (offsets, blob) of utf-8 encoded strings, where string i is
+    blob[offsets[i]:offsets[i+1]].
+    """
+    offsets = array(_OFFSET_TYPECODE, [0])
+    blob = bytearray()
+    for string in strings:
+        blob.extend(string)
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+def write_curie_store(curie_store_path, curies, source_version=None):
+    """ Writes a curies dictionary ({entity curie: {curie: value list}}) to a single memory
+    mappable file.
+
+        The file is a fixed preamble (magic, format version, header length) and a JSON header
+        holding the offsets of each entity's sections. Per entity, the curies are stored sorted
+        as utf-8 bytes behind an array of their offsets, followed by the JSON encoded values in
+        the same order behind their own offset array. The file is written to a temporary file
+        first and then moved into place so readers never see a partial store.
+
+        :param curie_store_path: Where to write the store.
+        :type curie_store_path: str
+        :param curies: The curies as parsed from a CHP curies JSON file.
+        :type curies: dict
+        :param source_version: Identifies the curies file the store was built from.
+        :type source_version: dict
+    """
+    sections = []
+    for entity_curie, entity_curies in curies.items():
+        keys = sorted(curie.encode('utf_8') for curie in entity_curies)
+        key_offsets, key_blob = _pack_strings(keys)
+        value_offsets, value_blob = _pack_strings(
+                json.dumps(entity_curies[key.decode('utf_8')]).encode('utf_8') for key in keys
+                )
+        sections.append((entity_curie, len(keys), [key_offsets.tobytes(), key_blob, value_offsets.tobytes(), value_blob]))
+
+    header = {
+            "format_version": CURIE_STORE_FORMAT_VERSION,
+            "source_version": source_version,
+            "entities": {},
+            }
+    # Reserve enough room for the header regardless of the offsets written into it.
+    header_size = len(json.dumps(header).encode('utf_8')) + 160 * (len(sections) + 1)
+    for entity_curie, _, _ in sections:
+        header_size += len(json.dumps(entity_curie).encode('utf_8'))
+    offset = _align(_PREAMBLE.size + header_size)
+    for entity_curie, count, blobs in sections:
+        section_offsets = []
+        for blob in blobs:
+            section_offsets.append(offset)
+            offset = _align(offset + len(blob))
+        header["entities"][entity_curie] = [count] + section_offsets
+    header_bytes = json.dumps(header).encode('utf_8')
+
+    curie_store_dir = os.path.dirname(os.path.abspath(curie_store_path))
+    fd, tmp_path = tempfile.mkstemp(dir=curie_store_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f_:
+            f_.write(_PREAMBLE.pack(CURIE_STORE_MAGIC, CURIE_STORE_FORMAT_VERSION, len(header_bytes)))
+            f_.write(header_bytes)
+            for entity_curie, _, blobs in sections:
+                for section_offset, blob in zip(header["entities"][entity_curie][1:], blobs):
+                    f_.write(b'\x00' * (section_offset - f_.tell()))
+                    f_.write(blob)
+        os.replace(tmp_path, curie_store_path)
+    except:
+        os.remove(tmp_path)
+        raise
+    logger.info('Wrote curie store to {}.'.format(curie_store_path))
+    return curie_store_path
+
+class CurieStoreEntity:
+    """ Read only view of the curies of one biolink entity in a CurieStore. Supports
+    `curie in view`, `view[curie]` (the curie's value list, e.g. its names), get, len and iteration.
+    """
+    def __init__(self, buffer, count, key_offsets_offset, keys_offset, value_offsets_offset, values_offset):
+        self.count = count
+        self._buffer = buffer
+        self._key_offsets = buffer[key_offsets_offset:key_offsets_offset + (count + 1) * _OFFSET_SIZE].cast(_OFFSET_TYPECODE)
+        self._keys_offset = keys_offset
+        self._value_offsets = buffer[value_offsets_offset:value_offsets_offset + (count + 1) * _OFFSET_SIZE].cast(_OFFSET_TYPECODE)
+        self._values_offset = values_offset
+
+    def _get_key(self, index):
+        start = self._keys_offset + self._key_offsets[index]
+        return self._buffer[start:self._keys_offset + self._key_offsets[index + 1]].tobytes()
+
+    def _find(self, curie):
+        if not isinstance(curie, str):
+            return -1
+        key = curie.encode('utf_8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._get_key(low) == key:
+            return low
+        return -1
+
+    def _get_value(self, index):
+        start = self._values_offset + self._value_offsets[index]
+        return json.loads(self._buffer[start:self._values_offset + self._value_offsets[index + 1]].tobytes())
+
+    def __contains__(self, curie):
+        return self._find(curie) >= 0
+
+    def __getitem__(self, curie):
+        index = self._find(curie)
+        if index < 0:
+            raise KeyError(curie)
+        return self._get_value(index)
+
+    def get(self, curie, default=None):
+        index = self._find(curie)
+        if index < 0:
+            return default
+        return self._get_value(index)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self._get_key(index).decode('utf_8')
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for index in range(self.count):
+            yield self._get_key(index).decode('utf_8'), self._get_value(index)
+
+class CurieStore:
+    """ Read only, memory mapped curie store written by write_curie_store.
+
+        Replaces both the CurieDatabase curies and the parsed curies JSON of the handlers:
+        store[entity] returns a CurieStoreEntity view where entity is a biolink entity or its
+        curie. Lookups binary search the mapped, sorted curies, so the curies are never parsed
+        into Python objects and forked workers share the page cache of the file.
+
+        :param curie_store_path: Path of the store.
+        :type curie_store_path: str
+    """
+    def __init__(self, curie_store_path):
+        self.curie_store_path = curie_store_path
+        with open(curie_store_path, 'rb') as f_:
+            self._mmap = mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, header_length = _PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != CURIE_STORE_MAGIC:
+            raise ValueError('{} is not a CHP curie store.'.format(curie_store_path))
+        if format_version != CURIE_STORE_FORMAT_VERSION:
+            raise ValueError('Curie store format version {} but expected {}.'.format(format_version, CURIE_STORE_FORMAT_VERSION))
+        self.header = json.loads(bytes(self._mmap[_PREAMBLE.size:_PREAMBLE.size + header_length]))
+        self.source_version = self.header["source_version"]
+        buffer = memoryview(self._mmap)
+        self._entities = {
+                entity_curie: CurieStoreEntity(buffer, *section_offsets)
+                for entity_curie, section_offsets in self.header["entities"].items()
+                }
+
+    def __getitem__(self, entity):
+        return self._entities[_get_entity_curie(entity)]
+
+    def __contains__(self, entity):
+        return _get_entity_curie(entity) in self._entities
+
+    def get(self, entity, default=None):
+        return self._entities.get(_get_entity_curie(entity), default)
+
+    def keys(self):
+        return self._entities.keys()
+
+    def __iter__(self):
+        return iter(self._entities)
+
+    def __len__(self):
+        return len(self._entities)
+
+def get_curie_store_path(curie_store_dir, curies_path):
+    """ Returns the store filename of a curies file. It is keyed by a hash of the absolute path
+    of the curies file, so curies files that share a basename get their own stores.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(curies_path).encode('utf_8')).hexdigest()[:16]
+    return os.path.join(curie_store_dir, '{}.{}{}'.format(os.path.basename(curies_path), path_hash, CURIE_STORE_EXTENSION))
+
+def load_curie_store(curies_path, curie_store_dir=None):
+    """ Returns the curie store of a curies JSON file, (re)building it in curie_store_dir
+    (default: the temporary directory) if it is missing or was built from another version
+    of the curies file.
+    """
+    if curie_store_dir is None:
+        curie_store_dir = tempfile.gettempdir()
+    curie_store_path = get_curie_store_path(curie_store_dir, curies_path)
+    source_version = _get_source_version(curies_path)
+    if os.path.exists(curie_store_path):
+        try:
+            curie_store = CurieStore(curie_store_path)
+            if curie_store.source_version == source_version:
+                return curie_store
+        except ValueError as ex:
+            logger.warning('Rebuilding curie store. {}'.format(str(ex)))
+    with open(curies_path, 'r') as f_:
+        curies = json.load(f_)
+    write_curie_store(curie_store_path, curies, source_version=source_version)
+    return CurieStore(curie_store_path)
@@ -0,0 +1,289 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import os
+import json
+import mmap
+import pickle
+import struct
+import hashlib
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INTERPOLATION_TABLE_MAGIC = b'CHPINTRP'
+INTERPOLATION_TABLE_FORMAT_VERSION = 1
+INTERPOLATION_TABLE_EXTENSION = '.chpinterp'
+_PREAMBLE = struct.Struct('<8sII')
+_ALIGNMENT = 8
+
+# Sections of the table and their dtypes, in file order.
+INTERPOLATION_TABLE_SECTIONS = [
+        ('curie_offsets', np.uint64),
+        ('curies', np.uint8),
+        ('is_row', np.uint8),
+        ('indptr', np.uint64),
+        ('indices', np.uint32),
+        ('weights', np.float32),
+        ]
+
+def _get_source_version(interpolations_path):
+    stat = os.stat(interpolations_path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+def _iter_neighbors(neighbors):
+    if isinstance(neighbors, dict):
+        return neighbors.items()
+    try:
+        return [(neighbor, weight) for neighbor, weight in neighbors]
+    except (TypeError, ValueError):
+        raise ValueError('Unsupported interpolation table format, expected {curie: {curie: weight}}.')
+
+def write_interpolation_table(interpolation_table_path, interpolations, source_version=None):
+    """ Writes interpolations of the form {curie: {neighbor curie: weight}} (or {curie: [(neighbor
+    curie, weight), ...]}) to a single memory mappable file.
+
+        Every curie (row or neighbor) is interned once: the sorted curies are stored as utf-8
+        bytes behind an array of their offsets and a curie id is its position. The neighbors of
+        each row are stored as CSR arrays, i.e. row pointers, uint32 neighbor ids and float32
+        weights. The file is a fixed preamble (magic, format version, header length), a JSON
+        header with the section offsets and the 8 byte aligned sections. It is written to a
+        temporary file first and then moved into place so readers never see a partial table.
+
+        :param interpolation_table_path: Where to write the table.
+        :type interpolation_table_path: str
+        :param interpolations: The unpickled interpolations.
+        :type interpolations: dict
+        :param source_version: Identifies the interpolations file the table was built from.
+        :type source_version: dict
+    """
+    if not isinstance(interpolations, dict):
+        raise ValueError('Unsupported interpolation table format, expected {curie: {curie: weight}}.')
+    rows = {curie: list(_iter_neighbors(neighbors)) for curie, neighbors in interpolations.items()}
+    curies = set(rows)
+    for neighbors in rows.values():
+        curies.update(neighbor for neighbor, _ in neighbors)
+    curies = sorted(curie.encode('utf_8') for curie in curies)
+    curie_ids = {curie.decode('utf_8'): curie_id for curie_id, curie in enumerate(curies)}
+
+    is_row = np.zeros(len(curies), dtype=np.uint8)
+    indptr = np.zeros(len(curies) + 1, dtype=np.uint64)
+    indices = []
+    weights = []
+    for curie_id, curie in enumerate(curies):
+        neighbors = rows.get(curie.decode('utf_8'))
+        if neighbors is not None:
+            is_row[curie_id] = 1
+            for neighbor, weight in neighbors:
+                indices.append(curie_ids[neighbor])
+                weights.append(weight)
+        indptr[curie_id + 1] = len(indices)
+    curie_offsets = np.zeros(len(curies) + 1, dtype=np.uint64)
+    curie_offsets[1:] = np.cumsum([len(curie) for curie in curies], dtype=np.uint64)
+    arrays = {
+            "curie_offsets": curie_offsets,
+            "curies": np.frombuffer(b''.join(curies), dtype=np.uint8),
+            "is_row": is_row,
+            "indptr": indptr,
+            "indices": np.asarray(indices, dtype=np.uint32),
+            "weights": np.asarray(weights, dtype=np.float32),
+            }
+
+    header = {
+            "format_version": INTERPOLATION_TABLE_FORMAT_VERSION,
+            "source_version": source_version,
+            "num_curies": len(curies),
+            "num_rows": len(rows),
+            "sections": {name: [0, len(arrays[name])] for name, _ in INTERPOLATION_TABLE_SECTIONS},
+            }
+    # Reserve enough room for the header regardless of the offsets written into it.
+    header_size = len(json.dumps(header).encode('utf_8')) + 32 * len(INTERPOLATION_TABLE_SECTIONS)
+    offset = _align(_PREAMBLE.size + header_size)
+    for name, _ in INTERPOLATION_TABLE_SECTIONS:
+        header["sections"][name][0] = offset
+        offset = _align(offset + arrays[name].nbytes)
+    header_bytes = json.dumps(header).encode('utf_8')
+
+    interpolation_table_dir = os.path.dirname(os.path.abspath(interpolation_table_path))
+    fd, tmp_path = tempfile.mkstemp(dir=interpolation_table_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f_:
+            f_.write(_PREAMBLE.pack(INTERPOLATION_TABLE_MAGIC, INTERPOLATION_TABLE_FORMAT_VERSION, len(header_bytes)))
+            f_.write(header_bytes)
+            for name, dtype in INTERPOLATION_TABLE_SECTIONS:
+                section_offset, _ = header["sections"][name]
+                f_.write(b'\x00' * (section_offset - f_.tell()))
+                f_.write(arrays[name].astype(dtype, copy=False).tobytes())
+        os.replace(tmp_path, interpolation_table_path)
+    except:
+        os.remove(tmp_path)
+        raise
+    logger.info('Wrote interpolation table to {}.'.format(interpolation_table_path))
+    return interpolation_table_path
+
+class InterpolationTable:
+    """ Read only, memory mapped interpolation table written by write_interpolation_table.
+
+        Behaves like the unpickled {curie: {neighbor curie: weight}} dictionary: supports
+        `curie in table`, `table[curie]`, get, len, iteration, keys and items, where a row is
+        decoded only when it is accessed. get_neighbors returns the neighbor ids and float32
+        weights of a row as zero copy array views. Forked workers and all disease configurations
+        share the page cache of the file and opening a table does not read it.
+
+        :param interpolation_table_path: Path of the table.
+        :type interpolation_table_path: str
+    """
+    def __init__(self, interpolation_table_path):
+        self.interpolation_table_path = interpolation_table_path
+        with open(interpolation_table_path, 'rb') as f_:
+            self._mmap = mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, header_length = _PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != INTERPOLATION_TABLE_MAGIC:
+            raise ValueError('{} is not a CHP interpolation table.'.format(interpolation_table_path))
+        if format_version != INTERPOLATION_TABLE_FORMAT_VERSION:
+            raise ValueError('Interpolation table format version {} but expected {}.'.format(format_version, INTERPOLATION_TABLE_FORMAT_VERSION))
+        self.header = json.loads(bytes(self._mmap[_PREAMBLE.size:_PREAMBLE.size + header_length]))
+        self.source_version = self.header["source_version"]
+        self.num_curies = self.header["num_curies"]
+        for name, dtype in INTERPOLATION_TABLE_SECTIONS:
+            offset, count = self.header["sections"][name]
+            setattr(self, name, np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset))
+
+    def __reduce__(self):
+        # Pickle (e.g. into snapshots or to workers) as a reference to the mapped file.
+        return (InterpolationTable, (self.interpolation_table_path,))
+
+    def _get_curie_bytes(self, curie_id):
+        return self.curies[int(self.curie_offsets[curie_id]):int(self.curie_offsets[curie_id + 1])].tobytes()
+
+    def get_curie(self, curie_id):
+        return self._get_curie_bytes(curie_id).decode('utf_8')
+
+    def get_curie_id(self, curie):
+        """ Returns the interned id of a curie or -1.
+        """
+        if not isinstance(curie, str):
+            return -1
+        key = curie.encode('utf_8')
+        low, high = 0, self.num_curies
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_curie_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.num_curies and self._get_curie_bytes(low) == key:
+            return low
+        return -1
+
+    def _get_row_id(self, curie):
+        curie_id = self.get_curie_id(curie)
+        if curie_id < 0 or not self.is_row[curie_id]:
+            return -1
+        return curie_id
+
+    def get_neighbors(self, curie):
+        """ Returns the (neighbor ids, weights) arrays of a curie's row.
+        """
+        row_id = self._get_row_id(curie)
+        if row_id < 0:
+            raise KeyError(curie)
+        start, end = int(self.indptr[row_id]), int(self.indptr[row_id + 1])
+        return self.indices[start:end], self.weights[start:end]
+
+    def _get_row(self, row_id):
+        start, end = int(self.indptr[row_id]), int(self.indptr[row_id + 1])
+        return {self.get_curie(neighbor_id): weight for neighbor_id, weight in zip(self.indices[start:end].tolist(), self.weights[start:end].tolist())}
+
+    def __contains__(self, curie):
+        return self._get_row_id(curie) >= 0
+
+    def __getitem__(self, curie):
+        row_id = self._get_row_id(curie)
+        if row_id < 0:
+            raise KeyError(curie)
+        return self._get_row(row_id)
+
+    def get(self, curie, default=None):
+        row_id = self._get_row_id(curie)
+        if row_id < 0:
+            return default
+        return self._get_row(row_id)
+
+    def __len__(self):
+        return self.header["num_rows"]
+
+    def __iter__(self):
+        for row_id in np.flatnonzero(self.is_row).tolist():
+            yield self.get_curie(row_id)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for row_id in np.flatnonzero(self.is_row).tolist():
+            yield self.get_curie(row_id), self._get_row(row_id)
+
+def get_interpolation_table_path(interpolation_table_dir, interpolations_path):
+    """ Returns the table filename of an interpolations file. It is keyed by a hash of the
+    absolute path of the interpolations file, so interpolations files of different disease
+    configurations that share a basename get their own tables.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(interpolations_path).encode('utf_8')).hexdigest()[:16]
+    return os.path.join(interpolation_table_dir, '{}.{}{}'.format(os.path.basename(interpolations_path), path_hash, INTERPOLATION_TABLE_EXTENSION))
+
+def convert_interpolations(interpolations_path, interpolation_table_dir=None):
+    """ Converts a pickled interpolations file into an interpolation table in
+    interpolation_table_dir (default: the temporary directory) and returns the table path.
+    """
+    if interpolation_table_dir is None:
+        interpolation_table_dir = tempfile.gettempdir()
+    with open(interpolations_path, 'rb') as f_:
+        interpolations = pickle.load(f_)
+    return write_interpolation_table(
+            get_interpolation_table_path(interpolation_table_dir, interpolations_path),
+            interpolations,
+            source_version=_get_source_version(interpolations_path),
+            )
+
+def load_interpolation_table(interpolations_path, interpolation_table_dir=None):
+    """ Returns the interpolation table of a pickled interpolations file, (re)converting it in
+    interpolation_table_dir (default: the temporary directory) if it is missing or was built
+    from another version of the interpolations file.
+    """
+    if interpolation_table_dir is None:
+        interpolation_table_dir = tempfile.gettempdir()
+    interpolation_table_path = get_interpolation_table_path(interpolation_table_dir, interpolations_path)
+    if os.path.exists(interpolation_table_path):
+        try:
+            interpolation_table = InterpolationTable(interpolation_table_path)
+            if interpolation_table.source_version == _get_source_version(interpolations_path):
+                return interpolation_table
+        except ValueError as ex:
+            logger.warning('Rebuilding interpolation table. {}'.format(str(ex)))
+    return InterpolationTable(convert_interpolations(interpolations_path, interpolation_table_dir))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert pickled CHP interpolations into memory mapped interpolation tables.')
+    parser.add_argument('interpolation_table_dir', help='Directory to write the tables into.')
+    parser.add_argument('interpolations_paths', nargs='+', help='Pickled interpolations files.')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.interpolation_table_dir, exist_ok=True)
+    for interpolations_path in args.interpolations_paths:
+        print(convert_interpolations(interpolations_path, args.interpolation_table_dir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import logging
+
+logger = logging.getLogger(__name__)
+
+class MetaKnowledgeGraphIndex:
+    """ Lookup tables over a meta knowledge graph that are built once when it is loaded.
+
+        :param meta_knowledge_graph: The CHP meta knowledge graph.
+        :type meta_knowledge_graph: trapi_model.meta_knowledge_graph.MetaKnowledgeGraph
+
+        Attributes:
+            :prefix_to_entity: Curie prefix to the supported biolink entity. If several entities
+                support a prefix, the first one in the meta knowledge graph wins.
+            :entity_depth: Biolink entity to its number of ancestors (higher is more specific).
+            :preferred_prefix: Biolink entity to its preferred (first) curie prefix.
+            :curie_to_entity: Biolink curie, e.g. 'biolink:Gene', to the supported biolink entity.
+    """
+    def __init__(self, meta_knowledge_graph):
+        self.prefix_to_entity = {}
+        self.entity_depth = {}
+        self.preferred_prefix = {}
+        self.curie_to_entity = {}
+        for biolink_entity, meta_node in meta_knowledge_graph.nodes.items():
+            for prefix in meta_node.id_prefixes:
+                if prefix not in self.prefix_to_entity:
+                    self.prefix_to_entity[prefix] = biolink_entity
+            self.entity_depth[biolink_entity] = len(biolink_entity.get_ancestors())
+            if len(meta_node.id_prefixes) > 0:
+                self.preferred_prefix[biolink_entity] = meta_node.id_prefixes[0]
+            self.curie_to_entity[biolink_entity.get_curie()] = biolink_entity
+
+    def get_entity(self, curie_prefix):
+        """ Returns the supported biolink entity of a curie prefix or None.
+        """
+        return self.prefix_to_entity.get(curie_prefix)
+
+    def get_supported_entity(self, biolink_type):
+        """ Returns the supported biolink entity for a biolink entity or biolink curie or None.
+        """
+        if isinstance(biolink_type, str):
+            return self.curie_to_entity.get(biolink_type)
+        if biolink_type in self.entity_depth:
+            return biolink_type
+        return None
+
+    def get_more_specific_entity(self, *biolink_entities):
+        """ Returns the most specific of the passed supported biolink entities.
+        """
+        return max(biolink_entities, key=lambda entity: self.entity_depth[entity])
+
+    def get_preferred_curie(self, normalized_node_dict):
+        """ Returns the equivalent curie of a normalized node with the preferred prefix of its
+        most specific supported biolink type or None.
+        """
+        supported_entities = set()
+        for biolink_type in normalized_node_dict["types"]:
+            supported_entity = self.get_supported_entity(biolink_type)
+            if supported_entity is not None:
+                supported_entities.add(supported_entity)
+        # Biolink category isn't supported
+        if len(supported_entities) == 0:
+            return None
+        preferred_prefix = self.preferred_prefix.get(self.get_more_specific_entity(*supported_entities))
+        for curie in normalized_node_dict["equivalent_identifiers"]:
+            # Node normalizer identifiers may be curies or {"identifier": curie} dicts
+            if isinstance(curie, dict):
+                curie = curie["identifier"]
+            if curie.split(':')[0] == preferred_prefix:
+                return curie
+        return None
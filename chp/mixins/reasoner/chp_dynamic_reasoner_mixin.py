@@ -12,11 +12,14 @@ class ChpDynamicReasonerMixin:
     """ This reasoner class is responsible for running all dynamic BKB queries.
     """
     def _setup_reasoner(self):
-        # Construct linker
-        self.linker_builder = LinkerBuilder(self.patient_data)
-        logger.info('Constructed Linker Builder from processed patient data.')
+        # The linker is constructed on the first dynamic query, so the patient data is only
+        # loaded by processes that run dynamic queries
+        self._linker_builder = None
         # Load in gene prelinked bkb for bkb_data_handler or appropriate override
-        if self.gene_prelinked_bkb_override is None:
+        if self.gene_prelinked_bkb_override is None and self.snapshot is not None:
+            self.gene_prelinked_bkb = self.snapshot.get('gene_prelinked_bkb')
+            logger.info('Loaded in gene prelinked bkb from snapshot.')
+        elif self.gene_prelinked_bkb_override is None:
             with open(self.bkb_handler.collapsed_gene_bkb_path, 'rb') as f_:
                 self.gene_prelinked_bkb = compress_pickle.load(f_, compression='lz4')
             logger.info('Loaded in gene prelinked bkb from: {}'.format(self.bkb_handler.collapsed_gene_bkb_path))
@@ -24,7 +27,10 @@ class ChpDynamicReasonerMixin:
             self.gene_prelinked_bkb = self.gene_prelinked_bkb_override
             logger.info('Loaded override gene prelinked bkb.')
         # Load in drug prelinked bkb for bkb_data_handler or appropriate override
-        if self.drug_prelinked_bkb_override is None:
+        if self.drug_prelinked_bkb_override is None and self.snapshot is not None:
+            self.drug_prelinked_bkb = self.snapshot.get('drug_prelinked_bkb')
+            logger.info('Loaded in drug prelinked bkb from snapshot.')
+        elif self.drug_prelinked_bkb_override is None:
             with open(self.bkb_handler.collapsed_drug_bkb_path, 'rb') as f_:
                 self.drug_prelinked_bkb = compress_pickle.load(f_, compression='lz4')
             logger.info('Loaded in drug prelinked bkb from: {}'.format(self.bkb_handler.collapsed_drug_bkb_path))
@@ -32,6 +38,15 @@ class ChpDynamicReasonerMixin:
             self.drug_prelinked_bkb = self.drug_prelinked_bkb_override
             logger.info('Loaded override drug prelinked bkb.')
 
+    @property
+    def linker_builder(self):
+        with self._lazy_lock:
+            if self._linker_builder is None:
+                # Construct linker
+                self._linker_builder = LinkerBuilder(self.patient_data)
+                logger.info('Constructed Linker Builder from processed patient data.')
+            return self._linker_builder
+
     def _pool_properties(self, query, bkb):
         """ Pools all the evidence and targets that aren't in the prelinked BKB and gets them
         ready to link.
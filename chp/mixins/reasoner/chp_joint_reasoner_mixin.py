@@ -4,28 +4,130 @@ import pickle
 from pybkb.python_base.reasoning.reasoning import updating
 from pybkb.python_base.reasoning.joint_reasoner import JointReasoner
 
+from chp.result_cache import get_data_version
+from chp.interpolation_store import InterpolationTable, load_interpolation_table
+
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.INFO)
 
 class ChpJointReasonerMixin:
     def _setup_reasoner(self):
-        if self.bkb_handler.gene_interpolations_path is not None:
-            with open(self.bkb_handler.gene_interpolations_path, 'rb') as f:
-                gene_interpolations = pickle.load(f)
+        # Interpolations that are memory mapped tables (or come with the snapshot) are loaded
+        # now, pickled ones only with the pybkb joint reasoner that uses them.
+        self._gene_interpolations = None
+        self._drug_interpolations = None
+        self._interpolations_loaded = False
+        self._joint_reasoner = None
+        if self.snapshot is not None or self.interpolation_table_dir is not None:
+            self._load_all_interpolations()
+        if isinstance(self._gene_interpolations, InterpolationTable) or isinstance(self._drug_interpolations, InterpolationTable):
+            self.interpolation_format = 'table'
         else:
-            gene_interpolations_path = None
+            self.interpolation_format = 'pickle'
 
-        if self.bkb_handler.drug_interpolations_path is not None:
-            with open(self.bkb_handler.drug_interpolations_path, 'rb') as f:
-                drug_interpolations = pickle.load(f)
+        if self.joint_engine == 'bitset':
+            # Attaches to the index file shared by all processes serving this data if there is
+            # one, so the pybkb joint reasoner and the patient data are only loaded for queries
+            # the index can not answer.
+            self.patient_index = self.get_patient_index()
+        elif self.joint_engine == 'bkb':
+            self.patient_index = None
+            self._get_joint_reasoner()
         else:
-            drug_interpolations_path = None
-
-        self.joint_reasoner = JointReasoner(self.patient_data, 
-                                            gene_interpolations=gene_interpolations,
-                                            drug_interpolations=drug_interpolations)
+            raise ValueError('Unknown joint engine: {}'.format(self.joint_engine))
         logger.info('Setup Joint Reasoner.')
 
+    @property
+    def joint_reasoner(self):
+        return self._get_joint_reasoner()
+
+    @property
+    def gene_interpolations(self):
+        self._load_all_interpolations()
+        return self._gene_interpolations
+
+    @property
+    def drug_interpolations(self):
+        self._load_all_interpolations()
+        return self._drug_interpolations
+
+    def _get_joint_reasoner(self):
+        with self._lazy_lock:
+            if self._joint_reasoner is None:
+                self._joint_reasoner = JointReasoner(self.patient_data,
+                                                     gene_interpolations=self.gene_interpolations,
+                                                     drug_interpolations=self.drug_interpolations)
+            return self._joint_reasoner
+
+    def _load_all_interpolations(self):
+        with self._lazy_lock:
+            if self._interpolations_loaded:
+                return
+            if self.snapshot is not None:
+                self._gene_interpolations = self.snapshot.get('gene_interpolations')
+                self._drug_interpolations = self.snapshot.get('drug_interpolations')
+            else:
+                self._gene_interpolations = self._load_interpolations(self.bkb_handler.gene_interpolations_path)
+                self._drug_interpolations = self._load_interpolations(self.bkb_handler.drug_interpolations_path)
+            self._interpolations_loaded = True
+
+    def _load_interpolations(self, interpolations_path):
+        if interpolations_path is None:
+            return None
+        # Map the array backed interpolation table instead of unpickling a private copy
+        if self.interpolation_table_dir is not None:
+            try:
+                return load_interpolation_table(interpolations_path, self.interpolation_table_dir)
+            except ValueError as ex:
+                logger.warning('Loading pickled interpolations. {}'.format(str(ex)))
+        with open(interpolations_path, 'rb') as f:
+            return pickle.load(f)
+
+    def get_result_version(self):
+        """ Returns what identifies the results of this reasoner: the data version, the joint
+        engine and the format of the loaded interpolations ('pickle' or float32 'table').
+        """
+        result_version = get_data_version(self.bkb_handler)
+        result_version["joint_engine"] = self.joint_engine
+        result_version["interpolation_format"] = self.interpolation_format
+        return result_version
+
+    @staticmethod
+    def _get_contribution_feature_type(contribution_type):
+        if contribution_type == 'gene':
+            return 'ENSEMBL'
+        elif contribution_type == 'drug':
+            return 'CHEMBL.COMPOUND'
+        return None
+
+    def _compute_joint(self, evidence, query, contribution_feature_type, interpolation_type):
+        """ Computes the joint probability with the patient bitset index if it supports the
+        query, otherwise (or with the 'bkb' engine) with the pybkb joint reasoner. Interpolated
+        queries and evidence no patient matches are always left to the pybkb joint reasoner.
+        """
+        if self.patient_index is not None and self.patient_index.supports(
+                evidence,
+                query.targets,
+                query.dynamic_evidence,
+                query.dynamic_targets,
+                interpolation_type,
+                ):
+            return self.patient_index.compute_joint(
+                evidence,
+                query.targets,
+                continuous_evidence=query.dynamic_evidence,
+                continuous_targets=query.dynamic_targets,
+                contribution_features=contribution_feature_type,
+            )
+        return self.joint_reasoner.compute_joint(
+            evidence,
+            query.targets,
+            continuous_evidence=query.dynamic_evidence,
+            continuous_targets=query.dynamic_targets,
+            contribution_features=contribution_feature_type,
+            interpolation_type=interpolation_type
+        )
+
     def run_query(self, query, interpolation_type=None, contribution_type=None):
         # Compute joint probability
         '''
@@ -36,24 +138,94 @@ class ChpJointReasonerMixin:
             if return_contributions:
                 contribution_feature_type = 'CHEMBL.COMPOUND'
         '''
-        if contribution_type == 'gene':
-            contribution_feature_type = 'ENSEMBL'
-        elif contribution_type == 'drug':
-            contribution_feature_type = 'CHEMBL.COMPOUND'
-        else:
-            contribution_feature_type = None
+        contribution_feature_type = self._get_contribution_feature_type(contribution_type)
 
         evidence = query.compose_evidence(with_dynamic=False, meta_tag=False)
-        res, contrib = self.joint_reasoner.compute_joint(
-            evidence,
-            query.targets,
-            continuous_evidence=query.dynamic_evidence,
-            continuous_targets=query.dynamic_targets,
-            contribution_features=contribution_feature_type,
-            interpolation_type=interpolation_type
-        )
+        res, contrib = self._compute_joint(evidence, query, contribution_feature_type, interpolation_type)
         # Set query parameters
         query.result = res
         query.contributions = contrib
         query.from_joint_reasoner = True
         return query
+
+    def run_extended_queries(self, query, extension_curies, extension_state='True', interpolation_type=None, contribution_type=None):
+        """ Runs a query once per extension curie, each time with only that curie added as meta
+        evidence to the evidence of the query. The query itself is not changed, so it does not
+        have to be copied per extension. With the patient bitset index, the base evidence mask
+        is built once and all extensions are computed in one pass over it.
+
+        :param query: The base query.
+        :type query: chp.query.Query
+        :param extension_curies: The curies that extend the base evidence one at a time.
+        :type extension_curies: list
+        :param extension_state: The state of each extension curie.
+        :type extension_state: str
+
+        :return: A (result, contributions) tuple per extension curie, in the same order.
+        :rtype: list
+        """
+        contribution_feature_type = self._get_contribution_feature_type(contribution_type)
+        # Compose the shared base evidence only once
+        base_evidence = dict(query.compose_evidence(with_dynamic=False, meta_tag=False))
+        if self.patient_index is not None and self.patient_index.supports_extensions(
+                base_evidence,
+                extension_curies,
+                extension_state,
+                query.targets,
+                query.dynamic_evidence,
+                query.dynamic_targets,
+                interpolation_type,
+                ):
+            return self.patient_index.compute_extended_joints(
+                base_evidence,
+                extension_curies,
+                extension_state,
+                query.targets,
+                continuous_evidence=query.dynamic_evidence,
+                continuous_targets=query.dynamic_targets,
+                contribution_features=contribution_feature_type,
+            )
+        extended_results = []
+        for curie in extension_curies:
+            evidence = dict(base_evidence)
+            evidence[curie] = extension_state
+            extended_results.append(self._compute_joint(evidence, query, contribution_feature_type, interpolation_type))
+        return extended_results
+
+    def run_survival_sweep(self, query, thresholds, contribution_type=None):
+        """ Computes the joint probability of the query for its survival target operator at
+        every threshold at once with the patient bitset index, see
+        chp.patient_index.PatientBitsetIndex.compute_survival_sweep. Takes the same evidence,
+        including 'False' and dynamic evidence, as run_query. Evidence that matches no patient
+        gives zero probabilities at every threshold.
+
+        :param query: The query, its dynamic target operator is used for every threshold.
+        :type query: chp.query.Query
+        :param thresholds: The survival time thresholds.
+        :type thresholds: list
+        :param contribution_type: 'gene', 'drug' or None to compute the contributions of both.
+        :type contribution_type: str
+
+        :return: A (result, contributions) tuple per threshold, in the same order.
+        :rtype: list
+        :raises ValueError: If there is no patient bitset index (the 'bkb' joint engine) or it
+            can not answer the query.
+        """
+        if self.patient_index is None:
+            raise ValueError('Survival sweeps need the bitset joint engine.')
+        evidence = query.compose_evidence(with_dynamic=False, meta_tag=False)
+        if not self.patient_index.supports_query(evidence, query.targets, query.dynamic_evidence, query.dynamic_targets):
+            raise ValueError('The patient bitset index can not answer the survival sweep query.')
+        if contribution_type is None:
+            contribution_features = ['ENSEMBL', 'CHEMBL.COMPOUND']
+        else:
+            contribution_features = self._get_contribution_feature_type(contribution_type)
+        target = list(query.dynamic_targets.keys())[0]
+        return self.patient_index.compute_survival_sweep(
+            evidence,
+            query.dynamic_targets[target]["op"],
+            thresholds,
+            query.targets,
+            continuous_evidence=query.dynamic_evidence,
+            contribution_features=contribution_features,
+        )
@@ -12,33 +12,38 @@ import copy
 import csv
 import sys
 import pickle
+import logging
 from collections import defaultdict
 
 from trapi_model.biolink.constants import *
 
 from chp.query import Query as ChpQuery
 from chp.reasoner import ChpDynamicReasoner, ChpJointReasoner
+from chp.result_cache import get_data_version
+from chp.query_plan import QueryPlans, compile_query_graph, get_default_predicate_proxy, get_default_operator, get_default_value
+from chp.contributions import ContributionMatrix, get_normalization_weight, to_relative_contributions, get_top_k_indices, rank_wildcard_contributions
+from chp.response_builder import TrapiMessageBuilder, SURVIVAL_PROBABILITY_ATTRIBUTE, SURVIVAL_CURVE_ATTRIBUTE, CONTRIBUTION_ATTRIBUTE
 from chp_data.bkb_handler import BkbDataHandler
 from pybkb.python_base.utils import get_operator, get_opposite_operator
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
-# Default functions
-def get_default_predicate_proxy():
-    return 'EFO:0000714'
-
-def get_default_operator(predicate_proxy):
-    if predicate_proxy == 'EFO:0000714':
-        return '>='
-    else:
-        raise ValueError('Unknown predicate proxy: {}'.format(predicate_proxy))
+# Interpolation and contribution type each onehop type is reasoned with.
+ONEHOP_REASONING_TYPES = {
+        'standard': ('gene', None),
+        'gene': ('drug', 'gene'),
+        'drug_two_hop': ('drug', 'gene'),
+        'drug': ('gene', 'drug'),
+        'gene_two_hop': ('gene', 'drug'),
+        }
 
-def get_default_value(predicate_proxy):
-    if predicate_proxy == 'EFO:0000714':
-        return 978
-    else:
-        raise ValueError('Unknown predicate proxy: {}'.format(predicate_proxy))
+# Deepest ranked wildcard result a query can page to, i.e. the bound on the 'result_offset' and
+# 'max_results' constraints together.
+MAX_RESULT_WINDOW = 1000
+# Number of best one-hop candidates every two hop query is extended with. The depth does not
+# depend on the requested page, so all pages of a two hop query page over one ranking.
+TWO_HOP_CANDIDATES = 10
 
 def get_default_two_hop_proxy(message_type):
     if message_type == 'gene_two_hop':
@@ -60,8 +65,15 @@ class OneHopHandlerMixin:
             used for distributed reasoning.
         :type num_processes_per_host: int
         :param max_results: specific to 1-hop queries, specifies the number of
-            wildcard genes to return.
+            wildcard genes to return. A query can page through the ranked wildcard
+            results with the 'result_offset' and 'max_results' constraints of its edge.
         :type max_results: int
+        :param max_result_window: deepest ranked result a query can page to. Larger
+            'result_offset' and 'max_results' constraints are clamped. Defaults to MAX_RESULT_WINDOW.
+        :type max_result_window: int
+        :param two_hop_candidates: number of best one-hop candidates two hop queries are
+            extended with. Defaults to TWO_HOP_CANDIDATES.
+        :type two_hop_candidates: int
     """
 
     def _setup_handler(self):
@@ -90,145 +102,136 @@ class OneHopHandlerMixin:
                     num_processes_per_host=self.num_processes_per_host)
 
     def _setup_messages(self):
+        if self.query_plans is None:
+            self.query_plans = QueryPlans()
         self.queries_dict = defaultdict(list)
         for query in self.queries:
-            self.queries_dict[self._get_onehop_type(query.message)].append(query)
-
-    def _get_onehop_type(self, message):
-        wildcard_type = None
-        node_types = []
-        all_node_categories = []
-        for node_id, node in message.query_graph.nodes.items():
-            if node.ids is None:
-                if wildcard_type is None:
-                    wildcard_type = node.categories[0]
-                node_types.append(node.categories[0])
-            all_node_categories.append(node.categories[0])
-
-        # implicit 2-hop-queries
-        if all(category == BIOLINK_GENE_ENTITY for category in all_node_categories):
-            return 'gene_two_hop'
-        elif all(category == BIOLINK_DRUG_ENTITY for category in all_node_categories):
-            return 'drug_two_hop'
-
-        # If standard onehop query
-        if wildcard_type is None:
-            return 'standard'
-        elif wildcard_type == BIOLINK_DRUG_ENTITY:
-            return 'drug'
-        elif wildcard_type == BIOLINK_GENE_ENTITY:
-            return 'gene'
-        else:
-            raise ValueError('Did not understand wildcard type {}.'.format(wildcard_type))
+            self.queries_dict[self._get_query_plan(query).onehop_type].append(query)
+
+    def _get_query_plan(self, query):
+        """ Returns the compiled query graph plan of a query. Plans are normally compiled by the
+        TrapiInterface, otherwise the query graph is compiled here.
+        """
+        plan = self.query_plans.get(query)
+        if plan is None:
+            plan = compile_query_graph(query.message.query_graph)
+            self.query_plans.set(query, plan)
+        return plan
 
     def check_query(self):
         """ Currently not implemented. Would check validity of query.
         """
         return True
 
-    @staticmethod
-    def _process_predicate_proxy(qedge, chp_query):
-        predicate_proxy_constraint = qedge.find_constraint('predicate_proxy')
-        if predicate_proxy_constraint is None:
-            predicate_proxy = get_default_predicate_proxy()
-            proxy_constraint = qedge.find_constraint(predicate_proxy)
-        else:
-            predicate_proxy = predicate_proxy_constraint.value[0]
-            proxy_constraint = qedge.find_constraint(predicate_proxy)
-        if proxy_constraint is None:
-            proxy_operator = get_default_operator(predicate_proxy)
-            proxy_value = get_default_value(predicate_proxy)
-        else:
-            proxy_operator = proxy_constraint.operator
-            proxy_value = proxy_constraint.value
-        # Setup dynamic target
-        chp_query.add_dynamic_target(predicate_proxy, proxy_operator, proxy_value)
-        return chp_query
-
-
-    @staticmethod
-    def _process_predicate_context(qedge, message_type, chp_query):
-        evidence = {}
-        dynamic_evidence = {}
-        predicate_context_constraint = qedge.find_constraint('predicate_context')
-
-        if predicate_context_constraint is not None:
-            for context in predicate_context_constraint.value:
-                context_curie = get_biolink_entity(context)
-                context_constraint = qedge.find_constraint(context)
-                # used 2 hop structure where context curie is the proxy
-                if context_constraint is None:
-                     continue
-                if context_curie == BIOLINK_GENE_ENTITY:
-                    if message_type == 'gene' or message_type == 'drug_two_hop':
-                            if type(context_constraint.value) is list:
-                                for _curie in context_constraint.value:
-                                    chp_query.add_dynamic_evidence(_curie, '==', 'True')
-                            else:
-                                chp_query.add_dynamic_evidence(context_constraint.value, '==', 'True')
-                    else:
-                        if type(context_constraint.value) is list:
-                            for _curie in context_constraint.value:
-                                chp_query.add_meta_evidence(_curie, 'True')
-                        else:
-                            chp.add_meta_evidence(_curie, 'True')
-                elif context_curie == BIOLINK_DRUG_ENTITY:
-                    if message_type == 'drug' or message_type == 'gene_two_hop':
-                        if type(context_constraint.value) is list:
-                            for _curie in context_constraint.value:
-                                chp_query.add_dynamic_evidence(_curie, '==', 'True')
-                        else:
-                            chp_query.add_dynamic_evidence(context_constraint.value, '==', 'True')
-                    else:
-                        if type(context_constraint.value) is list:
-                            for _curie in context_constraint.value:
-                                chp_query.add_meta_evidence(_curie, 'True')
-                        else:
-                            chp_query.add_meta_evidence(_curie, 'True')
-                else:
-                    raise ValueError('Unsupported context type: {}'.format(context_curie))
-        return chp_query
-
     def _extract_chp_query(self, query, message_type):
-        # Extract Message
-        message = query.message
+        plan = self._get_query_plan(query)
 
         # Initialize CHP BKB Query
         chp_query = ChpQuery(reasoning_type='updating')
 
-        # Grab edge
-        for qedge_id, qedge in message.query_graph.edges.items():
-            break
-        # Process predicate proxy
-        chp_query = self._process_predicate_proxy(qedge, chp_query)
+        # Setup dynamic target
+        chp_query.add_dynamic_target(plan.predicate_proxy, plan.proxy_operator, plan.proxy_value)
         # Process predicate context
-        chp_query = self._process_predicate_context(qedge, message_type, chp_query)
+        for curie in plan.context_dynamic_curies:
+            chp_query.add_dynamic_evidence(curie, '==', 'True')
+        for curie in plan.context_meta_curies:
+            chp_query.add_meta_evidence(curie, 'True')
         #TODO: Probably need a more robust solution for when no context is provided in wildcard queries and you need it.
         #if len(evidence) == 0:
         #    raise ValueError('Did not supply context with a query that required context.')
 
-        if message_type == 'standard':
-            # Setup gene and drug evidence
-            for qnode_id, qnode in message.query_graph.nodes.items():
-                if qnode.categories[0] == BIOLINK_GENE_ENTITY or qnode.categories[0] == BIOLINK_DRUG_ENTITY:
-                    chp_query.add_meta_evidence(qnode.ids[0], 'True')
-        elif message_type == 'gene' or message_type == 'drug_two_hop':
-            for qnode_id, qnode in message.query_graph.nodes.items():
-                if qnode.categories[0] == BIOLINK_DRUG_ENTITY:
-                    if qnode.ids is not None:
-                        chp_query.add_meta_evidence(qnode.ids[0], 'True')
-        elif message_type == 'drug' or message_type == 'gene_two_hop':
-            for qnode_id, qnode in message.query_graph.nodes.items():
-                if qnode.categories[0] == BIOLINK_GENE_ENTITY:
-                    if qnode.ids is not None:
-                        chp_query.add_meta_evidence(qnode.ids[0], 'True')
+        # Setup gene and drug evidence
+        for curie in plan.evidence_curies:
+            chp_query.add_meta_evidence(curie, 'True')
 
         target = list(chp_query.dynamic_targets.keys())[0]
         truth_target = (target, '{} {}'.format(chp_query.dynamic_targets[target]["op"], chp_query.dynamic_targets[target]["value"]))
         # Set some other helpful attributes
         chp_query.truth_target = truth_target
+        # Page of the ranked wildcard results to return, within the result window
+        result_offset = plan.result_offset if plan.result_offset is not None else 0
+        result_limit = plan.result_limit if plan.result_limit is not None else self.max_results
+        chp_query.result_offset = min(result_offset, self.max_result_window)
+        chp_query.result_limit = min(result_limit, self.max_result_window - chp_query.result_offset)
+        if chp_query.result_offset != result_offset or chp_query.result_limit != result_limit:
+            query.info('Only the best {} results can be paged through. Returning results {} to {}.'.format(
+                self.max_result_window,
+                chp_query.result_offset,
+                chp_query.result_offset + chp_query.result_limit,
+                ))
+        # Two hop queries are extended with a fixed number of candidates
+        if message_type == 'drug_two_hop' or message_type == 'gene_two_hop':
+            chp_query.num_candidates = self.two_hop_candidates
+        # Survival time thresholds to compute the target probability for
+        chp_query.survival_sweep = plan.survival_sweep
         return chp_query
 
+    def _get_num_ranked_results(self, chp_query):
+        """ Returns how many of the best wildcard results a query needs: all results up to the
+        end of its page.
+        """
+        return getattr(chp_query, 'result_offset', 0) + getattr(chp_query, 'result_limit', self.max_results)
+
+    def _get_result_key(self, chp_query, query_type):
+        """ Result key of a built query: the result version of the joint reasoner (data version,
+        joint engine and interpolation format), the onehop type, the number of expanded
+        candidates for two hop queries, the survival sweep thresholds and the query
+        fingerprint. Wildcard results hold every ranked contribution and two hop queries are
+        extended with a fixed number of candidates, so all pages of a query share one result.
+        """
+        interpolation_type, contribution_type = ONEHOP_REASONING_TYPES[query_type]
+        if self.joint_reasoner is not None:
+            result_version = self.joint_reasoner.get_result_version()
+        else:
+            result_version = get_data_version(self.bkb_data_handler)
+        return (
+                tuple(sorted(result_version.items())),
+                query_type,
+                getattr(chp_query, 'num_candidates', None),
+                getattr(chp_query, 'survival_sweep', None),
+                chp_query.get_fingerprint(interpolation_type, contribution_type),
+                )
+
+    def _get_ranked_wildcard_contributions(self, chp_query, num_results):
+        """ Returns the num_results best (relative contribution, curie) tuples of a ran query.
+        Uses the ranking of the run if it is deep enough and otherwise ranks the (cached)
+        wildcard contributions again, so deeper pages never run the reasoner again.
+        """
+        ranked_wildcard_contributions = getattr(chp_query, 'ranked_wildcard_contributions', None)
+        if ranked_wildcard_contributions is not None:
+            if len(ranked_wildcard_contributions) >= num_results or len(ranked_wildcard_contributions) == len(chp_query.wildcard_contributions):
+                return ranked_wildcard_contributions[:num_results]
+        return rank_wildcard_contributions(chp_query.wildcard_contributions, num_results)
+
+    def _get_survival_curve(self, chp_query):
+        """ Returns a (threshold, probability, ranked contributions) tuple per survival sweep
+        threshold of a standard query. Probabilities are normalized like truth_prob (-1 if no
+        patient matches the evidence) and the ranked contributions are the max_results best
+        (relative contribution, curie) tuples of the gene and drug curies.
+        """
+        target = list(chp_query.dynamic_targets.keys())[0]
+        op = chp_query.dynamic_targets[target]["op"]
+        survival_curve = []
+        for threshold, (res, contrib) in zip(chp_query.survival_sweep, self.joint_reasoner.run_survival_sweep(chp_query, chp_query.survival_sweep)):
+            truth_target = (target, '{} {}'.format(op, threshold))
+            unnormalized_truth_prob = max(0, res.get(truth_target, 0))
+            normalize = sum(max(0, prob) for prob in res.values())
+            if normalize == 0:
+                survival_curve.append((threshold, -1, []))
+                continue
+            contribution_matrix = ContributionMatrix.from_joint_contributions(contrib)
+            relative_contributions = contribution_matrix.get_relative(
+                    truth_target,
+                    get_normalization_weight(unnormalized_truth_prob),
+                    get_normalization_weight(normalize - unnormalized_truth_prob),
+                    )
+            ranked_contributions = [
+                    (relative_contributions[idx].item(), contribution_matrix.curies[idx])
+                    for idx in get_top_k_indices(relative_contributions, self.max_results)
+                    ]
+            survival_curve.append((threshold, unnormalized_truth_prob / normalize, ranked_contributions))
+        return survival_curve
+
     def _run_query(self, chp_query, query_type):
         """ Runs build BKB query to calculate probability of survival.
             A probability is returned to specificy survival time w.r.t a drug.
@@ -245,11 +248,23 @@ class OneHopHandlerMixin:
                     for target, contrib in chp_query.result.items():
                         prob = max(0, contrib)
                         total_unnormalized_prob += prob
-                    chp_query.truth_prob = max([0, chp_query.result[(chp_query.truth_target)]])/total_unnormalized_prob
+                    if total_unnormalized_prob == 0:
+                        # No patient matches the evidence
+                        chp_query.truth_prob = -1
+                    else:
+                        chp_query.truth_prob = max([0, chp_query.result[(chp_query.truth_target)]])/total_unnormalized_prob
                 else:
                     chp_query.truth_prob = 0
             else:
                 chp_query.truth_prob = -1
+            # Probability and contributions for every sweep threshold from one pass over the
+            # matching patients
+            if getattr(chp_query, 'survival_sweep', None) is not None:
+                try:
+                    chp_query.survival_curve = self._get_survival_curve(chp_query)
+                except ValueError as ex:
+                    logger.warning('Could not run survival sweep. {}'.format(str(ex)))
+                    chp_query.survival_curve = None
             chp_query.report = None
             return chp_query
         else:
@@ -270,87 +285,72 @@ class OneHopHandlerMixin:
                 normalize += prob
             unnormalized_false_prob = normalize - unnormalized_truth_prob
 
-            for target in chp_res_dict.keys():
-                chp_res_dict[target] /= normalize
-
-            if chp_query.truth_target in chp_res_dict:
-                chp_query.truth_prob = chp_res_dict[chp_query.truth_target]
+            if normalize == 0:
+                # No patient matches the evidence, so there are no contributions to normalize
+                chp_query.truth_prob = -1
             else:
-               chp_query.truth_target = 0
-
-        # organize the contributions over curie then target
-        wildcard_contributions = defaultdict(lambda: defaultdict(int))
-        for target, curies in chp_query.contributions.items():
-            for curie, contrib in curies.items():
-                if curie[1] == 'True':
-                    wildcard_contributions[curie[0]][target] = contrib
-
-        #for curie in wildcard_contributions.keys():
-        # normalize gene contributions by the target and take relative difference
-        for curie in wildcard_contributions.keys():
-            truth_target_gene_contrib = 0
-            nontruth_target_gene_contrib = 0
-            for target, contrib in wildcard_contributions[curie].items():
-                try:
-                    if target[0] == chp_query.truth_target[0] and target[1] == chp_query.truth_target[1]:
-                        truth_target_gene_contrib += contrib / unnormalized_truth_prob
-                    else:
-                        nontruth_target_gene_contrib += contrib / unnormalized_false_prob
-                except ZeroDivisionError:
-                    continue
-            wildcard_contributions[curie]['relative'] = truth_target_gene_contrib - nontruth_target_gene_contrib
+                for target in chp_res_dict.keys():
+                    chp_res_dict[target] /= normalize
+
+                if chp_query.truth_target in chp_res_dict:
+                    chp_query.truth_prob = chp_res_dict[chp_query.truth_target]
+                else:
+                    chp_query.truth_prob = 0
 
+        # organize the contributions over curie then target and take the relative difference
+        # of the normalized truth and non truth target contributions
+        contribution_matrix = ContributionMatrix.from_joint_contributions(chp_query.contributions)
+        relative_contributions = contribution_matrix.get_relative(
+                chp_query.truth_target,
+                get_normalization_weight(unnormalized_truth_prob),
+                get_normalization_weight(unnormalized_false_prob),
+                )
+        wildcard_contributions = to_relative_contributions(contribution_matrix.curies, relative_contributions)
+        # Rank the best curies up to the end of the requested page (or the two hop candidates)
+        # once, they are reused when constructing the message
         if query_type == 'drug_two_hop' or query_type == 'gene_two_hop':
-            # Build relative contribution results and added associated edges into knowledge graph
-            unsorted_wildcard_contributions = []
-            for wildcard, contrib_dict in wildcard_contributions.items():
-                unsorted_wildcard_contributions.append((contrib_dict['relative'], wildcard))
-            truncated_sorted_wildcard_contributions = [(contrib,wildcard) for contrib, wildcard in sorted(unsorted_wildcard_contributions, key=lambda x: abs(x[0]), reverse=True)][:self.max_results]
-            truncated_contribution_list = [curie[1] for curie in truncated_sorted_wildcard_contributions]
+            num_ranked_results = chp_query.num_candidates
+        else:
+            num_ranked_results = self._get_num_ranked_results(chp_query)
+        ranked_wildcard_contributions = [
+                (relative_contributions[idx].item(), contribution_matrix.curies[idx])
+                for idx in get_top_k_indices(relative_contributions, num_ranked_results)
+                ]
 
-            chp_query.contributions = None
-            wildcard_contributions = defaultdict(lambda: defaultdict(int))
-            for contrib in truncated_contribution_list:
-                chp_query_extended = copy.deepcopy(chp_query)
-                chp_query_extended.add_meta_evidence(contrib, 'True')
-                if query_type == 'drug_two_hop':
-                    chp_query_extended = self.joint_reasoner.run_query(chp_query_extended, contribution_type='drug')
-                else:
-                    chp_query_extended = self.joint_reasoner.run_query(chp_query_extended, contribution_type='gene')
+        if query_type == 'drug_two_hop' or query_type == 'gene_two_hop':
+            truncated_contribution_list = [curie for _, curie in ranked_wildcard_contributions]
 
-                chp_res_dict = chp_query_extended.result
-                if chp_query_extended.truth_target in chp_res_dict:
-                    extended_unnormalized_truth_prob = chp_res_dict[chp_query_extended.truth_target]
+            chp_query.contributions = None
+            relative_totals = defaultdict(float)
+            # Run every two hop extension of the query in one batch
+            extended_results = self.joint_reasoner.run_extended_queries(
+                    chp_query,
+                    truncated_contribution_list,
+                    contribution_type='drug' if query_type == 'drug_two_hop' else 'gene',
+                    )
+            for chp_res_dict, extended_contributions in extended_results:
+                if chp_query.truth_target in chp_res_dict:
+                    extended_unnormalized_truth_prob = chp_res_dict[chp_query.truth_target]
                 else:
                     extended_unnormalized_truth_prob = 0
-                normalize = 0
-                for target, prob in chp_res_dict.items():
-                    normalize += prob
+                normalize = sum(chp_res_dict.values())
                 extended_unnormalized_false_prob = normalize - extended_unnormalized_truth_prob
 
-                # organize the contributions over curie then target
-                extended_wildcard_contributions = defaultdict(lambda: defaultdict(int))
-                for target, curies in chp_query_extended.contributions.items():
-                    for curie, contrib in curies.items():
-                        if curie[1] == 'True':
-                            extended_wildcard_contributions[curie[0]][target] = contrib
-
-                # normalize gene contributions by the target and take relative difference
-                for curie in extended_wildcard_contributions.keys():
-                    truth_target_gene_contrib = 0
-                    nontruth_target_gene_contrib = 0
-                    for target, contrib in extended_wildcard_contributions[curie].items():
-                        try:
-                            if target[0] == chp_query_extended.truth_target[0] and target[1] == chp_query_extended.truth_target[1]:
-                                truth_target_gene_contrib += contrib / extended_unnormalized_truth_prob * unnormalized_truth_prob
-                            else:
-                                nontruth_target_gene_contrib += contrib / extended_unnormalized_false_prob * unnormalized_false_prob
-                        except ZeroDivisionError:
-                            continue
-                    wildcard_contributions[curie]['relative'] += (truth_target_gene_contrib - nontruth_target_gene_contrib)
+                # rescale the extended contributions to the base query and add up their relative differences
+                extended_matrix = ContributionMatrix.from_joint_contributions(extended_contributions)
+                extended_relative = extended_matrix.get_relative(
+                        chp_query.truth_target,
+                        get_normalization_weight(extended_unnormalized_truth_prob, unnormalized_truth_prob),
+                        get_normalization_weight(extended_unnormalized_false_prob, unnormalized_false_prob),
+                        )
+                for curie, contrib in zip(extended_matrix.curies, extended_relative.tolist()):
+                    relative_totals[curie] += contrib
+            wildcard_contributions = {curie: {'relative': contrib} for curie, contrib in relative_totals.items()}
+            ranked_wildcard_contributions = rank_wildcard_contributions(wildcard_contributions, self._get_num_ranked_results(chp_query))
 
         chp_query.report = None
         chp_query.wildcard_contributions = wildcard_contributions
+        chp_query.ranked_wildcard_contributions = ranked_wildcard_contributions
 
         return chp_query
 
@@ -358,111 +358,96 @@ class OneHopHandlerMixin:
 
         # Helpful short cuts
         message = query.message
-        qg = message.query_graph
-        kg = message.knowledge_graph
+        plan = self._get_query_plan(query)
+        builder = TrapiMessageBuilder(message)
 
-        edge_bindings = {}
         node_bindings = {}
 
         # Process nodes
-        for qnode_id, qnode in qg.nodes.items():
-            if qnode.ids is not None:
-                if qnode.categories[0] == BIOLINK_GENE_ENTITY:
-                    knode_key = kg.add_node(
-                            qnode.ids[0],
-                            self.curies[BIOLINK_GENE_ENTITY.get_curie()][qnode.ids[0]][0],
-                            qnode.categories[0].get_curie(),
-                            )
-                elif qnode.categories[0] == BIOLINK_DRUG_ENTITY:
-                    knode_key = kg.add_node(
-                            qnode.ids[0],
-                            self.curies[BIOLINK_DRUG_ENTITY.get_curie()][qnode.ids[0]][0],
-                            qnode.categories[0].get_curie(),
-                            )
-                elif qnode.categories[0] == BIOLINK_DISEASE_ENTITY:
-                    #TODO: Add diseases to curies and fix name hack below.
-                    knode_key = kg.add_node(
-                            qnode.ids[0],
-                            qnode.ids[0], #TODO: Once curies is fixed, make this a name.
-                            qnode.categories[0].get_curie(),
-                            )
-                node_bindings[qnode_id] = [knode_key]
+        for node in plan.nodes:
+            if node.curie is None:
+                continue
+            if node.role == 'gene' or node.role == 'drug':
+                name = self.curies[node.category.get_curie()][node.curie][0]
             else:
-                wildcard_node = qnode
+                #TODO: Add diseases to curies and fix name hack below.
+                name = node.curie
+            knode_key = builder.add_node(
+                    node.curie,
+                    name,
+                    node.category.get_curie(),
+                    )
+            node_bindings[node.qnode_id] = [knode_key]
         if query_type == 'standard':
-            for qedge_key, qedge in qg.edges.items():
-                kedge_key = kg.add_edge(
-                        node_bindings[qedge.subject][0],
-                        node_bindings[qedge.object][0],
-                        predicate=qedge.predicates[0].get_curie(),
-                        )
-                edge_bindings[qedge_key] = [kedge_key]
-                # Add Attribute
-                kg.edges[kedge_key].add_attribute(
-                        attribute_type_id='Probability of Survival',
-                        value=chp_query.truth_prob,
-                        value_type_id=BIOLINK_HAS_CONFIDENCE_LEVEL_ENTITY.get_curie(),
+            kedge_key = builder.add_edge(
+                    node_bindings[plan.subject_id][0],
+                    node_bindings[plan.object_id][0],
+                    plan.predicate.get_curie(),
+                    attribute_template=SURVIVAL_PROBABILITY_ATTRIBUTE,
+                    value=chp_query.truth_prob,
+                    )
+            if getattr(chp_query, 'survival_curve', None) is not None:
+                builder.add_edge_attribute(
+                        kedge_key,
+                        SURVIVAL_CURVE_ATTRIBUTE,
+                        [
+                            {
+                                "threshold": threshold,
+                                "probability": prob,
+                                "contributions": [[curie, contrib] for contrib, curie in ranked_contributions],
+                            }
+                            for threshold, prob, ranked_contributions in chp_query.survival_curve
+                        ],
                         )
-            message.results.add_result(
+            elif plan.survival_sweep is not None:
+                query.info('The survival_sweep constraint needs the bitset joint engine and known evidence curies. Returning the probability of the single survival target.')
+            builder.add_result(
                     node_bindings,
-                    edge_bindings,
+                    {plan.edge_id: [kedge_key]},
                     )
         else:
             # Build relative contribution results and added associated edges into knowledge graph
-            unsorted_wildcard_contributions = []
-            for wildcard, contrib_dict in chp_query.wildcard_contributions.items():
-                unsorted_wildcard_contributions.append((contrib_dict['relative'], wildcard))
-            sorted_wildcard_contributions = [(contrib,wildcard) for contrib, wildcard in sorted(unsorted_wildcard_contributions, key=lambda x: abs(x[0]), reverse=True)]
-
+            result_offset = getattr(chp_query, 'result_offset', 0)
+            num_results = self._get_num_ranked_results(chp_query)
+            ranked_wildcard_contributions = self._get_ranked_wildcard_contributions(chp_query, num_results)
+            if len(chp_query.wildcard_contributions) > num_results:
+                query.info('Returned ranked results {} to {} of {}. Set the result_offset constraint to {} for the next page.'.format(
+                    result_offset,
+                    num_results,
+                    len(chp_query.wildcard_contributions),
+                    num_results,
+                    ))
+
+            wildcard_node = plan.node_map[plan.wildcard_node_id]
+            wildcard_category = wildcard_node.category.get_curie()
+            wildcard_curies = self.curies[wildcard_category]
             # add kg gene nodes and edges
-            edge_count = 0
-            node_count = 1
-            results = []
-            for contrib, wildcard in sorted_wildcard_contributions[:self.max_results]:
-                _node_bindings = {}
-                _edge_bindings = {}
+            for contrib, wildcard in ranked_wildcard_contributions[result_offset:]:
                 # Process node bindings
-                bad_wildcard = False
-                for qnode_id, qnode in qg.nodes.items():
-                    if qnode.categories[0] == BIOLINK_GENE_ENTITY and qnode.ids is None and (query_type == 'gene' or query_type == 'gene_two_hop'):
-                        try:
-                            knode_id = kg.add_node(
-                                    wildcard,
-                                    self.curies[BIOLINK_GENE_ENTITY.get_curie()][wildcard][0],
-                                    qnode.categories[0].get_curie(),
-                                    )
-                            _node_bindings[qnode_id] = [knode_id]
-                        except KeyError:
-                            logger.info("Couldn't find {} in curies[{}]".format(wildcard, BIOLINK_GENE))
-                            bad_wildcard = True
-                    elif qnode.categories[0] == BIOLINK_DRUG_ENTITY and qnode.ids is None and (query_type == 'drug' or query_type == 'drug_two_hop'):
-                        knode_id = kg.add_node(
-                                wildcard,
-                                self.curies[BIOLINK_DRUG_ENTITY.get_curie()][wildcard][0],
-                                qnode.categories[0].get_curie(),
-                                )
-                        _node_bindings[qnode_id] = [knode_id]
-                    else:
-                        _node_bindings[qnode_id] = node_bindings[qnode_id]
-                if bad_wildcard:
+                try:
+                    wildcard_name = wildcard_curies[wildcard][0]
+                except KeyError:
+                    logger.info("Couldn't find {} in curies[{}]".format(wildcard, wildcard_category))
                     continue
+                knode_id = builder.add_node(
+                        wildcard,
+                        wildcard_name,
+                        wildcard_category,
+                        )
+                _node_bindings = dict(node_bindings)
+                _node_bindings[wildcard_node.qnode_id] = [knode_id]
                 # Process edge bindings
-                for qedge_id, qedge in qg.edges.items():
-                    kedge_id = kg.add_edge(
-                            _node_bindings[qedge.subject][0],
-                            _node_bindings[qedge.object][0],
-                            predicate=qedge.predicates[0],
-                            )
-                    kg.edges[kedge_id].add_attribute(
-                            attribute_type_id='Contribution',
-                            value=contrib,
-                            value_type_id=BIOLINK_HAS_EVIDENCE_ENTITY.get_curie(),
-                            description='Inference is derived from cancer data. Contribution reflects sensitivity of nodes to patient survival time. Contribution values closer to 1 are correlated with longer survival time and contribution values closer to -1 are correlated with shorter survival time.'
-                            )
-                    _edge_bindings[qedge_id] = [kedge_id]
+                kedge_id = builder.add_edge(
+                        _node_bindings[plan.subject_id][0],
+                        _node_bindings[plan.object_id][0],
+                        plan.predicate,
+                        attribute_template=CONTRIBUTION_ATTRIBUTE,
+                        value=contrib,
+                        )
                 # Process node and edge binding results
-                message.results.add_result(
+                builder.add_result(
                         _node_bindings,
-                        _edge_bindings,
-                        ) 
+                        {plan.edge_id: [kedge_id]},
+                        )
+        builder.build()
         return query
@@ -20,6 +20,7 @@ from chp_data.bkb_handler import BkbDataHandler
 
 from chp.query import Query as ChpQuery
 from chp.reasoner import ChpDynamicReasoner
+from chp.contributions import get_normalization_weight, to_relative_contributions, rank_wildcard_contributions
 from pybkb.python_base.utils import get_operator, get_opposite_operator
 
 # Setup logging
@@ -223,26 +224,16 @@ class WildCardHandlerMixin:
                         patient_contributions[('EFO:0000714', '{} {}'.format(opp_op, days))][patient] = (1-chp_query.truth_prob)/(num_all-num_survived)
 
         # Now iterate through the patient data to translate patient contributions to drug/gene contributions
-        wildcard_contributions = defaultdict(lambda: defaultdict(int))
-        for target, patient_contrib_dict in patient_contributions.items():
-            for patient, contrib in patient_contrib_dict.items():
-                if query_type == 'gene':
-                    for gene_curie in self.dynamic_reasoner.raw_patient_data[patient]["gene_curies"]:
-                        wildcard_contributions[gene_curie][target] += contrib
-                elif query_type == 'drug':
-                    for drug_curie in self.dynamic_reasoner.raw_patient_data[patient]["drug_curies"]:
-                        wildcard_contributions[drug_curie][target] += contrib
+        patient_curie_matrix = self.dynamic_reasoner.get_patient_curie_matrix('gene_curies' if query_type == 'gene' else 'drug_curies')
+        contribution_matrix = patient_curie_matrix.get_contribution_matrix(patient_contributions)
 
         # normalize gene contributions by the target and take relative difference
-        for curie in wildcard_contributions.keys():
-            truth_target_gene_contrib = 0
-            nontruth_target_gene_contrib = 0
-            for target, contrib in wildcard_contributions[curie].items():
-                if target[0] == chp_query.truth_target[0] and target[1] == chp_query.truth_target[1]:
-                    truth_target_gene_contrib += contrib / chp_query.truth_prob
-                else:
-                    nontruth_target_gene_contrib += contrib / (1 - chp_query.truth_prob)
-            wildcard_contributions[curie]['relative'] = truth_target_gene_contrib - nontruth_target_gene_contrib
+        relative_contributions = contribution_matrix.get_relative(
+                chp_query.truth_target,
+                get_normalization_weight(chp_query.truth_prob),
+                get_normalization_weight(1 - chp_query.truth_prob),
+                )
+        wildcard_contributions = to_relative_contributions(contribution_matrix.curies, relative_contributions)
 
         chp_query.report = None
         chp_query.wildcard_contributions = wildcard_contributions
@@ -343,12 +334,7 @@ class WildCardHandlerMixin:
         #    results = []
 
         # Build relative contribution results and added associated edges into knowledge graph
-        unsorted_wildcard_contributions = []
-        for wildcard, contrib_dict in chp_query.wildcard_contributions.items():
-            unsorted_wildcard_contributions.append((contrib_dict['relative'], wildcard))
-        sorted_wildcard_contributions = [(contrib,wildcard) for contrib, wildcard in sorted(unsorted_wildcard_contributions, key=lambda x: abs(x[0]), reverse=True)]
-
-        for contrib, wildcard in sorted_wildcard_contributions[:self.max_results]:
+        for contrib, wildcard in rank_wildcard_contributions(chp_query.wildcard_contributions, self.max_results):
             #TODO: Fix this!
             if wildcard == 'missing':
                 continue
@@ -0,0 +1,188 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import os
+import json
+import sqlite3
+import logging
+import threading
+import urllib.request
+
+from chp.result_cache import ResultCache
+
+logger = logging.getLogger(__name__)
+
+SRI_NODE_NORMALIZER_URL = 'https://nodenormalization-sri.renci.org/get_normalized_nodes'
+
+def to_normalized_node_dict(node):
+    """ Reduces a node normalizer result to the {"types": [...], "equivalent_identifiers": [...]}
+    form used by TrapiInterface._get_preferred_curie. Unknown curies (None) stay None.
+    """
+    if node is None:
+        return None
+    equivalent_identifiers = []
+    for identifier in node.get("equivalent_identifiers", []):
+        if isinstance(identifier, dict):
+            identifier = identifier["identifier"]
+        equivalent_identifiers.append(identifier)
+    return {
+            "types": list(node.get("types", node.get("type", []))),
+            "equivalent_identifiers": equivalent_identifiers,
+            }
+
+class SriNodeNormalizerBackend:
+    """ Backend that normalizes curies with the SRI Node Normalizer service.
+
+        :param url: The get_normalized_nodes endpoint.
+        :type url: str
+        :param timeout: Request timeout in seconds.
+        :type timeout: float
+        :param batch_size: Maximum number of curies sent per request.
+        :type batch_size: int
+    """
+    def __init__(self, url=SRI_NODE_NORMALIZER_URL, timeout=30, batch_size=1000):
+        self.url = url
+        self.timeout = timeout
+        self.batch_size = batch_size
+
+    def get_normalized_nodes(self, curies):
+        normalized_nodes = {}
+        for i in range(0, len(curies), self.batch_size):
+            request = urllib.request.Request(
+                    self.url,
+                    data=json.dumps({"curies": curies[i:i+self.batch_size]}).encode('utf_8'),
+                    headers={"Content-Type": "application/json"},
+                    )
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                for curie, node in json.loads(response.read()).items():
+                    normalized_nodes[curie] = to_normalized_node_dict(node)
+        return normalized_nodes
+
+class FileNodeNormalizerBackend:
+    """ Offline backend that reads node normalizer results from a JSON file of
+    curie -> node (or null for curies the normalizer does not know).
+
+        :param filename: The JSON filename.
+        :type filename: str
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'r') as f_:
+            self.nodes = {curie: to_normalized_node_dict(node) for curie, node in json.load(f_).items()}
+
+    def get_normalized_nodes(self, curies):
+        return {curie: self.nodes.get(curie) for curie in curies}
+
+class NodeNormalizerStore:
+    """ File backed store of node normalizer results shared by worker processes and restarts.
+    Curies the backend did not know are stored too, so they are not requested again.
+
+        :param path: Database filename.
+        :type path: str
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+                'CREATE TABLE IF NOT EXISTS normalized_nodes ('
+                'curie TEXT PRIMARY KEY, '
+                'node TEXT NOT NULL)'
+                )
+
+    def _connect(self):
+        # SQLite connections must not cross threads or forked processes.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_many(self, curies):
+        conn = self._connect()
+        normalized_nodes = {}
+        for curie in curies:
+            row = conn.execute('SELECT node FROM normalized_nodes WHERE curie = ?', (curie,)).fetchone()
+            if row is not None:
+                normalized_nodes[curie] = json.loads(row[0])
+        return normalized_nodes
+
+    def set_many(self, normalized_nodes):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                    'INSERT OR REPLACE INTO normalized_nodes (curie, node) VALUES (?, ?)',
+                    [(curie, json.dumps(node)) for curie, node in normalized_nodes.items()],
+                    )
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM normalized_nodes').fetchone()[0]
+
+class NodeNormalizer:
+    """ Normalizes curies through an in-process cache, an optional persistent store and,
+    for the remaining curies only, a pluggable backend.
+
+        :param backend: Object with a get_normalized_nodes(curies) method returning a dict of
+            curie -> {"types": [...], "equivalent_identifiers": [...]} or None.
+        :type backend: chp.node_normalizer.SriNodeNormalizerBackend
+        :param store: Optional persistent store of normalizer results.
+        :type store: chp.node_normalizer.NodeNormalizerStore
+        :param cache_size: Maximum number of normalizer results kept in process. The least
+            recently used result is evicted first.
+        :type cache_size: int
+    """
+    def __init__(self, backend=None, store=None, cache_size=4096):
+        if backend is None:
+            backend = SriNodeNormalizerBackend()
+        self.backend = backend
+        self.store = store
+        self.backend_requests = 0
+        # Results are cached as 1-tuples, as unknown curies have a None result
+        self._normalized_nodes = ResultCache(maxsize=cache_size, ttl=None)
+
+    def _get_cached(self, curies):
+        normalized_nodes = {}
+        for curie in curies:
+            entry = self._normalized_nodes.get(curie)
+            if entry is not None:
+                normalized_nodes[curie] = entry[0]
+        return normalized_nodes
+
+    def _set_cached(self, normalized_nodes):
+        for curie, node in normalized_nodes.items():
+            self._normalized_nodes.set(curie, (node,))
+
+    def get_normalized_nodes(self, curies):
+        """ Returns a dict of curie -> normalized node dict (None if the curie is unknown).
+        """
+        curies = list(dict.fromkeys(curies))
+        normalized_nodes = self._get_cached(curies)
+        missing_curies = [curie for curie in curies if curie not in normalized_nodes]
+        if len(missing_curies) > 0 and self.store is not None:
+            stored_nodes = self.store.get_many(missing_curies)
+            normalized_nodes.update(stored_nodes)
+            missing_curies = [curie for curie in missing_curies if curie not in stored_nodes]
+            self._set_cached(stored_nodes)
+        if len(missing_curies) > 0:
+            logger.info('Normalizing {} of {} curies with {}.'.format(len(missing_curies), len(curies), type(self.backend).__name__))
+            backend_nodes = self.backend.get_normalized_nodes(missing_curies)
+            backend_nodes = {curie: backend_nodes.get(curie) for curie in missing_curies}
+            self.backend_requests += 1
+            if self.store is not None:
+                self.store.set_many(backend_nodes)
+            normalized_nodes.update(backend_nodes)
+            self._set_cached(backend_nodes)
+        return normalized_nodes
@@ -0,0 +1,614 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import os
+import json
+import mmap
+import struct
+import logging
+import tempfile
+import threading
+from collections import OrderedDict, Counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Prefixes of the features contributions are computed for, as passed to compute_joint.
+CURIES_KEYS = {
+        'ENSEMBL': 'gene_curies',
+        'CHEMBL.COMPOUND': 'drug_curies',
+        }
+
+OPPOSITE_OPERATORS = {
+        '>=': '<',
+        '>': '<=',
+        '<': '>=',
+        '<=': '>',
+        '==': '!=',
+        }
+
+# Default number of evidence subset bitsets kept by an EvidenceMaskCache.
+EVIDENCE_CACHE_SIZE = 4096
+
+PATIENT_INDEX_MAGIC = b'CHPPATIX'
+PATIENT_INDEX_FORMAT_VERSION = 2
+PATIENT_INDEX_EXTENSION = '.chppatix'
+_PREAMBLE = struct.Struct('<8sII')
+_ALIGNMENT = 8
+
+def pack_mask(mask):
+    """ Packs a boolean patient mask into uint64 words, patient i is bit i % 64 of word i // 64.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    words = np.zeros((len(mask) + 63) // 64, dtype=np.uint64)
+    patient_idxs = np.flatnonzero(mask)
+    np.bitwise_or.at(words, patient_idxs >> 6, np.left_shift(np.uint64(1), (patient_idxs & 63).astype(np.uint64)))
+    return words
+
+def popcount(words, axis=None):
+    """ Returns the number of set bits of uint64 words, summed over axis.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=axis, dtype=np.int64)
+    bits = np.unpackbits(words.view(np.uint8).reshape(words.shape + (8,)), axis=-1)
+    return bits.sum(axis=-1, dtype=np.int64).sum(axis=axis)
+
+class EvidenceMaskCache:
+    """ Bounded LRU cache of the patient bitsets of evidence sets.
+
+        Only requested evidence sets and one base subset per set are cached. The bitset of an
+        evidence set is built from a cached subset with one more feature ANDed in. If no subset
+        that is one item smaller is cached, the item seen least often in past evidence is left
+        out and the base bitset of the remaining items is built and cached as well. Items that
+        recur across queries, like a shared predicate context, therefore form a cached base and
+        overlapping queries cost a single AND.
+
+        :param patient_index: The index the feature bitsets are taken from.
+        :type patient_index: chp.patient_index.PatientBitsetIndex
+        :param maxsize: Maximum number of cached bitsets.
+        :type maxsize: int
+    """
+    def __init__(self, patient_index, maxsize=EVIDENCE_CACHE_SIZE):
+        self.patient_index = patient_index
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+        self._item_counts = Counter()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __contains__(self, evidence):
+        return frozenset(dict(evidence).items()) in self._masks
+
+    def get(self, evidence):
+        """ Returns the read only bitset of the patients matching all evidence of the form
+        {curie: state}.
+        """
+        items = frozenset(evidence.items())
+        with self._lock:
+            self._item_counts.update(items)
+            words = self._lookup(items)
+            if words is not None:
+                self.hits += 1
+                return words
+            self.misses += 1
+        if len(items) == 0:
+            words = self.patient_index.all_words.copy()
+        else:
+            words = None
+            with self._lock:
+                for item in items:
+                    base_words = self._lookup(items - {item})
+                    if base_words is not None:
+                        break
+                else:
+                    item = min(items, key=lambda item: (self._item_counts[item], item))
+                    base_words = self._lookup(items - {item})
+            if base_words is None:
+                base_words = self.patient_index.all_words.copy()
+                for base_item in items - {item}:
+                    base_words &= self.patient_index.get_item_words(*base_item)
+                self._insert(items - {item}, base_words)
+            words = base_words & self.patient_index.get_item_words(*item)
+        self._insert(items, words)
+        return words
+
+    def _lookup(self, items):
+        # Called with the lock held
+        words = self._masks.get(items)
+        if words is not None:
+            self._masks.move_to_end(items)
+        return words
+
+    def _insert(self, items, words):
+        words.flags.writeable = False
+        with self._lock:
+            self._masks[items] = words
+            while len(self._masks) > self.maxsize:
+                self._masks.popitem(last=False)
+
+class PatientBitsetIndex:
+    """ Patient index that stores every gene and drug curie as a packed bitset over the
+    patients and the survival times as a sorted column, built once from the raw patient data.
+
+        Joint counts of evidence and targets are bitwise ANDs of the bitsets followed by a
+        popcount, and the contributions of all genes (or drugs) of a target are a single AND
+        and popcount over the stacked feature bitsets. The index also keeps the numeric
+        patient fields (e.g. survival time and age) as columns in patient order and the curies
+        of every patient in listed order as CSR indptr/indices arrays into the curie tables,
+        see chp.contributions.PatientCurieMatrix.from_patient_index.
+
+        :param raw_patient_data: The raw patient data of a bkb handler.
+        :type raw_patient_data: dict
+        :param survival_feature: Name of the survival time dynamic target.
+        :type survival_feature: str
+        :param evidence_cache_size: Number of evidence subset bitsets to cache, 0 disables
+            the cache.
+        :type evidence_cache_size: int
+    """
+    def __init__(self, raw_patient_data, survival_feature='EFO:0000714', evidence_cache_size=EVIDENCE_CACHE_SIZE):
+        self._patients = list(raw_patient_data.keys())
+        self.num_patients = len(self._patients)
+        self.survival_feature = survival_feature
+        self.columns = {
+                name: np.array([raw_patient_data[patient][name] for patient in self._patients], dtype=np.float64)
+                for name in _get_numeric_fields(raw_patient_data)
+                }
+        survival_times = np.array([raw_patient_data[patient]['survival_time'] for patient in self._patients], dtype=float)
+        self.survival_order = np.argsort(survival_times, kind='stable')
+        self.sorted_survival_times = survival_times[self.survival_order]
+        self.all_words = pack_mask(np.ones(self.num_patients, dtype=bool))
+        # Stacked feature bitsets per feature prefix
+        self.feature_curies = {}
+        self.feature_words = {}
+        self.curie_indptr = {}
+        self.curie_indices = {}
+        self.curie_rows = {}
+        for prefix, curies_key in CURIES_KEYS.items():
+            curie_idxs = {}
+            rows = []
+            patient_idxs = []
+            indptr = [0]
+            for patient_idx, patient in enumerate(self._patients):
+                for curie in raw_patient_data[patient].get(curies_key, []):
+                    rows.append(curie_idxs.setdefault(curie, len(curie_idxs)))
+                    patient_idxs.append(patient_idx)
+                indptr.append(len(rows))
+            if len(rows) >= 2**31:
+                raise ValueError('Too many {} to index.'.format(curies_key))
+            # 32 bit indices, so scipy.sparse uses the arrays as they are
+            self.curie_indptr[prefix] = np.asarray(indptr, dtype=np.int32)
+            self.curie_indices[prefix] = np.asarray(rows, dtype=np.int32)
+            rows = np.asarray(rows, dtype=np.intp)
+            patient_idxs = np.asarray(patient_idxs, dtype=np.intp)
+            words = np.zeros((len(curie_idxs), len(self.all_words)), dtype=np.uint64)
+            np.bitwise_or.at(words, (rows, patient_idxs >> 6), np.left_shift(np.uint64(1), (patient_idxs & 63).astype(np.uint64)))
+            self.feature_curies[prefix] = list(curie_idxs)
+            self.feature_words[prefix] = words
+        self._setup_lookups(evidence_cache_size)
+        logger.info('Built patient bitset index of {} patients and {} curies.'.format(self.num_patients, len(self.curie_rows)))
+
+    def _setup_lookups(self, evidence_cache_size):
+        self.curie_rows = {}
+        for prefix, curies in self.feature_curies.items():
+            for row, curie in enumerate(curies):
+                self.curie_rows[curie] = (prefix, row)
+        self.evidence_cache = EvidenceMaskCache(self, evidence_cache_size) if evidence_cache_size > 0 else None
+
+    @property
+    def patients(self):
+        if self._patients is None:
+            self._patients = self._load_patients()
+        return self._patients
+
+    @classmethod
+    def attach(cls, patient_index_path, evidence_cache_size=EVIDENCE_CACHE_SIZE):
+        """ Attaches to a patient index file written by write_patient_index. The bitsets,
+        columns and curie arrays are read only views of the shared mapping, so every process
+        attached to the same file shares its pages instead of holding a copy.
+
+        :param patient_index_path: Path of the patient index file.
+        :type patient_index_path: str
+        :param evidence_cache_size: Number of evidence subset bitsets to cache in this process.
+        :type evidence_cache_size: int
+
+        :rtype: chp.patient_index.PatientBitsetIndex
+        """
+        with open(patient_index_path, 'rb') as f_:
+            buffer = mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, header_length = _PREAMBLE.unpack_from(buffer, 0)
+        if magic != PATIENT_INDEX_MAGIC:
+            raise ValueError('{} is not a CHP patient index.'.format(patient_index_path))
+        if format_version != PATIENT_INDEX_FORMAT_VERSION:
+            raise ValueError('Patient index format version {} but expected {}.'.format(format_version, PATIENT_INDEX_FORMAT_VERSION))
+        header = json.loads(bytes(buffer[_PREAMBLE.size:_PREAMBLE.size + header_length]))
+
+        def get_section(name, dtype=np.uint8, shape=None):
+            offset, nbytes = header["sections"][name]
+            array = np.frombuffer(buffer, dtype=dtype, count=nbytes // np.dtype(dtype).itemsize, offset=offset)
+            return array if shape is None else array.reshape(shape)
+
+        def get_json_section(name):
+            return json.loads(get_section(name).tobytes())
+
+        patient_index = cls.__new__(cls)
+        patient_index.patient_index_path = patient_index_path
+        patient_index.header = header
+        patient_index.num_patients = header["num_patients"]
+        patient_index.survival_feature = header["survival_feature"]
+        patient_index.all_words = get_section('all_words', np.uint64)
+        patient_index.survival_order = get_section('survival_order', np.int64)
+        patient_index.sorted_survival_times = get_section('sorted_survival_times', np.float64)
+        patient_index.columns = {name: get_section('column_{}'.format(name), np.float64) for name in header["columns"]}
+        patient_index.feature_curies = {}
+        patient_index.feature_words = {}
+        patient_index.curie_indptr = {}
+        patient_index.curie_indices = {}
+        for prefix in header["prefixes"]:
+            patient_index.feature_curies[prefix] = get_json_section('{}_curies'.format(prefix))
+            patient_index.feature_words[prefix] = get_section(
+                    '{}_words'.format(prefix),
+                    np.uint64,
+                    (len(patient_index.feature_curies[prefix]), len(patient_index.all_words)),
+                    )
+            patient_index.curie_indptr[prefix] = get_section('{}_indptr'.format(prefix), np.int32)
+            patient_index.curie_indices[prefix] = get_section('{}_indices'.format(prefix), np.int32)
+        # Patient ids are only parsed if they are asked for
+        patient_index._patients = None
+        patient_index._load_patients = lambda: get_json_section('patients')
+        patient_index._setup_lookups(evidence_cache_size)
+        logger.info('Attached to patient bitset index {}.'.format(patient_index_path))
+        return patient_index
+
+    def __contains__(self, curie):
+        return curie in self.curie_rows
+
+    def get_curie_words(self, curie):
+        prefix, row = self.curie_rows[curie]
+        return self.feature_words[prefix][row]
+
+    def get_item_words(self, curie, state):
+        """ Returns the bitset of the patients where curie has state 'True' or 'False'.
+        """
+        if state == 'True':
+            return self.get_curie_words(curie)
+        return ~self.get_curie_words(curie) & self.all_words
+
+    def get_evidence_words(self, evidence):
+        """ Returns the bitset of the patients matching all evidence of the form {curie: state},
+        with states 'True' or 'False'. The bitset must not be modified.
+        """
+        if self.evidence_cache is not None:
+            return self.evidence_cache.get(evidence)
+        words = self.all_words.copy()
+        for curie, state in evidence.items():
+            words &= self.get_item_words(curie, state)
+        return words
+
+    def get_survival_words(self, op, value):
+        """ Returns the bitset of the patients whose survival time satisfies op value.
+        """
+        value = float(value)
+        left = np.searchsorted(self.sorted_survival_times, value, side='left')
+        right = np.searchsorted(self.sorted_survival_times, value, side='right')
+        positions = {
+                '>=': slice(left, None),
+                '>': slice(right, None),
+                '<': slice(None, left),
+                '<=': slice(None, right),
+                '==': slice(left, right),
+                }[op]
+        mask = np.zeros(self.num_patients, dtype=bool)
+        mask[self.survival_order[positions]] = True
+        return pack_mask(mask)
+
+    def supports_query(self, evidence, targets=None, continuous_evidence=None, continuous_targets=None):
+        """ Whether the index can represent a query: 'True'/'False' evidence on indexed curies,
+        only '== True' continuous evidence and a single survival time continuous target.
+        """
+        if targets:
+            return False
+        if continuous_targets is None or list(continuous_targets.keys()) != [self.survival_feature]:
+            return False
+        if continuous_targets[self.survival_feature]["op"] not in OPPOSITE_OPERATORS:
+            return False
+        for prop in (continuous_evidence or {}).values():
+            if prop["op"] != '==' or str(prop["value"]) != 'True':
+                return False
+        if any(state not in ['True', 'False'] for state in evidence.values()):
+            return False
+        curies = list(evidence.keys()) + list((continuous_evidence or {}).keys())
+        return all(curie in self for curie in curies)
+
+    def supports(self, evidence, targets=None, continuous_evidence=None, continuous_targets=None, interpolation_type=None):
+        """ Whether compute_joint answers a query like the pybkb joint reasoner: the index can
+        represent it (see supports_query), no interpolation is requested and the evidence matches
+        at least one patient. The pybkb joint reasoner interpolates the other queries or returns
+        an empty result for them.
+        """
+        if interpolation_type is not None:
+            return False
+        if not self.supports_query(evidence, targets, continuous_evidence, continuous_targets):
+            return False
+        return popcount(self._get_base_words(evidence, continuous_evidence)) > 0
+
+    def supports_extensions(self, evidence, extension_curies, extension_state='True', targets=None, continuous_evidence=None, continuous_targets=None, interpolation_type=None):
+        """ Whether compute_extended_joints can answer a query extended by each of the
+        extension curies: the base query must be supported, every extension curie must be
+        indexed and not already part of the evidence, and every extended evidence must match at
+        least one patient.
+        """
+        if extension_state not in ['True', 'False']:
+            return False
+        if not self.supports(evidence, targets, continuous_evidence, continuous_targets, interpolation_type):
+            return False
+        if not all(curie in self and curie not in evidence and curie not in (continuous_evidence or {}) for curie in extension_curies):
+            return False
+        if len(extension_curies) == 0:
+            return True
+        base_words = self._get_base_words(evidence, continuous_evidence)
+        extension_words = np.stack([self.get_item_words(curie, extension_state) for curie in extension_curies])
+        return bool(np.all(popcount(extension_words & base_words, axis=1) > 0))
+
+    def compute_joint(self, evidence, targets=None, continuous_evidence=None, continuous_targets=None, contribution_features=None):
+        """ Computes the joint probability of the evidence with the survival target and with its
+        complement, in the (res, contrib) form of the pybkb joint reasoner. Check that the query
+        is supported first.
+
+        :param evidence: Discrete evidence of the form {curie: state}.
+        :type evidence: dict
+        :param continuous_evidence: Dynamic evidence of the form {curie: {"op": '==', "value": 'True'}}.
+        :type continuous_evidence: dict
+        :param continuous_targets: The survival time target of the form {feature: {"op": op, "value": value}}.
+        :type continuous_targets: dict
+        :param contribution_features: Prefix of the curies to compute contributions for, i.e.
+            'ENSEMBL' or 'CHEMBL.COMPOUND', or None.
+        :type contribution_features: str
+
+        :return: res of the form {(feature, state): probability} and contrib of the form
+            {(feature, state): {(curie, 'True'): probability}}, where probabilities are joint
+            probabilities over all patients.
+        :rtype: tuple
+        """
+        evidence_words = self._get_base_words(evidence, continuous_evidence)
+        return self._get_joints(evidence_words[np.newaxis], continuous_targets, contribution_features)[0]
+
+    def compute_extended_joints(self, evidence, extension_curies, extension_state='True', targets=None, continuous_evidence=None, continuous_targets=None, contribution_features=None):
+        """ Computes compute_joint for the evidence extended by each extension curie at once.
+        The base evidence bitset is built once and ANDed with the stacked bitsets of all
+        extension curies. Check that the extensions are supported first.
+
+        :param extension_curies: The curies that extend the evidence one at a time.
+        :type extension_curies: list
+        :param extension_state: The state of each extension curie, 'True' or 'False'.
+        :type extension_state: str
+
+        :return: A (res, contrib) tuple per extension curie, in the same order.
+        :rtype: list
+        """
+        if len(extension_curies) == 0:
+            return []
+        base_words = self._get_base_words(evidence, continuous_evidence)
+        extension_words = np.stack([self.get_item_words(curie, extension_state) for curie in extension_curies])
+        return self._get_joints(extension_words & base_words, continuous_targets, contribution_features)
+
+    def compute_survival_sweep(self, evidence, op, thresholds, targets=None, continuous_evidence=None, contribution_features=None):
+        """ Computes compute_joint for the survival target op threshold of every threshold at
+        once. The evidence bitset is built once, the matching patients are counted in survival
+        time order with one cumulative sum and each threshold is a lookup into it. The
+        contributions of a threshold are a single AND and popcount over the stacked feature
+        bitsets. Check that the query is supported first.
+
+        :param op: Operator of the survival target, one of '>=', '>', '<', '<=' or '=='.
+        :type op: str
+        :param thresholds: The survival time thresholds.
+        :type thresholds: list
+        :param contribution_features: Prefix or list of prefixes of the curies to compute
+            contributions for, or None.
+        :type contribution_features: str
+
+        :return: A (res, contrib) tuple per threshold, in the same order.
+        :rtype: list
+        """
+        if op not in OPPOSITE_OPERATORS:
+            raise ValueError('Unsupported survival operator: {}'.format(op))
+        if contribution_features is None:
+            contribution_features = []
+        elif isinstance(contribution_features, str):
+            contribution_features = [contribution_features]
+        evidence_words = self._get_base_words(evidence, continuous_evidence)
+        mask = np.unpackbits(evidence_words.astype('<u8').view(np.uint8), bitorder='little')[:self.num_patients]
+        # Number of matching patients before each position of the survival order
+        cumulative_counts = np.concatenate([[0], np.cumsum(mask[self.survival_order], dtype=np.int64)])
+        num_matching = cumulative_counts[-1].item()
+        evidence_feature_counts = {
+                prefix: popcount(self.feature_words[prefix] & evidence_words, axis=1)
+                for prefix in contribution_features
+                }
+        joints = []
+        for threshold in thresholds:
+            left = np.searchsorted(self.sorted_survival_times, threshold, side='left')
+            right = np.searchsorted(self.sorted_survival_times, threshold, side='right')
+            start, end = {
+                    '>=': (left, self.num_patients),
+                    '>': (right, self.num_patients),
+                    '<': (0, left),
+                    '<=': (0, right),
+                    '==': (left, right),
+                    }[op]
+            true_count = (cumulative_counts[end] - cumulative_counts[start]).item()
+            true_state = '{} {}'.format(op, threshold)
+            false_state = '{} {}'.format(OPPOSITE_OPERATORS[op], threshold)
+            res = {
+                    (self.survival_feature, true_state): true_count / self.num_patients,
+                    (self.survival_feature, false_state): (num_matching - true_count) / self.num_patients,
+                    }
+            contrib = {}
+            if len(contribution_features) > 0:
+                true_words = evidence_words & self.get_survival_words(op, threshold)
+                contrib[(self.survival_feature, true_state)] = {}
+                contrib[(self.survival_feature, false_state)] = {}
+                for prefix in contribution_features:
+                    true_counts = popcount(self.feature_words[prefix] & true_words, axis=1).tolist()
+                    false_counts = (evidence_feature_counts[prefix] - true_counts).tolist()
+                    for state, counts in [(true_state, true_counts), (false_state, false_counts)]:
+                        contrib[(self.survival_feature, state)].update({
+                                (curie, 'True'): count / self.num_patients
+                                for curie, count in zip(self.feature_curies[prefix], counts) if count > 0
+                                })
+            joints.append((res, contrib))
+        return joints
+
+    def _get_base_words(self, evidence, continuous_evidence):
+        evidence = dict(evidence)
+        for curie in (continuous_evidence or {}):
+            evidence[curie] = 'True'
+        return self.get_evidence_words(evidence)
+
+    def _get_joints(self, evidence_words, continuous_targets, contribution_features):
+        """ Returns the (res, contrib) tuple of every row of stacked evidence bitsets.
+        """
+        target = continuous_targets[self.survival_feature]
+        true_words = self.get_survival_words(target["op"], target["value"])
+        states = [
+                ('{} {}'.format(target["op"], target["value"]), evidence_words & true_words),
+                ('{} {}'.format(OPPOSITE_OPERATORS[target["op"]], target["value"]), evidence_words & ~true_words & self.all_words),
+                ]
+        joints = [({}, {}) for _ in range(len(evidence_words))]
+        for state, words in states:
+            counts = popcount(words, axis=1).tolist()
+            for row, (res, contrib) in enumerate(joints):
+                res[(self.survival_feature, state)] = counts[row] / self.num_patients
+                if contribution_features is None:
+                    continue
+                feature_counts = popcount(self.feature_words[contribution_features] & words[row], axis=1)
+                contrib[(self.survival_feature, state)] = {
+                        (curie, 'True'): count / self.num_patients
+                        for curie, count in zip(self.feature_curies[contribution_features], feature_counts.tolist()) if count > 0
+                        }
+        return joints
+
+def write_patient_index(patient_index_path, patient_index, data_version=None):
+    """ Writes the arrays of a patient index to a single memory mappable file that other
+    processes attach to with PatientBitsetIndex.attach.
+
+        The file is a fixed preamble (magic, format version, header length), a JSON header with
+        the (offset, length) of every section and the 8 byte aligned sections: the feature
+        bitsets and CSR curie arrays per prefix, the survival and numeric columns and the JSON
+        encoded curie and patient id tables. It is written to a temporary file first and then
+        moved into place so attaching processes never see a partial index.
+
+        :param patient_index_path: Where to write the index.
+        :type patient_index_path: str
+        :param patient_index: The built patient index.
+        :type patient_index: chp.patient_index.PatientBitsetIndex
+        :param data_version: Identifies the data the index was built from.
+        :type data_version: dict
+    """
+    def encode_json(value):
+        return np.frombuffer(json.dumps(value).encode('utf_8'), dtype=np.uint8)
+
+    sections = {
+            "all_words": np.ascontiguousarray(patient_index.all_words, dtype=np.uint64),
+            "survival_order": np.ascontiguousarray(patient_index.survival_order, dtype=np.int64),
+            "sorted_survival_times": np.ascontiguousarray(patient_index.sorted_survival_times, dtype=np.float64),
+            "patients": encode_json(patient_index.patients),
+            }
+    for name, column in patient_index.columns.items():
+        sections['column_{}'.format(name)] = np.ascontiguousarray(column, dtype=np.float64)
+    for prefix in patient_index.feature_words:
+        sections['{}_words'.format(prefix)] = np.ascontiguousarray(patient_index.feature_words[prefix], dtype=np.uint64)
+        sections['{}_curies'.format(prefix)] = encode_json(patient_index.feature_curies[prefix])
+        sections['{}_indptr'.format(prefix)] = np.ascontiguousarray(patient_index.curie_indptr[prefix], dtype=np.int32)
+        sections['{}_indices'.format(prefix)] = np.ascontiguousarray(patient_index.curie_indices[prefix], dtype=np.int32)
+    header = {
+            "format_version": PATIENT_INDEX_FORMAT_VERSION,
+            "data_version": data_version,
+            "num_patients": patient_index.num_patients,
+            "survival_feature": patient_index.survival_feature,
+            "prefixes": list(patient_index.feature_words),
+            "columns": list(patient_index.columns),
+            "sections": {name: [0, array.nbytes] for name, array in sections.items()},
+            }
+    # Reserve enough room for the header regardless of the offsets written into it.
+    header_size = len(json.dumps(header).encode('utf_8')) + 32 * len(sections)
+    offset = _align(_PREAMBLE.size + header_size)
+    for name, array in sections.items():
+        header["sections"][name][0] = offset
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf_8')
+
+    patient_index_dir = os.path.dirname(os.path.abspath(patient_index_path))
+    fd, tmp_path = tempfile.mkstemp(dir=patient_index_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f_:
+            f_.write(_PREAMBLE.pack(PATIENT_INDEX_MAGIC, PATIENT_INDEX_FORMAT_VERSION, len(header_bytes)))
+            f_.write(header_bytes)
+            for name, array in sections.items():
+                f_.write(b'\x00' * (header["sections"][name][0] - f_.tell()))
+                f_.write(array.tobytes())
+        os.replace(tmp_path, patient_index_path)
+    except:
+        os.remove(tmp_path)
+        raise
+    logger.info('Wrote patient index to {}.'.format(patient_index_path))
+    return patient_index_path
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+def _get_numeric_fields(raw_patient_data):
+    """ Returns the fields of the raw patient data that hold a number for every patient.
+    """
+    numeric_fields = None
+    for patient_data in raw_patient_data.values():
+        fields = {
+                name for name, value in patient_data.items()
+                if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_))
+                }
+        numeric_fields = fields if numeric_fields is None else numeric_fields & fields
+    return sorted(numeric_fields or [])
+
+def get_patient_index_path(patient_index_dir, data_version):
+    filename = '{}_{}_{}{}'.format(
+            data_version["disease"],
+            data_version["bkb_major_version"],
+            data_version["bkb_minor_version"],
+            PATIENT_INDEX_EXTENSION,
+            )
+    return os.path.join(patient_index_dir, filename)
+
+def load_patient_index(patient_index_dir, data_version, evidence_cache_size=EVIDENCE_CACHE_SIZE):
+    """ Attaches to the shared patient index of a data version in patient_index_dir. The file
+    is written once by the serving parent process (see
+    chp.reasoner.BaseReasoner.get_patient_index), this only maps it.
+
+    :param patient_index_dir: Directory of the shared patient index files.
+    :type patient_index_dir: str
+    :param data_version: The data version, see chp.result_cache.get_data_version.
+    :type data_version: dict
+
+    :return: The attached index or None if there is no index of this data version.
+    :rtype: chp.patient_index.PatientBitsetIndex
+    """
+    patient_index_path = get_patient_index_path(patient_index_dir, data_version)
+    if not os.path.exists(patient_index_path):
+        return None
+    try:
+        patient_index = PatientBitsetIndex.attach(patient_index_path, evidence_cache_size=evidence_cache_size)
+    except ValueError as ex:
+        logger.warning('Ignoring patient index. {}'.format(str(ex)))
+        return None
+    if patient_index.header["data_version"] != data_version:
+        logger.warning('Ignoring patient index built for {}.'.format(patient_index.header["data_version"]))
+        return None
+    return patient_index
@@ -244,6 +244,37 @@ class Query:
         """
         self.meta_targets.append(random_variable)
 
+    def get_fingerprint(self, interpolation_type=None, contribution_type=None):
+        """ Returns a canonical, hashable fingerprint of the query. Queries with the same fingerprint
+        have the same reasoning result, regardless of their name or the order evidence was added in.
+
+        Note:
+            Compute the fingerprint before running the query as composing evidence adds the meta
+            evidence to the normal evidence.
+
+        :param interpolation_type: The interpolation type the query is run with.
+        :type interpolation_type: str
+        :param contribution_type: The contribution type the query is run with.
+        :type contribution_type: str
+
+        :return: A tuple of sorted evidence and target items.
+        :rtype: tuple
+        """
+        def freeze_dynamic(dynamic):
+            return tuple(sorted((rv, prop["op"], str(prop["value"])) for rv, prop in dynamic.items()))
+
+        return (
+                tuple(sorted(self.evidence.items())),
+                tuple(sorted(self.targets)),
+                tuple(sorted(self.meta_evidence.items())),
+                tuple(sorted(self.meta_targets)),
+                freeze_dynamic(self.dynamic_evidence),
+                freeze_dynamic(self.dynamic_targets),
+                self.reasoning_type,
+                interpolation_type,
+                contribution_type,
+                )
+
 """ Code to depreciate in next version.
 
     def save(self, directory, only_json=False):
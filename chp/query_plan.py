@@ -0,0 +1,278 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import logging
+from collections import namedtuple
+
+from trapi_model.biolink.constants import *
+
+from chp.exceptions import *
+
+logger = logging.getLogger(__name__)
+
+# Default functions
+def get_default_predicate_proxy():
+    return 'EFO:0000714'
+
+def get_default_operator(predicate_proxy):
+    if predicate_proxy == 'EFO:0000714':
+        return '>='
+    else:
+        raise ValueError('Unknown predicate proxy: {}'.format(predicate_proxy))
+
+def get_default_value(predicate_proxy):
+    if predicate_proxy == 'EFO:0000714':
+        return 978
+    else:
+        raise ValueError('Unknown predicate proxy: {}'.format(predicate_proxy))
+
+NodePlan = namedtuple('NodePlan', ['qnode_id', 'category', 'curie', 'role'])
+
+class QueryGraphPlan:
+    """ Immutable plan of a one-hop TRAPI query graph compiled in a single pass by compile_query_graph.
+
+        Later stages (message typing, CHP query extraction and TRAPI message construction) read the
+        plan instead of walking the query graph and resolving biolink entities again.
+
+        Attributes:
+            :nodes: Tuple of NodePlans with the query node id, category, curie (None for wildcards)
+                and role ('gene', 'drug', 'disease' or 'other').
+            :onehop_type: One of 'standard', 'gene', 'drug', 'gene_two_hop' or 'drug_two_hop'.
+            :wildcard_node_id: Query node id of the wildcard node or None.
+            :edge_id: Query edge id of the one-hop edge.
+            :subject_id, object_id: Query node ids of the edge subject and object.
+            :predicate: The edge predicate.
+            :predicate_proxy, proxy_operator, proxy_value: The resolved survival proxy target.
+            :evidence_curies: Node curies that become meta evidence.
+            :context_meta_curies: Predicate context curies that become meta evidence.
+            :context_dynamic_curies: Predicate context curies that become dynamic evidence.
+            :result_offset: Number of ranked wildcard results to skip (the 'result_offset'
+                edge constraint) or None.
+            :result_limit: Number of ranked wildcard results to return (the 'max_results' edge
+                constraint) or None to use the handler default.
+            :survival_sweep: Tuple of survival time thresholds (the 'survival_sweep' edge
+                constraint) to compute the proxy target probability for, or None.
+    """
+    __slots__ = [
+            'nodes',
+            'onehop_type',
+            'wildcard_node_id',
+            'edge_id',
+            'subject_id',
+            'object_id',
+            'predicate',
+            'predicate_proxy',
+            'proxy_operator',
+            'proxy_value',
+            'evidence_curies',
+            'context_meta_curies',
+            'context_dynamic_curies',
+            'result_offset',
+            'result_limit',
+            'survival_sweep',
+            ]
+
+    def __init__(self, **attributes):
+        for name in self.__slots__:
+            object.__setattr__(self, name, attributes.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('QueryGraphPlan is immutable.')
+
+    @property
+    def node_map(self):
+        return {node.qnode_id: node for node in self.nodes}
+
+class QueryPlans:
+    """ The compiled plans of TRAPI query objects.
+
+        Plans are found by the identity of their query. Each query is referenced next to its
+        plan, so its id can not be reused by another object while the plan is held.
+    """
+    def __init__(self):
+        self._plans = {}
+
+    def get(self, query, default=None):
+        entry = self._plans.get(id(query))
+        if entry is None or entry[0] is not query:
+            return default
+        return entry[1]
+
+    def set(self, query, plan):
+        self._plans[id(query)] = (query, plan)
+
+    def __contains__(self, query):
+        return self.get(query) is not None
+
+    def __len__(self):
+        return len(self._plans)
+
+def _get_node_role(category):
+    if category == BIOLINK_GENE_ENTITY:
+        return 'gene'
+    elif category == BIOLINK_DRUG_ENTITY:
+        return 'drug'
+    elif category == BIOLINK_DISEASE_ENTITY:
+        return 'disease'
+    return 'other'
+
+def _get_onehop_type(nodes):
+    roles = [node.role for node in nodes]
+    # implicit 2-hop-queries
+    if all(role == 'gene' for role in roles):
+        return 'gene_two_hop'
+    elif all(role == 'drug' for role in roles):
+        return 'drug_two_hop'
+    wildcard_nodes = [node for node in nodes if node.curie is None]
+    # If standard onehop query
+    if len(wildcard_nodes) == 0:
+        return 'standard'
+    wildcard_type = wildcard_nodes[0].category
+    if wildcard_type == BIOLINK_DRUG_ENTITY:
+        return 'drug'
+    elif wildcard_type == BIOLINK_GENE_ENTITY:
+        return 'gene'
+    raise ValueError('Did not understand wildcard type {}.'.format(wildcard_type))
+
+def _resolve_predicate_proxy(qedge):
+    predicate_proxy_constraint = qedge.find_constraint('predicate_proxy')
+    if predicate_proxy_constraint is None:
+        predicate_proxy = get_default_predicate_proxy()
+    else:
+        predicate_proxy = predicate_proxy_constraint.value[0]
+    proxy_constraint = qedge.find_constraint(predicate_proxy)
+    if proxy_constraint is None:
+        return predicate_proxy, get_default_operator(predicate_proxy), get_default_value(predicate_proxy)
+    return predicate_proxy, proxy_constraint.operator, proxy_constraint.value
+
+def _resolve_predicate_context(qedge, onehop_type):
+    meta_curies = []
+    dynamic_curies = []
+    predicate_context_constraint = qedge.find_constraint('predicate_context')
+    if predicate_context_constraint is None:
+        return tuple(meta_curies), tuple(dynamic_curies)
+    for context in predicate_context_constraint.value:
+        context_curie = get_biolink_entity(context)
+        context_constraint = qedge.find_constraint(context)
+        # used 2 hop structure where context curie is the proxy
+        if context_constraint is None:
+            continue
+        if type(context_constraint.value) is list:
+            context_curies = context_constraint.value
+        else:
+            context_curies = [context_constraint.value]
+        if context_curie == BIOLINK_GENE_ENTITY:
+            is_dynamic = onehop_type in ['gene', 'drug_two_hop']
+        elif context_curie == BIOLINK_DRUG_ENTITY:
+            is_dynamic = onehop_type in ['drug', 'gene_two_hop']
+        else:
+            raise ValueError('Unsupported context type: {}'.format(context_curie))
+        if is_dynamic:
+            dynamic_curies.extend(context_curies)
+        else:
+            meta_curies.extend(context_curies)
+    return tuple(meta_curies), tuple(dynamic_curies)
+
+def _get_constraint_int(qedge, constraint_id):
+    constraint = qedge.find_constraint(constraint_id)
+    if constraint is None:
+        return None
+    value = constraint.value[0] if type(constraint.value) is list else constraint.value
+    value = int(value)
+    if value < 0:
+        raise ValueError('Constraint {} must not be negative.'.format(constraint_id))
+    return value
+
+def _get_survival_sweep(qedge, onehop_type, predicate_proxy):
+    constraint = qedge.find_constraint('survival_sweep')
+    if constraint is None:
+        return None
+    if onehop_type != 'standard' or predicate_proxy != 'EFO:0000714':
+        raise ValueError('Survival sweeps are only supported for standard one-hop survival queries.')
+    values = constraint.value if type(constraint.value) is list else [constraint.value]
+    return tuple(float(value) for value in values)
+
+def _get_evidence_curies(nodes, onehop_type):
+    if onehop_type == 'standard':
+        evidence_roles = ['gene', 'drug']
+    elif onehop_type in ['gene', 'drug_two_hop']:
+        evidence_roles = ['drug']
+    else:
+        evidence_roles = ['gene']
+    return tuple(node.curie for node in nodes if node.role in evidence_roles and node.curie is not None)
+
+def compile_query_graph(query_graph, curies=None):
+    """ Compiles a one-hop query graph into a QueryGraphPlan with a single walk over its nodes
+    and edge.
+
+    :param query_graph: The TRAPI query graph.
+    :type query_graph: trapi_model.query_graph.QueryGraph
+    :param curies: The supported curies keyed by biolink entity. If passed, gene and drug curies
+        are validated against it and the node ids are reduced to the supported curie.
+    :type curies: dict
+
+    :return: The compiled plan.
+    :rtype: chp.query_plan.QueryGraphPlan
+    """
+    nodes = []
+    wildcard_node_ids = []
+    for qnode_id, qnode in query_graph.nodes.items():
+        if qnode.categories is None:
+            continue
+        category = qnode.categories[0]
+        role = _get_node_role(category)
+        curie = None
+        if qnode.ids is None:
+            if role in ['gene', 'drug']:
+                wildcard_node_ids.append(qnode_id)
+        elif curies is not None and role in ['gene', 'drug']:
+            role_curies = curies[BIOLINK_GENE_ENTITY] if role == 'gene' else curies[BIOLINK_DRUG_ENTITY]
+            for _curie in qnode.ids:
+                if _curie in role_curies:
+                    query_graph.nodes[qnode_id].set_ids(_curie)
+                elif role == 'gene':
+                    raise UnidentifiedGeneCurie(qnode.ids)
+                else:
+                    raise UnidentifiedDrugCurie(qnode.ids)
+            curie = query_graph.nodes[qnode_id].ids[0]
+        else:
+            curie = qnode.ids[0]
+        nodes.append(NodePlan(qnode_id, category, curie, role))
+
+    if len(wildcard_node_ids) > 1:
+        raise TooManyContributionNodes
+    if len([node for node in nodes if node.role != 'other']) != 2:
+        raise UnidentifiedQueryType
+
+    onehop_type = _get_onehop_type(nodes)
+
+    # Grab edge
+    for qedge_id, qedge in query_graph.edges.items():
+        break
+    predicate = qedge.predicates[0] if qedge.predicates is not None else None
+    predicate_proxy, proxy_operator, proxy_value = _resolve_predicate_proxy(qedge)
+    context_meta_curies, context_dynamic_curies = _resolve_predicate_context(qedge, onehop_type)
+
+    return QueryGraphPlan(
+            nodes=tuple(nodes),
+            onehop_type=onehop_type,
+            wildcard_node_id=wildcard_node_ids[0] if len(wildcard_node_ids) > 0 else None,
+            edge_id=qedge_id,
+            subject_id=qedge.subject,
+            object_id=qedge.object,
+            predicate=predicate,
+            predicate_proxy=predicate_proxy,
+            proxy_operator=proxy_operator,
+            proxy_value=proxy_value,
+            evidence_curies=_get_evidence_curies(nodes, onehop_type),
+            context_meta_curies=context_meta_curies,
+            context_dynamic_curies=context_dynamic_curies,
+            result_offset=_get_constraint_int(qedge, 'result_offset'),
+            result_limit=_get_constraint_int(qedge, 'max_results'),
+            survival_sweep=_get_survival_sweep(qedge, onehop_type, predicate_proxy),
+            )
@@ -1,5 +1,6 @@
 import pickle
 import logging
+import threading
 
 from pybkb.python_base.reasoning.reasoning import updating
 from pybkb.python_base.reasoning.joint_reasoner import JointReasoner
@@ -7,6 +8,9 @@ from pybkb.python_base.learning.bkb_builder import LinkerBuilder
 
 from chp_data.patient_bkb_builder import PatientBkbBuilder
 
+from chp.contributions import PatientCurieMatrix
+from chp.result_cache import get_data_version
+from chp.patient_index import PatientBitsetIndex, load_patient_index, write_patient_index, get_patient_index_path
 from chp.mixins.reasoner.chp_joint_reasoner_mixin import ChpJointReasonerMixin
 from chp.mixins.reasoner.chp_dynamic_reasoner_mixin import ChpDynamicReasonerMixin
 
@@ -24,6 +28,11 @@ class BaseReasoner:
                  patient_bkb_builder=None,
                  gene_prelinked_bkb_override=None,
                  drug_prelinked_bkb_override=None,
+                 snapshot=None,
+                 joint_engine='bkb',
+                 interpolation_table_dir=None,
+                 patient_index_dir=None,
+                 share_patient_index=False,
                 ):
         """ The base reasoner class for CHP.
 
@@ -45,6 +54,23 @@ class BaseReasoner:
             :param drug_prelinked_bkb_override: A drug bkb that is used to override the bkb loaded from the
             bkb handler. Used primarily in obtaining reasoning results for internal analysis.
             :type drug_prelinked_bkb_override: pybkb.bayesianKnowledgeBase
+            :param snapshot: A reasoner snapshot holding the already processed patient data, prelinked
+            bkbs and interpolations. If passed, these are taken from the snapshot instead of being
+            rebuilt from the bkb handler files.
+            :type snapshot: chp.snapshot.ReasonerSnapshot
+            :param joint_engine: Engine of the joint reasoner, 'bkb' for the pybkb joint reasoner or
+            'bitset' to answer the queries it supports with a chp.patient_index.PatientBitsetIndex.
+            :type joint_engine: str
+            :param interpolation_table_dir: If passed, the joint reasoner maps the interpolations as
+            chp.interpolation_store.InterpolationTables converted into this directory instead of
+            unpickling them.
+            :type interpolation_table_dir: str
+            :param patient_index_dir: If passed, the patient index (see get_patient_index) is attached
+            from a memory mapped file in this directory that is shared by all processes.
+            :type patient_index_dir: str
+            :param share_patient_index: Whether this reasoner writes the shared patient index file if
+            it is missing. Set by the parent process at warm-up, before any workers start.
+            :type share_patient_index: bool
         """
         self.bkb_handler = bkb_handler
         self.hosts_filename = hosts_filename
@@ -53,35 +79,135 @@ class BaseReasoner:
         self.patient_bkb_builder = patient_bkb_builder
         self.gene_prelinked_bkb_override = gene_prelinked_bkb_override
         self.drug_prelinked_bkb_override = drug_prelinked_bkb_override
+        self.snapshot = snapshot
+        self.joint_engine = joint_engine
+        self.interpolation_table_dir = interpolation_table_dir
+        self.patient_index_dir = patient_index_dir
+        self.share_patient_index = share_patient_index
+        self.patient_curie_matrices = {}
+        self._raw_patient_data = None
+        self._patient_data = None
+        self._patient_index = None
+        self._lazy_lock = threading.RLock()
+        # Passed patient data can not be loaded again, so it is never released
+        self._patient_data_passed = patient_bkb_builder is not None
 
         # Run base reasoner setup
         self._setup_base_reasoner()
 
     def _setup_base_reasoner(self):
-        """ Reads in patient BKB builder if one is not passed and loads patient data into
-        the appropriate format. Lastly, it runs the specific reasoner setup method.
+        """ Takes the patient data of a passed patient BKB builder and runs the specific reasoner
+        setup method. Otherwise the patient data is only loaded once it is used, see
+        load_patient_data.
         """
-        # Read in raw patient data
-        if self.patient_bkb_builder is None:
-            with open(self.bkb_handler.patient_data_pk_path, 'rb') as patient_file:
-                self.raw_patient_data = pickle.load(patient_file)
-            # Load in the CHP Data Patient data builder
-            self.patient_bkb_builder = PatientBkbBuilder(
-                                self.raw_patient_data,
-                                self.bkb_handler,
-                               )
-            logger.info('Constructed Patient Bkb Builder.')
-        # For readability
-        self.patient_data = self.patient_bkb_builder.patient_data
-        features = self.patient_data[list(self.patient_data.keys())[0]].keys()
-        non_gene_features = [feature for feature in features if 'ENSEMBL' not in feature]
-
+        if self.patient_bkb_builder is not None:
+            self._raw_patient_data = getattr(self.patient_bkb_builder, 'raw_patient_data', None)
+            self._patient_data = self.patient_bkb_builder.patient_data
         # Setup reasoner mixin
         self._setup_reasoner()
 
+    @property
+    def raw_patient_data(self):
+        if self._raw_patient_data is None:
+            self.load_patient_data()
+        return self._raw_patient_data
+
+    @property
+    def patient_data(self):
+        if self._patient_data is None:
+            self.load_patient_data()
+        return self._patient_data
+
+    def load_patient_data(self):
+        """ Loads the raw patient data and processes it into patient BKB data, or takes both from
+        the snapshot.
+        """
+        with self._lazy_lock:
+            if self._patient_data is not None:
+                return
+            # Take already processed patient data from the snapshot
+            if self.patient_bkb_builder is None and self.snapshot is not None:
+                self._raw_patient_data = self.snapshot.get('raw_patient_data')
+                self._patient_data = self.snapshot.get('patient_data')
+                logger.info('Loaded patient data from snapshot: {}'.format(self.snapshot.snapshot_path))
+                return
+            # Read in raw patient data
+            if self.patient_bkb_builder is None:
+                with open(self.bkb_handler.patient_data_pk_path, 'rb') as patient_file:
+                    self._raw_patient_data = pickle.load(patient_file)
+                # Load in the CHP Data Patient data builder
+                self.patient_bkb_builder = PatientBkbBuilder(
+                                    self._raw_patient_data,
+                                    self.bkb_handler,
+                                   )
+                logger.info('Constructed Patient Bkb Builder.')
+            self._patient_data = self.patient_bkb_builder.patient_data
+
+    def get_patient_index(self):
+        """ Returns the chp.patient_index.PatientBitsetIndex of the raw patient data.
+
+            With a patient_index_dir, the index is attached from the file of this data version that
+            is shared by all processes, without loading the patient data. If there is no such file,
+            a reasoner with share_patient_index writes it first, so the parent process writes it
+            once before the workers start. Otherwise the index is built in memory.
+
+            :rtype: chp.patient_index.PatientBitsetIndex
+        """
+        with self._lazy_lock:
+            if self._patient_index is not None:
+                return self._patient_index
+            if self.patient_index_dir is not None:
+                data_version = get_data_version(self.bkb_handler)
+                self._patient_index = load_patient_index(self.patient_index_dir, data_version)
+                if self._patient_index is None and self.share_patient_index:
+                    patient_data_loaded = self._raw_patient_data is not None
+                    write_patient_index(
+                            get_patient_index_path(self.patient_index_dir, data_version),
+                            PatientBitsetIndex(self.raw_patient_data, evidence_cache_size=0),
+                            data_version=data_version,
+                            )
+                    # Do not hold on to patient data that was only loaded to write the index
+                    if not patient_data_loaded:
+                        self.release_patient_data()
+                    self._patient_index = load_patient_index(self.patient_index_dir, data_version)
+                if self._patient_index is None:
+                    logger.warning('No shared patient index in {}, building it in memory.'.format(self.patient_index_dir))
+            if self._patient_index is None:
+                self._patient_index = PatientBitsetIndex(self.raw_patient_data)
+            return self._patient_index
+
+    def release_patient_data(self):
+        """ Drops the loaded patient data of a reasoner that does not need it any more, e.g.
+        after the shared patient index was written, also from the snapshot it came from. It is
+        loaded again if it is used.
+        """
+        with self._lazy_lock:
+            if not self._patient_data_passed:
+                self._raw_patient_data = None
+                self._patient_data = None
+                self.patient_bkb_builder = None
+                if self.snapshot is not None:
+                    self.snapshot.release(['raw_patient_data', 'patient_data'])
+
     def _setup_reasoner(self):
         pass
 
+    def get_patient_curie_matrix(self, curies_key):
+        """ Returns the sparse patients x curies matrix of the raw patient data, building it on
+        first use. With a patient_index_dir it is read from the shared patient index.
+
+        :param curies_key: 'gene_curies' or 'drug_curies'.
+        :type curies_key: str
+
+        :rtype: chp.contributions.PatientCurieMatrix
+        """
+        if curies_key not in self.patient_curie_matrices:
+            if self.patient_index_dir is not None:
+                self.patient_curie_matrices[curies_key] = PatientCurieMatrix.from_patient_index(self.get_patient_index(), curies_key)
+            else:
+                self.patient_curie_matrices[curies_key] = PatientCurieMatrix(self.raw_patient_data, curies_key)
+        return self.patient_curie_matrices[curies_key]
+
     def run_query(self, query):
         pass
 
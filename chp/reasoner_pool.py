@@ -0,0 +1,124 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import uuid
+import logging
+import multiprocessing
+
+from chp.result_cache import to_plain_dict
+
+logger = logging.getLogger(__name__)
+
+# Reasoners of every pool created in this process, by pool id and then by name. Workers are
+# forked after the reasoners are registered here so they inherit them (copy-on-write) instead
+# of receiving copies.
+_pool_reasoners = {}
+
+def _run_query_in_worker(task):
+    pool_id, reasoners_name, handler_class, max_results, chp_query, query_type = task
+    joint_reasoner, dynamic_reasoner = _pool_reasoners[pool_id][reasoners_name]
+    handler = handler_class.get_reasoning_handler(
+            joint_reasoner=joint_reasoner,
+            dynamic_reasoner=dynamic_reasoner,
+            max_results=max_results,
+            )
+    chp_query = handler._run_query(chp_query, query_type)
+    # Make sure the ran query can be sent back to the parent
+    for attribute in ['result', 'contributions', 'wildcard_contributions']:
+        if hasattr(chp_query, attribute):
+            setattr(chp_query, attribute, to_plain_dict(getattr(chp_query, attribute)))
+    return chp_query
+
+class ReasonerPool:
+    """ Pool of pre-forked worker processes that run CHP queries against already loaded reasoners.
+
+        Create the pool in the process that uses it, after the reasoners are loaded and
+        preferably before the process starts any threads: forking a multithreaded process can
+        leave the workers with locks (logging, database connections, ...) that are held forever,
+        and a pool inherited through a fork can not run queries. The workers are forked from the
+        current process, so the reasoners are shared copy-on-write, the patient index and
+        interpolation table files stay mapped once and only the CHP queries and their results
+        travel between processes. One pool serves the reasoners of several configurations, see
+        get_reasoners_pool.
+
+        :param reasoners: The loaded (joint reasoner, dynamic reasoner) of each configuration name.
+        :type reasoners: dict
+        :param processes: Number of worker processes. Defaults to the cpu count.
+        :type processes: int
+    """
+    def __init__(self, reasoners, processes=None):
+        self.pool_id = str(uuid.uuid4())
+        _pool_reasoners[self.pool_id] = dict(reasoners)
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = multiprocessing.get_context('fork').Pool(processes=self.processes)
+        logger.info('Forked reasoner pool with {} workers for {}.'.format(self.processes, ', '.join(reasoners)))
+
+    def get_reasoners_pool(self, reasoners_name):
+        """ Returns a view of the pool that runs queries against the reasoners of one
+        configuration. Handlers take such a view as their reasoner_pool.
+        """
+        if reasoners_name not in _pool_reasoners[self.pool_id]:
+            raise KeyError('No reasoners named {} in the reasoner pool.'.format(reasoners_name))
+        return ReasonersPool(lambda: self, reasoners_name)
+
+    def _get_worker_tasks(self, reasoners_name, handler_class, tasks, max_results):
+        return [(self.pool_id, reasoners_name, handler_class, max_results, chp_query, query_type) for chp_query, query_type in tasks]
+
+    def run_queries(self, reasoners_name, handler_class, tasks, max_results):
+        """ Runs CHP queries on the pool with handler_class._run_query.
+
+            :param reasoners_name: Name of the reasoners to run the queries against.
+            :type reasoners_name: str
+            :param handler_class: The handler class whose _run_query is used.
+            :type handler_class: type
+            :param tasks: List of (chp_query, query_type) tuples.
+            :type tasks: list
+            :param max_results: Max results of the calling handler.
+            :type max_results: int
+
+            :return: The ran CHP queries in the same order as the tasks.
+            :rtype: list
+        """
+        return self._pool.map(_run_query_in_worker, self._get_worker_tasks(reasoners_name, handler_class, tasks, max_results), chunksize=1)
+
+    def imap_queries(self, reasoners_name, handler_class, tasks, max_results):
+        """ Same as run_queries but returns an iterator that yields each ran CHP query, in task
+        order, as soon as it is finished.
+        """
+        return self._pool.imap(_run_query_in_worker, self._get_worker_tasks(reasoners_name, handler_class, tasks, max_results), chunksize=1)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.discard()
+
+    def discard(self):
+        """ Forgets the reasoners of a pool that was inherited by a forked process. The
+        inherited pool can not run queries, as its task and result handler threads only exist
+        in the process that created it, and can not be closed from the child either.
+        """
+        _pool_reasoners.pop(self.pool_id, None)
+
+class ReasonersPool:
+    """ The view of a ReasonerPool for the reasoners of one configuration.
+
+        :param get_reasoner_pool: Returns the ReasonerPool to run queries on. It is called on
+            every batch, so the pool can be started on first use.
+        :type get_reasoner_pool: callable
+        :param reasoners_name: Name of the reasoners to run the queries against.
+        :type reasoners_name: str
+    """
+    def __init__(self, get_reasoner_pool, reasoners_name):
+        self.get_reasoner_pool = get_reasoner_pool
+        self.reasoners_name = reasoners_name
+
+    def run_queries(self, handler_class, tasks, max_results):
+        return self.get_reasoner_pool().run_queries(self.reasoners_name, handler_class, tasks, max_results)
+
+    def imap_queries(self, handler_class, tasks, max_results):
+        return self.get_reasoner_pool().imap_queries(self.reasoners_name, handler_class, tasks, max_results)
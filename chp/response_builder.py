@@ -0,0 +1,123 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import logging
+
+from trapi_model.biolink.constants import *
+
+logger = logging.getLogger(__name__)
+
+# Attribute templates are built once at import and only ever read. Per edge values are
+# filled in with get_attribute_kwargs.
+
+# CHP and TCGA provenance attributes added to every knowledge graph edge.
+PROVENANCE_ATTRIBUTES = (
+        # CHP InfoRes Attribute
+        {
+            "attribute_type_id": BIOLINK_PRIMARY_KNOWLEDGE_SOURCE_ENTITY.get_curie(),
+            "value": 'infores:connections-hypothesis',
+            "value_type_id": BIOLINK_INFORMATION_RESOURCE_ENTITY.get_curie(),
+            "value_url": 'http://chp.thayer.dartmouth.edu',
+            "description": 'The Connections Hypothesis Provider from NCATS Translator.',
+            "attribute_source": 'infores:connections-hypothesis',
+            },
+        # TCGA Supporting Data Source Attribute
+        {
+            "attribute_type_id": BIOLINK_SUPPORTING_DATA_SOURCE_ENTITY.get_curie(),
+            "value": 'infores:tcga',
+            "value_type_id": BIOLINK_INFORMATION_RESOURCE_ENTITY.get_curie(),
+            "value_url": 'https://portal.gdc.cancer.gov/',
+            "description": 'The Cancer Genome Atlas provided by the GDC Data Portal.',
+            "attribute_source": 'infores:gdc',
+            },
+        {
+            "attribute_type_id": BIOLINK_SUPPORTING_DATA_SOURCE_ENTITY.get_curie(),
+            "value": 'infores:tcga',
+            "value_type_id": BIOLINK_INFORMATION_RESOURCE_ENTITY.get_curie(),
+            "value_url": 'https://di2ag.github.io/chp/chp_documentation#chp-single-hop-contribution-analysis',
+            "description": 'Documents how Connections Hypothesis Provider builds ranked contribution values over tcga data.',
+            "attribute_source": 'infores:connections-hypothesis',
+            },
+        )
+
+SURVIVAL_PROBABILITY_ATTRIBUTE = {
+        "attribute_type_id": 'Probability of Survival',
+        "value_type_id": BIOLINK_HAS_CONFIDENCE_LEVEL_ENTITY.get_curie(),
+        }
+
+SURVIVAL_CURVE_ATTRIBUTE = {
+        "attribute_type_id": 'Survival Curve',
+        "value_type_id": BIOLINK_HAS_CONFIDENCE_LEVEL_ENTITY.get_curie(),
+        "description": 'Probability of survival for each threshold of the survival_sweep constraint, with the [curie, contribution] pairs of the gene and drug curies that contribute most at that threshold.',
+        }
+
+CONTRIBUTION_ATTRIBUTE = {
+        "attribute_type_id": 'Contribution',
+        "value_type_id": BIOLINK_HAS_EVIDENCE_ENTITY.get_curie(),
+        "description": 'Inference is derived from cancer data. Contribution reflects sensitivity of nodes to patient survival time. Contribution values closer to 1 are correlated with longer survival time and contribution values closer to -1 are correlated with shorter survival time.',
+        }
+
+def get_attribute_kwargs(template, value):
+    """ Returns add_attribute keyword arguments of an attribute template with the given value.
+    """
+    attribute_kwargs = dict(template)
+    attribute_kwargs["value"] = value
+    return attribute_kwargs
+
+def add_provenance_attributes(kedge):
+    for attribute_kwargs in PROVENANCE_ATTRIBUTES:
+        kedge.add_attribute(**attribute_kwargs)
+    return kedge
+
+class TrapiMessageBuilder:
+    """ Builds the knowledge graph and results of a TRAPI message.
+
+        Nodes are interned by (curie, category), so a node that is bound in many results is
+        added to the knowledge graph only once. Results are collected while building and added
+        to the message in one pass by build().
+
+        :param message: The TRAPI message to fill.
+        :type message: trapi_model.message.Message
+    """
+    def __init__(self, message):
+        self.message = message
+        self.kg = message.knowledge_graph
+        self._node_keys = {}
+        self._results = []
+
+    def add_node(self, curie, name, category):
+        """ Returns the knowledge graph key of the node, adding it if it has not been added yet.
+        """
+        node_key = self._node_keys.get((curie, category))
+        if node_key is None:
+            node_key = self.kg.add_node(curie, name, category)
+            self._node_keys[(curie, category)] = node_key
+        return node_key
+
+    def add_edge(self, subject_key, object_key, predicate, attribute_template=None, value=None):
+        """ Adds an edge and, if passed, an attribute built from attribute_template and value.
+        """
+        edge_key = self.kg.add_edge(subject_key, object_key, predicate=predicate)
+        if attribute_template is not None:
+            self.add_edge_attribute(edge_key, attribute_template, value)
+        return edge_key
+
+    def add_edge_attribute(self, edge_key, attribute_template, value):
+        self.kg.edges[edge_key].add_attribute(**get_attribute_kwargs(attribute_template, value))
+        return edge_key
+
+    def add_result(self, node_bindings, edge_bindings):
+        self._results.append((node_bindings, edge_bindings))
+
+    def build(self):
+        """ Adds the collected results to the message and returns it.
+        """
+        for node_bindings, edge_bindings in self._results:
+            self.message.results.add_result(node_bindings, edge_bindings)
+        self._results = []
+        return self.message
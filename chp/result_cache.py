@@ -0,0 +1,304 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import os
+import copy
+import time
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Attributes of a ran CHP query that make up its reasoning result.
+RESULT_ATTRIBUTES = [
+        'result',
+        'contributions',
+        'wildcard_contributions',
+        'ranked_wildcard_contributions',
+        'truth_target',
+        'truth_prob',
+        'survival_curve',
+        'report',
+        ]
+
+def get_data_version(bkb_handler):
+    """ Returns the fields of a bkb handler that identify the data a result was computed from.
+    """
+    return {
+            "bkb_major_version": getattr(bkb_handler, 'bkb_major_version', None),
+            "bkb_minor_version": getattr(bkb_handler, 'bkb_minor_version', None),
+            "disease": getattr(bkb_handler, 'disease', None),
+            }
+
+def to_plain_dict(value):
+    """ Recursively turns (default)dicts into plain dicts and copies lists. Result dictionaries
+    are often defaultdicts with lambda factories, which can not be pickled.
+    """
+    if isinstance(value, dict):
+        return {key: to_plain_dict(_value) for key, _value in value.items()}
+    if isinstance(value, list):
+        return [to_plain_dict(_value) for _value in value]
+    return value
+
+def get_result(chp_query):
+    """ Extracts the reasoning result attributes of a ran CHP query.
+    """
+    return {attribute: to_plain_dict(getattr(chp_query, attribute)) for attribute in RESULT_ATTRIBUTES if hasattr(chp_query, attribute)}
+
+def set_result(chp_query, result):
+    """ Sets copies of cached reasoning result attributes on a built CHP query, so the same
+    cached result can be handed to several queries without them sharing any objects.
+    """
+    for attribute, value in result.items():
+        setattr(chp_query, attribute, copy.deepcopy(value))
+    return chp_query
+
+class PersistentResultStore:
+    """ File backed store of CHP reasoning results shared by worker processes and restarts.
+
+        Results live in an embedded SQLite database. Every write is its own transaction, so
+        readers in other processes only ever see complete results. Reads do not write: their
+        access times are buffered in memory and written in one batch every access_batch_size
+        reads or with the next write. The total size of the stored results is kept in a single
+        row next to them, and when it grows beyond max_bytes the least recently read results
+        are evicted. Results older than ttl are neither returned nor kept.
+
+        :param path: Database filename.
+        :type path: str
+        :param max_bytes: Maximum total size of the stored (pickled) results.
+        :type max_bytes: int
+        :param ttl: Seconds a result stays valid. None means results never expire.
+        :type ttl: float
+        :param access_batch_size: Number of buffered access times that triggers a write.
+        :type access_batch_size: int
+    """
+    def __init__(self, path, max_bytes=1024**3, ttl=None, access_batch_size=64):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.access_batch_size = access_batch_size
+        self._local = threading.local()
+        self._accessed = {}
+        self._accessed_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(results)').fetchall()]
+            if columns and 'created' not in columns:
+                # Stores written before results expired can not be aged, start over
+                logger.info('Recreating result store {}.'.format(self.path))
+                conn.execute('DROP TABLE results')
+                conn.execute('DROP TABLE IF EXISTS store_size')
+            conn.execute(
+                    'CREATE TABLE IF NOT EXISTS results ('
+                    'key TEXT PRIMARY KEY, '
+                    'value BLOB NOT NULL, '
+                    'size INTEGER NOT NULL, '
+                    'created REAL NOT NULL, '
+                    'last_access REAL NOT NULL)'
+                    )
+            conn.execute('CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)')
+            conn.execute('CREATE INDEX IF NOT EXISTS results_created ON results (created)')
+            conn.execute('CREATE TABLE IF NOT EXISTS store_size (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)')
+            conn.execute('INSERT OR IGNORE INTO store_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM results')
+
+    def _connect(self):
+        # SQLite connections must not cross threads or forked processes.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _hash_key(key):
+        return hashlib.sha256(repr(key).encode('utf_8')).hexdigest()
+
+    def _get_expiry_cutoff(self):
+        if self.ttl is None:
+            return None
+        return time.time() - self.ttl
+
+    def get(self, key):
+        hashed_key = self._hash_key(key)
+        conn = self._connect()
+        row = conn.execute('SELECT value, created FROM results WHERE key = ?', (hashed_key,)).fetchone()
+        if row is None:
+            return None
+        value, created = row
+        cutoff = self._get_expiry_cutoff()
+        if cutoff is not None and created < cutoff:
+            return None
+        with self._accessed_lock:
+            self._accessed[hashed_key] = time.time()
+            flush = len(self._accessed) >= self.access_batch_size
+        if flush:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._flush_accessed(conn)
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        return pickle.loads(value)
+
+    def _flush_accessed(self, conn):
+        with self._accessed_lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            conn.executemany(
+                    'UPDATE results SET last_access = ? WHERE key = ?',
+                    [(last_access, hashed_key) for hashed_key, last_access in accessed.items()],
+                    )
+
+    def set(self, key, result):
+        value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        hashed_key = self._hash_key(key)
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._flush_accessed(conn)
+            row = conn.execute('SELECT size FROM results WHERE key = ?', (hashed_key,)).fetchone()
+            replaced_size = 0 if row is None else row[0]
+            conn.execute(
+                    'INSERT OR REPLACE INTO results (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)',
+                    (hashed_key, value, len(value), now, now),
+                    )
+            conn.execute('UPDATE store_size SET total = total + ? WHERE id = 0', (len(value) - replaced_size,))
+            self._evict(conn)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _delete(self, conn, rows):
+        conn.executemany('DELETE FROM results WHERE key = ?', [(hashed_key,) for hashed_key, _ in rows])
+        conn.execute('UPDATE store_size SET total = total - ? WHERE id = 0', (sum(size for _, size in rows),))
+
+    def _evict(self, conn):
+        cutoff = self._get_expiry_cutoff()
+        if cutoff is not None:
+            expired = conn.execute('SELECT key, size FROM results WHERE created < ?', (cutoff,)).fetchall()
+            if expired:
+                self._delete(conn, expired)
+        total_size = conn.execute('SELECT total FROM store_size WHERE id = 0').fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        evicted = []
+        for hashed_key, size in conn.execute('SELECT key, size FROM results ORDER BY last_access'):
+            evicted.append((hashed_key, size))
+            total_size -= size
+            if total_size <= self.max_bytes:
+                break
+        self._delete(conn, evicted)
+        logger.info('Evicted {} results from result store {}.'.format(len(evicted), self.path))
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM results')
+            conn.execute('UPDATE store_size SET total = 0 WHERE id = 0')
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        with self._accessed_lock:
+            self._accessed.clear()
+
+    def get_size(self):
+        """ Returns the total size of the stored (pickled) results.
+        """
+        return self._connect().execute('SELECT total FROM store_size WHERE id = 0').fetchone()[0]
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+class ResultCache:
+    """ Thread safe, in-process LRU cache of CHP reasoning results with a time to live.
+
+        :param maxsize: Maximum number of results to hold. The least recently used result is
+            evicted first.
+        :type maxsize: int
+        :param ttl: Seconds a result stays valid. None means results never expire.
+        :type ttl: float
+        :param store: Optional persistent store behind the in-process cache. Results missing
+            from the cache are looked up in the store, and new results are written to both.
+        :type store: chp.result_cache.PersistentResultStore
+    """
+    def __init__(self, maxsize=1024, ttl=3600, store=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = store
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached result for key or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                expires, result = entry
+                if expires is None or expires > time.monotonic():
+                    self._results.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self._results[key]
+        if self.store is not None:
+            result = self.store.get(key)
+            if result is not None:
+                self._set(key, result)
+                with self._lock:
+                    self.store_hits += 1
+                return result
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, result):
+        self._set(key, result)
+        if self.store is not None:
+            self.store.set(key, result)
+
+    def _set(self, key, result):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._results[key] = (expires, result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.hits = 0
+            self.store_hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def stats(self):
+        return {
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "size": len(self._results),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                }
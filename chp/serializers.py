@@ -0,0 +1,233 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import copy
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+class _ModelSection:
+    """ Stands in for a section of a trapi_model object (e.g. the message of a response) while
+    the rest of the object is converted to a dict, so the section can be encoded on its own
+    by iter_encode.
+    """
+    def __init__(self, model, iter_encode):
+        self.model = model
+        self.iter_encode = iter_encode
+
+    def to_dict(self):
+        return self
+
+class TrapiResponseSerializer:
+    """ Serializes TRAPI responses (trapi_model queries or their dicts) to JSON chunks that can
+        be written to a stream as they are produced.
+
+        The knowledge graph nodes, edges and results of a response are encoded one at a time.
+        A trapi_model response is never converted to a dict as a whole: only its small
+        sections (e.g. the query graph and logs) are, and every node, edge and result is
+        converted on its own right before it is encoded. So at most one element of a response
+        is held as a dict, and a batch is never held as a single JSON string. Edge attributes
+        repeat heavily across edges (e.g. the provenance attributes), so the encoding of every
+        field but the value is cached per distinct set of those fields and reused, while values
+        (e.g. contributions) are always encoded on their own.
+
+        :param max_cached_attributes: Maximum number of pre-encoded attribute fragments to keep.
+        :type max_cached_attributes: int
+    """
+    def __init__(self, max_cached_attributes=1024):
+        self.max_cached_attributes = max_cached_attributes
+        self._attribute_fragments = {}
+        self._lock = threading.Lock()
+
+    def _get_attribute_fragments(self, attribute):
+        """ Returns the encoding of an attribute split around its value, i.e. a (prefix, suffix)
+        tuple, or a 1-tuple with the whole encoding if it has no value.
+        """
+        chunks = ['{}: {}'.format(_encode(name), _encode(value)) for name, value in attribute.items() if name != "value"]
+        if "value" not in attribute:
+            return ('{{{}}}'.format(', '.join(chunks)),)
+        value_idx = list(attribute).index("value")
+        before, after = chunks[:value_idx], chunks[value_idx:]
+        prefix = '{{{}{}: '.format(''.join('{}, '.format(chunk) for chunk in before), _encode("value"))
+        suffix = '{}}}'.format(''.join(', {}'.format(chunk) for chunk in after))
+        return (prefix, suffix)
+
+    def _encode_attribute(self, attribute):
+        if not isinstance(attribute, dict):
+            return _encode(attribute)
+        # Types are part of the key, as True, 1 and 1.0 are equal but encode differently
+        try:
+            key = tuple((name,) if name == "value" else (name, type(value), value) for name, value in attribute.items())
+            hash(key)
+        except TypeError:
+            # Attributes with nested fields other than the value are not cached
+            return _encode(attribute)
+        fragments = self._attribute_fragments.get(key)
+        if fragments is None:
+            fragments = self._get_attribute_fragments(attribute)
+            with self._lock:
+                if len(self._attribute_fragments) < self.max_cached_attributes:
+                    self._attribute_fragments[key] = fragments
+        if len(fragments) == 1:
+            return fragments[0]
+        return '{}{}{}'.format(fragments[0], _encode(attribute["value"]), fragments[1])
+
+    def _encode_edge(self, edge):
+        attributes = edge.get("attributes")
+        if not attributes:
+            return _encode(edge)
+        chunks = []
+        for key, value in edge.items():
+            if key == "attributes":
+                value_fragment = '[{}]'.format(', '.join(self._encode_attribute(attribute) for attribute in attributes))
+            else:
+                value_fragment = _encode(value)
+            chunks.append('{}: {}'.format(_encode(key), value_fragment))
+        return '{{{}}}'.format(', '.join(chunks))
+
+    @staticmethod
+    def _iter_mapping(mapping, encode_value):
+        yield '{'
+        for i, (key, value) in enumerate(mapping.items()):
+            yield '{}{}: {}'.format(', ' if i > 0 else '', _encode(key), encode_value(key, value))
+        yield '}'
+
+    @staticmethod
+    def _iter_sequence(sequence, encode_item):
+        yield '['
+        for i, item in enumerate(sequence):
+            yield '{}{}'.format(', ' if i > 0 else '', encode_item(item))
+        yield ']'
+
+    def _iter_knowledge_graph(self, knowledge_graph):
+        yield '{'
+        for i, (key, value) in enumerate(knowledge_graph.items()):
+            yield '{}{}: '.format(', ' if i > 0 else '', _encode(key))
+            if key in ["nodes", "edges"] and isinstance(value, dict):
+                encode_element = (lambda _, node: _encode(node)) if key == "nodes" else (lambda _, edge: self._encode_edge(edge))
+                yield from self._iter_mapping(value, encode_element)
+            else:
+                yield _encode(value)
+        yield '}'
+
+    def _iter_message(self, message):
+        yield '{'
+        for i, (key, value) in enumerate(message.items()):
+            yield '{}{}: '.format(', ' if i > 0 else '', _encode(key))
+            if key == "knowledge_graph" and isinstance(value, dict):
+                yield from self._iter_knowledge_graph(value)
+            elif key == "results" and isinstance(value, list):
+                yield from self._iter_sequence(value, _encode)
+            else:
+                yield _encode(value)
+        yield '}'
+
+    def _iter_model(self, model, section_encoders):
+        """ Yields the JSON encoding of a trapi_model object in chunks, where the named sections
+        (attributes of the model) are encoded by their section encoder instead of being
+        converted to dicts with the rest of the model.
+        """
+        shallow_model = copy.copy(model)
+        for name, iter_encode in section_encoders.items():
+            section = getattr(model, name, None)
+            if hasattr(section, 'to_dict'):
+                setattr(shallow_model, name, _ModelSection(section, iter_encode))
+        yield '{'
+        for i, (key, value) in enumerate(shallow_model.to_dict().items()):
+            yield '{}{}: '.format(', ' if i > 0 else '', _encode(key))
+            if isinstance(value, _ModelSection):
+                yield from value.iter_encode(value.model)
+            else:
+                yield _encode(value)
+        yield '}'
+
+    def _iter_knowledge_graph_model(self, knowledge_graph):
+        nodes = getattr(knowledge_graph, 'nodes', None)
+        edges = getattr(knowledge_graph, 'edges', None)
+        if not isinstance(nodes, dict) or not isinstance(edges, dict):
+            yield from self._iter_knowledge_graph(knowledge_graph.to_dict())
+            return
+        yield '{{{}: '.format(_encode("nodes"))
+        yield from self._iter_mapping(nodes, lambda _, node: _encode(node.to_dict()))
+        yield ', {}: '.format(_encode("edges"))
+        yield from self._iter_mapping(edges, lambda _, edge: self._encode_edge(edge.to_dict()))
+        yield '}'
+
+    def _iter_results_model(self, results):
+        result_list = getattr(results, 'results', None)
+        if not isinstance(result_list, list):
+            yield _encode(results.to_dict())
+            return
+        yield from self._iter_sequence(result_list, lambda result: _encode(result.to_dict()))
+
+    def _iter_message_model(self, message):
+        yield from self._iter_model(message, {
+            "knowledge_graph": self._iter_knowledge_graph_model,
+            "results": self._iter_results_model,
+            })
+
+    def iter_response(self, response):
+        """ Yields the JSON encoding of a single TRAPI response in chunks.
+        """
+        if hasattr(response, 'to_dict'):
+            yield from self._iter_model(response, {"message": self._iter_message_model})
+            return
+        yield '{'
+        for i, (key, value) in enumerate(response.items()):
+            yield '{}{}: '.format(', ' if i > 0 else '', _encode(key))
+            if key == "message" and isinstance(value, dict):
+                yield from self._iter_message(value)
+            else:
+                yield _encode(value)
+        yield '}'
+
+    def iter_json(self, responses):
+        """ Yields the JSON encoding of a list of TRAPI responses in chunks.
+        """
+        yield '['
+        for i, response in enumerate(responses):
+            if i > 0:
+                yield ', '
+            yield from self.iter_response(response)
+        yield ']'
+
+    def iter_ndjson(self, responses):
+        """ Yields one JSON line per TRAPI response (newline delimited JSON).
+        """
+        for response in responses:
+            yield ''.join(self.iter_response(response)) + '\n'
+
+    def iter_record(self, response, **fields):
+        """ Yields one JSON line of the form {"response": response, **fields} in chunks, where
+        response is a TRAPI response or None.
+        """
+        yield '{{{}: '.format(_encode("response"))
+        if response is None:
+            yield _encode(None)
+        else:
+            yield from self.iter_response(response)
+        for name, value in fields.items():
+            yield ', {}: {}'.format(_encode(name), _encode(value))
+        yield '}\n'
+
+    def write(self, responses, stream, ndjson=False):
+        """ Writes TRAPI responses to a text stream as a JSON list or as NDJSON.
+        """
+        chunks = self.iter_ndjson(responses) if ndjson else self.iter_json(responses)
+        for chunk in chunks:
+            stream.write(chunk)
+        return stream
+
+trapi_response_serializer = TrapiResponseSerializer()
+
+def serialize_responses(responses, stream, ndjson=False):
+    return trapi_response_serializer.write(responses, stream, ndjson=ndjson)
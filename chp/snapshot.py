@@ -0,0 +1,233 @@
+'''
+Source code developed by DI2AG.
+Thayer School of Engineering at Dartmouth College
+Authors:    Dr. Eugene Santos, Jr
+            Mr. Chase Yakaboski,
+            Mr. Gregory Hyde,
+            Dr. Keum Joo Kim
+'''
+import os
+import json
+import pickle
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+
+from chp.result_cache import get_data_version
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'CHPSNAP\x00'
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_EXTENSION = '.chpsnap'
+_PREAMBLE = struct.Struct('<8sII')
+
+SNAPSHOT_SECTIONS = [
+        'raw_patient_data',
+        'patient_data',
+        'gene_prelinked_bkb',
+        'drug_prelinked_bkb',
+        'gene_interpolations',
+        'drug_interpolations',
+        ]
+
+class SnapshotVersionError(Exception):
+
+    def __init__(self, *args):
+        self.message = args[0]
+
+    def __str__(self):
+        return 'Incompatible reasoner snapshot: {}'.format(self.message)
+
+def get_snapshot_path(snapshot_dir, bkb_handler):
+    """ Returns the snapshot filename for a bkb handler's disease and bkb version.
+    """
+    data_version = get_data_version(bkb_handler)
+    filename = '{}_{}_{}{}'.format(
+            data_version["disease"],
+            data_version["bkb_major_version"],
+            data_version["bkb_minor_version"],
+            SNAPSHOT_EXTENSION,
+            )
+    return os.path.join(snapshot_dir, filename)
+
+def write_snapshot(snapshot_path, bkb_handler, dynamic_reasoner, joint_reasoner):
+    """ Writes the processed state of already initialized reasoners to a single versioned snapshot file.
+
+        The file is a fixed preamble (magic, format version, header length), a JSON header
+        holding the data version and the (offset, length) of every section, followed by one
+        pickle per section. The file is written to a temporary file first and then moved into
+        place so readers never see a partial snapshot.
+
+        Loading a snapshot skips processing the raw patient data into patient BKB data and
+        decompressing the prelinked BKBs, but the sections are still pickles: every process
+        reads and unpickles its own copy of each section it uses, so loading takes as long as
+        unpickling them. Interpolations that the joint reasoner maps as
+        chp.interpolation_store.InterpolationTables are stored as references to their
+        table files, which are shared by all processes.
+
+        :param snapshot_path: Where to write the snapshot.
+        :type snapshot_path: str
+        :param bkb_handler: The CHP Data handler the reasoners were built from.
+        :type bkb_handler: chp_data.bkb_handler.BkbHandler
+        :param dynamic_reasoner: An initialized dynamic reasoner.
+        :type dynamic_reasoner: chp.reasoner.ChpDynamicReasoner
+        :param joint_reasoner: An initialized joint reasoner.
+        :type joint_reasoner: chp.reasoner.ChpJointReasoner
+    """
+    sections = {
+            "raw_patient_data": getattr(dynamic_reasoner, 'raw_patient_data', None),
+            "patient_data": dynamic_reasoner.patient_data,
+            "gene_prelinked_bkb": dynamic_reasoner.gene_prelinked_bkb,
+            "drug_prelinked_bkb": dynamic_reasoner.drug_prelinked_bkb,
+            "gene_interpolations": joint_reasoner.gene_interpolations,
+            "drug_interpolations": joint_reasoner.drug_interpolations,
+            }
+    blobs = {name: pickle.dumps(sections[name], protocol=pickle.HIGHEST_PROTOCOL) for name in SNAPSHOT_SECTIONS}
+
+    # The header has to know the section offsets, which depend on the header size. Reserve a
+    # header region large enough for the header regardless of the offsets written into it.
+    header = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "data_version": get_data_version(bkb_handler),
+            "sections": {name: [0, len(blob)] for name, blob in blobs.items()},
+            }
+    header_size = len(json.dumps(header).encode('utf_8')) + 32 * len(blobs)
+    offset = _PREAMBLE.size + header_size
+    for name in SNAPSHOT_SECTIONS:
+        header["sections"][name][0] = offset
+        offset += len(blobs[name])
+    header_bytes = json.dumps(header).encode('utf_8')
+
+    snapshot_dir = os.path.dirname(os.path.abspath(snapshot_path))
+    fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f_:
+            f_.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, len(header_bytes)))
+            f_.write(header_bytes)
+            for name in SNAPSHOT_SECTIONS:
+                section_offset, _ = header["sections"][name]
+                f_.write(b'\x00' * (section_offset - f_.tell()))
+                f_.write(blobs[name])
+        os.replace(tmp_path, snapshot_path)
+    except:
+        os.remove(tmp_path)
+        raise
+    logger.info('Wrote reasoner snapshot to {}.'.format(snapshot_path))
+    return snapshot_path
+
+class ReasonerSnapshot:
+    """ Read only view of a reasoner snapshot.
+
+        Opening a snapshot only reads its header. Every section is read and unpickled the
+        first time it is requested and kept until it is released, so reasoners built from the
+        same snapshot share the unpickled sections (e.g. the patient data) instead of each
+        unpickling their own copy, also when they load a section lazily after the other.
+
+        :param snapshot_path: Path of a snapshot written by write_snapshot.
+        :type snapshot_path: str
+        :param bkb_handler: If passed, the snapshot must have been built from the same disease
+            and bkb version or a SnapshotVersionError is raised.
+        :type bkb_handler: chp_data.bkb_handler.BkbHandler
+    """
+    def __init__(self, snapshot_path, bkb_handler=None):
+        self.snapshot_path = snapshot_path
+        with open(snapshot_path, 'rb') as f_:
+            preamble = f_.read(_PREAMBLE.size)
+            if len(preamble) < _PREAMBLE.size:
+                raise SnapshotVersionError('{} is not a CHP reasoner snapshot.'.format(snapshot_path))
+            magic, format_version, header_length = _PREAMBLE.unpack(preamble)
+            if magic != SNAPSHOT_MAGIC:
+                raise SnapshotVersionError('{} is not a CHP reasoner snapshot.'.format(snapshot_path))
+            if format_version != SNAPSHOT_FORMAT_VERSION:
+                raise SnapshotVersionError('Format version {} but expected {}.'.format(format_version, SNAPSHOT_FORMAT_VERSION))
+            self.header = json.loads(f_.read(header_length))
+        self.data_version = self.header["data_version"]
+        if bkb_handler is not None and self.data_version != get_data_version(bkb_handler):
+            raise SnapshotVersionError('Built for {} but loading {}.'.format(self.data_version, get_data_version(bkb_handler)))
+        self._sections = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._sections:
+                offset, length = self.header["sections"][name]
+                with open(self.snapshot_path, 'rb') as f_:
+                    f_.seek(offset)
+                    self._sections[name] = pickle.loads(f_.read(length))
+            return self._sections[name]
+
+    def release(self, names=None):
+        """ Drops unpickled sections that are no longer needed. Reasoners keep the sections
+        they already took, a section that is requested again is unpickled again.
+
+        :param names: The sections to drop, or None to drop all of them.
+        :type names: list
+        """
+        with self._lock:
+            if names is None:
+                self._sections = {}
+                return
+            for name in names:
+                self._sections.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.header["sections"]
+
+def load_snapshot(snapshot_dir, bkb_handler):
+    """ Returns the snapshot for a bkb handler from a snapshot directory or None if there is no
+    usable snapshot, in which case the reasoners should be built from the bkb handler files.
+    """
+    if snapshot_dir is None:
+        return None
+    snapshot_path = get_snapshot_path(snapshot_dir, bkb_handler)
+    if not os.path.exists(snapshot_path):
+        logger.info('No reasoner snapshot found at {}.'.format(snapshot_path))
+        return None
+    try:
+        return ReasonerSnapshot(snapshot_path, bkb_handler=bkb_handler)
+    except SnapshotVersionError as ex:
+        logger.warning('Ignoring reasoner snapshot. {}'.format(str(ex)))
+        return None
+
+def build_snapshot(snapshot_dir, bkb_handler, hosts_filename=None, num_processes_per_host=0):
+    """ Builds the reasoners of a bkb handler from the raw data files and writes their snapshot.
+    """
+    from chp.reasoner import ChpDynamicReasoner, ChpJointReasoner
+
+    dynamic_reasoner = ChpDynamicReasoner(
+        bkb_handler=bkb_handler,
+        hosts_filename=hosts_filename,
+        num_processes_per_host=num_processes_per_host)
+    # Share the processed patient data instead of processing it twice.
+    dynamic_reasoner.load_patient_data()
+    joint_reasoner = ChpJointReasoner(
+        bkb_handler=bkb_handler,
+        hosts_filename=hosts_filename,
+        num_processes_per_host=num_processes_per_host,
+        patient_bkb_builder=dynamic_reasoner.patient_bkb_builder)
+    return write_snapshot(get_snapshot_path(snapshot_dir, bkb_handler), bkb_handler, dynamic_reasoner, joint_reasoner)
+
+def main(argv=None):
+    from chp_data.bkb_handler import BkbDataHandler
+
+    parser = argparse.ArgumentParser(description='Build a CHP reasoner snapshot for a disease configuration.')
+    parser.add_argument('snapshot_dir', help='Directory to write the snapshot into.')
+    parser.add_argument('--disease', default=None, help='Disease of the bkb handler, e.g. tcga_brca.')
+    parser.add_argument('--bkb-major-version', default='darwin')
+    parser.add_argument('--bkb-minor-version', default='2.0')
+    args = parser.parse_args(argv)
+
+    bkb_handler_kwargs = {
+            "bkb_major_version": args.bkb_major_version,
+            "bkb_minor_version": args.bkb_minor_version,
+            }
+    if args.disease is not None:
+        bkb_handler_kwargs["disease"] = args.disease
+    os.makedirs(args.snapshot_dir, exist_ok=True)
+    print(build_snapshot(args.snapshot_dir, BkbDataHandler(**bkb_handler_kwargs)))
+
+if __name__ == '__main__':
+    main()
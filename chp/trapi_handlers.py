@@ -13,15 +13,21 @@ import csv
 import sys
 import uuid
 import json
+import logging
 from collections import defaultdict
 
 from trapi_model.biolink.constants import *
 
 from chp_data.bkb_handler import BkbDataHandler
 
+from chp.result_cache import get_result, set_result
+from chp.response_builder import add_provenance_attributes
+
 from chp.mixins.trapi_handler.default_handler_mixin import DefaultHandlerMixin
 from chp.mixins.trapi_handler.wildcard_handler_mixin import WildCardHandlerMixin
-from chp.mixins.trapi_handler.one_hop_handler_mixin import OneHopHandlerMixin
+from chp.mixins.trapi_handler.one_hop_handler_mixin import OneHopHandlerMixin, MAX_RESULT_WINDOW, TWO_HOP_CANDIDATES
+
+logger = logging.getLogger(__name__)
 
 # Base TRAPI Handler
 
@@ -38,6 +44,16 @@ class BaseHandler:
         :param max_results: specific to 1-hop queries, specifies the number of
             wildcard genes to return.
         :type max_results: int
+        :param curies: already loaded curies dictionary (as read from the bkb handler curies path)
+            or the chp.curie_store.CurieStore of that file. If None, the curies are read in from
+            the bkb handler.
+        :type curies: dict
+        :param reasoner_pool: a pool of pre-forked reasoning workers. If passed, batches of queries
+            are run on the pool instead of one after another.
+        :type reasoner_pool: chp.reasoner_pool.ReasonersPool
+        :param result_cache: a cache of reasoning results shared across requests. Only used by
+            handlers that implement _get_result_key.
+        :type result_cache: chp.result_cache.ResultCache
     """
 
     def __init__(self,
@@ -46,7 +62,10 @@ class BaseHandler:
                  bkb_handler=None,
                  joint_reasoner=None,
                  dynamic_reasoner=None,
-                 max_results=10):
+                 max_results=10,
+                 curies=None,
+                 reasoner_pool=None,
+                 result_cache=None):
         # Instantiate handler is one was not passed
         if bkb_handler is None:
             self.bkb_data_handler = BkbDataHandler(
@@ -63,14 +82,31 @@ class BaseHandler:
         self.max_results = max_results
         self.joint_reasoner = joint_reasoner
         self.dynamic_reasoner = dynamic_reasoner
+        self.reasoner_pool = reasoner_pool
+        self.result_cache = result_cache
 
         # Run specific handler setup
         self._setup_handler()
 
         # Read in curies
-        with open(self.bkb_data_handler.curies_path, 'r') as f_:
-            self.curies = json.load(f_)
+        if curies is None:
+            with open(self.bkb_data_handler.curies_path, 'r') as f_:
+                curies = json.load(f_)
+        self.curies = curies
     
+    @classmethod
+    def get_reasoning_handler(cls, joint_reasoner=None, dynamic_reasoner=None, max_results=10):
+        """ Returns a bare handler that only holds what _run_query needs. Used by reasoner pool
+        workers, which run queries built by a fully setup handler in the parent process.
+        """
+        handler = cls.__new__(cls)
+        handler.joint_reasoner = joint_reasoner
+        handler.dynamic_reasoner = dynamic_reasoner
+        handler.max_results = max_results
+        handler.reasoner_pool = None
+        handler.result_cache = None
+        return handler
+
     @staticmethod
     def check_predicate_support(predicate1, predicate2, support_inverse=True):
         if predicate1 == predicate2:
@@ -120,13 +156,75 @@ class BaseHandler:
         """
         pass
 
+    def _get_result_key(self, chp_query, query_type):
+        """ This method can be overwritten by a specific handler to return a hashable key that
+            identifies the result of a built query, which enables result caching and coalescing
+            of identical queries. It is called before the query is run.
+        """
+        return None
+
+    def _get_tasks(self):
+        tasks = []
+        for message_type, chp_queries in self.chp_query_dict.items():
+            for chp_query in chp_queries:
+                tasks.append((chp_query, message_type))
+        return tasks
+
+    def _iter_run_queries(self, tasks):
+        """ Runs (chp_query, query_type) tasks and yields each ran query in task order as soon
+        as it is finished. Results found in the result cache are not run again and queries with
+        the same result key are only run once. If the handler has a reasoner pool, the
+        remaining queries are spread over its workers.
+        """
+        result_keys = []
+        results = {}
+        looked_up_keys = set()
+        for chp_query, message_type in tasks:
+            result_key = self._get_result_key(chp_query, message_type)
+            if result_key is not None and result_key not in looked_up_keys and self.result_cache is not None:
+                looked_up_keys.add(result_key)
+                result = self.result_cache.get(result_key)
+                if result is not None:
+                    results[result_key] = result
+            result_keys.append(result_key)
+        # Run each query that was not cached once
+        run_idxs = []
+        run_keys = set()
+        for idx, result_key in enumerate(result_keys):
+            if result_key is None:
+                run_idxs.append(idx)
+            elif result_key not in results and result_key not in run_keys:
+                run_idxs.append(idx)
+                run_keys.add(result_key)
+        run_tasks = [tasks[idx] for idx in run_idxs]
+        logger.info('Running {} of {} queries.'.format(len(run_tasks), len(tasks)))
+        if self.reasoner_pool is not None and len(run_tasks) > 1:
+            run_chp_queries = self.reasoner_pool.imap_queries(type(self), run_tasks, self.max_results)
+        else:
+            run_chp_queries = (self._run_query(chp_query, message_type) for chp_query, message_type in run_tasks)
+        run_idxs = set(run_idxs)
+        # Fan cached and coalesced results out to their queries. The first query of a result
+        # key always comes before its duplicates, so its result is known by then.
+        for idx, (chp_query, message_type) in enumerate(tasks):
+            result_key = result_keys[idx]
+            if idx in run_idxs:
+                chp_query = next(run_chp_queries)
+                if result_key is not None:
+                    results[result_key] = get_result(chp_query)
+                    if self.result_cache is not None:
+                        self.result_cache.set(result_key, results[result_key])
+            else:
+                chp_query = set_result(chp_query, results[result_key])
+            yield chp_query
+
     def run_queries(self):
         """ Runs built BKB query(s) in correspondence with the handlers _run_query function.
+        See _iter_run_queries.
         """
         self.results = defaultdict(list)
-        for message_type, chp_queries in self.chp_query_dict.items():
-            for chp_query in chp_queries:
-                self.results[message_type].append(self._run_query(chp_query, message_type))
+        tasks = self._get_tasks()
+        for chp_query, (_, message_type) in zip(self._iter_run_queries(tasks), tasks):
+            self.results[message_type].append(chp_query)
 
     def construct_trapi_responses(self):
         """ Constructs the trapi responses for each query in correspondance with each handlers
@@ -135,14 +233,26 @@ class BaseHandler:
         responses = []
         for (query_type, chp_queries), (_, queries) in zip(self.results.items(), self.queries_dict.items()):
             for chp_query, query in zip(chp_queries, queries):
-                # Construct Message
-                _response = self._construct_trapi_message(chp_query, query, query_type)
-                # Add provenance
-                _response = self.add_provenance_attributes(_response)
-                # Add to list of responses
-                responses.append(_response)
+                responses.append(self._construct_trapi_response(chp_query, query, query_type))
         return responses
 
+    def _construct_trapi_response(self, chp_query, query, query_type):
+        # Construct Message
+        _response = self._construct_trapi_message(chp_query, query, query_type)
+        # Add provenance
+        return self.add_provenance_attributes(_response)
+
+    def iter_responses(self):
+        """ Runs the built queries and yields each constructed trapi response, in the same order
+        as construct_trapi_responses, as soon as its query is finished.
+        """
+        self.results = defaultdict(list)
+        tasks = self._get_tasks()
+        queries = [query for _, _queries in self.queries_dict.items() for query in _queries]
+        for chp_query, (_, query_type), query in zip(self._iter_run_queries(tasks), tasks, queries):
+            self.results[query_type].append(chp_query)
+            yield self._construct_trapi_response(chp_query, query, query_type)
+
     def merge_messages(self, responses):
         new_query = self.query.get_copy()
         master_message = new_query.message
@@ -155,32 +265,7 @@ class BaseHandler:
         """ Adds CHP and TCGA provenance attributes to every edge in the knowledge graph.
         """
         for kedge_id, kedge in query.message.knowledge_graph.edges.items():
-            # Add CHP InfoRes Attribute
-            kedge.add_attribute(
-                    attribute_type_id=BIOLINK_PRIMARY_KNOWLEDGE_SOURCE_ENTITY.get_curie(),
-                    value='infores:connections-hypothesis',
-                    value_type_id=BIOLINK_INFORMATION_RESOURCE_ENTITY.get_curie(),
-                    value_url='http://chp.thayer.dartmouth.edu',
-                    description='The Connections Hypothesis Provider from NCATS Translator.',
-                    attribute_source='infores:connections-hypothesis',
-                    )
-            # Add TCGA Supporting Data Source Attribute
-            kedge.add_attribute(
-                    attribute_type_id=BIOLINK_SUPPORTING_DATA_SOURCE_ENTITY.get_curie(),
-                    value='infores:tcga',
-                    value_type_id=BIOLINK_INFORMATION_RESOURCE_ENTITY.get_curie(),
-                    value_url='https://portal.gdc.cancer.gov/',
-                    description='The Cancer Genome Atlas provided by the GDC Data Portal.',
-                    attribute_source='infores:gdc',
-                    )
-            kedge.add_attribute(
-                    attribute_type_id=BIOLINK_SUPPORTING_DATA_SOURCE_ENTITY.get_curie(),
-                    value='infores:tcga',
-                    value_type_id=BIOLINK_INFORMATION_RESOURCE_ENTITY.get_curie(),
-                    value_url='https://di2ag.github.io/chp/chp_documentation#chp-single-hop-contribution-analysis',
-                    description='Documents how Connections Hypothesis Provider builds ranked contribution values over tcga data.',
-                    attribute_source='infores:connections-hypothesis',
-                    )
+            add_provenance_attributes(kedge)
         return query
 
     def _get_curie_name(self, entity_type, curie):
@@ -208,8 +293,17 @@ class OneHopHandler(OneHopHandlerMixin, BaseHandler):
             joint_reasoner=None,
             dynamic_reasoner=None,
             max_results=10,
+            curies=None,
+            reasoner_pool=None,
+            result_cache=None,
+            query_plans=None,
+            max_result_window=None,
+            two_hop_candidates=None,
             ):
         self.queries = queries
+        self.query_plans = query_plans
+        self.max_result_window = max_result_window if max_result_window is not None else MAX_RESULT_WINDOW
+        self.two_hop_candidates = two_hop_candidates if two_hop_candidates is not None else TWO_HOP_CANDIDATES
 
         super(OneHopHandler, self).__init__(
             hosts_filename=hosts_filename,
@@ -218,4 +312,7 @@ class OneHopHandler(OneHopHandlerMixin, BaseHandler):
             joint_reasoner=joint_reasoner,
             dynamic_reasoner=dynamic_reasoner,
             max_results=max_results,
+            curies=curies,
+            reasoner_pool=reasoner_pool,
+            result_cache=result_cache,
             )
@@ -23,6 +23,8 @@ from chp_utils.conflation import ConflationMap
 from chp_utils.curie_database import CurieDatabase
 
 from chp.trapi_handlers import BaseHandler, OneHopHandler
+from chp.query_plan import QueryPlans, compile_query_graph
+from chp.meta_kg_index import MetaKnowledgeGraphIndex
 from chp.exceptions import *
 
 # Setup logging
@@ -37,7 +39,35 @@ class TrapiInterface:
                  joint_reasoner=None,
                  dynamic_reasoner=None,
                  trapi_version='1.2',
+                 base_handler=None,
+                 curies_db=None,
+                 meta_knowledge_graph=None,
+                 meta_kg_index=None,
+                 conflation_map=None,
+                 curie_store=None,
+                 reasoner_pool=None,
+                 result_cache=None,
+                 node_normalizer=None,
+                 max_result_window=None,
+                 two_hop_candidates=None,
                 ):
+        """ Interface between TRAPI queries and the CHP handlers.
+
+            The base handler, curies database, meta knowledge graph and conflation map are
+            immutable across requests, so they can be passed in already loaded (see
+            chp.app_interface.TrapiInterfaceRegistry). Anything not passed is loaded from
+            the bkb handler paths. The meta_kg_index is the MetaKnowledgeGraphIndex of the
+            meta knowledge graph and is built here if not passed. The curie_store is the
+            chp.curie_store.CurieStore of the bkb_handler curies. If passed, it is used to
+            validate query curies and is handed to each query handler for curie names, so neither
+            parses the curies file and the curies database is only loaded if it is requested.
+            If a reasoner_pool is passed, query handlers run their batches on it, and a passed
+            result_cache is shared by the query handlers across requests. If a node_normalizer
+            (chp.node_normalizer.NodeNormalizer) is passed, curies with unsupported prefixes
+            are normalized to supported curies before the queries are processed.
+            max_result_window and two_hop_candidates bound the paging and set the two hop
+            candidate depth of one-hop queries, see chp.trapi_handlers.OneHopHandler.
+        """
         self.hosts_filename = hosts_filename
         self.num_processes_per_host = num_processes_per_host
         self.bkb_handler = bkb_handler
@@ -46,16 +76,41 @@ class TrapiInterface:
         self.trapi_version = trapi_version
 
         # Get base handler for processing curies and meta kg requests
-        self.base_handler = self._get_handler()
-        self.curies_db = self._get_curies()
-        self.curies = self.curies_db.curies
-        self.meta_knowledge_graph = self._get_meta_knowledge_graph()
-        self.conflation_map = self._get_conflation_map()
+        if base_handler is None:
+            base_handler = self._get_handler()
+        self.base_handler = base_handler
+        self._curies_db = curies_db
+        self.curie_store = curie_store
+        if curie_store is not None:
+            self.curies = curie_store
+        else:
+            self.curies = self.curies_db.curies
+        if meta_knowledge_graph is None:
+            meta_knowledge_graph = self._get_meta_knowledge_graph()
+        self.meta_knowledge_graph = meta_knowledge_graph
+        if meta_kg_index is None:
+            meta_kg_index = MetaKnowledgeGraphIndex(self.meta_knowledge_graph)
+        self.meta_kg_index = meta_kg_index
+        if conflation_map is None:
+            conflation_map = self._get_conflation_map()
+        self.conflation_map = conflation_map
+        self.reasoner_pool = reasoner_pool
+        self.result_cache = result_cache
+        self.node_normalizer = node_normalizer
+        self.max_result_window = max_result_window
+        self.two_hop_candidates = two_hop_candidates
+
+        # Curies replaced by the node normalizer, see _node_normalize_queries
+        self.node_normalizer_mappings = {}
+        self.node_normalizer_inverse_mappings = {}
 
         # Initialize interface level logger
         self.logger = TrapiLogger()
 
     def setup_trapi_queries(self, trapi_queries):
+        # Normalize unsupported curies of all queries at once
+        if self.node_normalizer is not None:
+            self._node_normalize_queries(trapi_queries)
         # Setup messages
         self.queries_dict = self._setup_messages(trapi_queries)
         # Initialize necessary handlers
@@ -66,10 +121,13 @@ class TrapiInterface:
 
     def _setup_messages(self, queries):
         queries_dict = defaultdict(list)
+        # Compiled query graph plans of the queries, see chp.query_plan
+        self.query_plans = QueryPlans()
         for query in queries:
             try:
-                message_type = self._determine_message_type(query.message)
+                message_type, plan = self._determine_message_type(query.message)
                 queries_dict[message_type].append(query)
+                self.query_plans.set(query, plan)
             except Exception as ex:
                 self.logger.debug(f'CHP core could not process derived query. {str(ex)}. Derived query graph: {query.message.query_graph.to_dict()}')
         # Check if any queries where setup/processed.
@@ -78,47 +136,24 @@ class TrapiInterface:
         return queries_dict
 
     def _get_biolink_entity_if_supported_prefix(self, curie_prefix):
-        for biolink_entity, meta_node in self.meta_knowledge_graph.nodes.items():
-            if curie_prefix in meta_node.id_prefixes:
-                return biolink_entity
-        return None
+        return self.meta_kg_index.get_entity(curie_prefix)
 
     def _get_more_specific_biolink_entity(self, *biolink_entities):
-        unsorted_entities = []
-        for entity in biolink_entities:
-            unsorted_entities.append((len(entity.get_ancestors()), entity))
-        return sorted(unsorted_entities, reverse=True)[0][1]
+        return self.meta_kg_index.get_more_specific_entity(*biolink_entities)
 
     def _get_preferred_curie(self, normalized_node_dict):
-        biolink_entities = normalized_node_dict["types"]
-        normalized_curie_list = normalized_node_dict["equivalent_identifiers"]
-        supported_biolink_entity = set.intersection(
-                *[
-                    set(biolink_entities),
-                    set(self.meta_knowledge_graph.nodes.keys()),
-                    ]
-            )
-        # Biolink category isn't supported
-        if len(supported_biolink_entity) == 0:
-            return None
-        # If multiple supported biolink categories take the most specific.
-        if len(supported_biolink_entity) > 1:
-            supported_biolink_entity = self._get_more_specific_biolink_entity(*supported_biolink_type)
-        # If there is only one supported entity just take that.
-        else:
-            supported_biolink_entity = supported_biolink_entity[0]
-        preferred_prefix = self.meta_knowledge_graph.nodes[supported_biolink_entity].id_prefixes[0]
-        for curie in normalized_curie_list:
-            prefix = curie.split(':')[0]
-            if prefix == preferred_prefix:
-                return curie
-        return None
-
-    def _node_normalize_message(self, message):
-        client = SriNodeNormalizerApiClient()
-        # Collect node curies that need to be normalized
+        return self.meta_kg_index.get_preferred_curie(normalized_node_dict)
+
+    def _get_unsupported_curies(self, message):
+        """ Returns the node curies of a message whose prefix CHP does not support. Also aligns
+        the categories of supported nodes with the deduced biolink entity.
+        """
         node_curies = []
-        for node_id, node in message.query_graph.items():
+        if message is None:
+            return node_curies
+        for node_id, node in message.query_graph.nodes.items():
+            if node.ids is None:
+                continue
             # Grab curie prefix
             node_prefix = node.ids[0].split(':')[0]
             # Check CHP support
@@ -127,92 +162,87 @@ class TrapiInterface:
             if curie_biolink_entity is None:
                 node_curies.append(node.ids[0])
             # Check query category and supported category alignment
+            elif node.categories is None:
+                self.logger.info('Interpretting node: {} as having category {}.'.format(node_id, curie_biolink_entity.get_curie()))
+                node.categories = [curie_biolink_entity]
             elif curie_biolink_entity != node.categories[0]:
-                if node.categories is None:
-                    self.query.info('Interpretting node: {} as having category {}.'.format(node_id, curie_biolink_entity.get_curie()))
-                else:
-                    self.query.info(
-                            'Mismatch in passed category for node {}. \
-                                    Passed {} but deduced {}. Using deduced \
-                                    category {} for reasoning.'.format(
-                                        node_id,
-                                        node.categories[0].get_curie(),
-                                        curie_biolink_entity.get_curie(),
-                                        curie_biolink_entity.get_curie(),
-                                        )
+                self.logger.info(
+                        'Mismatch in passed category for node {}. \
+                                Passed {} but deduced {}. Using deduced \
+                                category {} for reasoning.'.format(
+                                    node_id,
+                                    node.categories[0].get_curie(),
+                                    curie_biolink_entity.get_curie(),
+                                    curie_biolink_entity.get_curie(),
                                     )
+                                )
                 node.categories[0] = curie_biolink_entity
+        return node_curies
+
+    def _node_normalize_queries(self, queries):
+        """ Normalizes the unsupported curies of all queries with a single node normalizer call.
+        The normalized curies of each message are mapped back to the passed curies in its
+        response, see _restore_node_normalized_curies.
+        """
+        self.node_normalizer_mappings = {}
+        self.node_normalizer_inverse_mappings = {}
+        message_curies = [self._get_unsupported_curies(query.message) for query in queries]
+        node_curies = list(itertools.chain.from_iterable(message_curies))
         if len(node_curies) == 0:
-            return message
+            return queries
         # Query the Node Normalizer
-        normalized_nodes = client.get_normalized_nodes(node_curies)
+        normalized_nodes = self.node_normalizer.get_normalized_nodes(node_curies)
+        for query, curies in zip(queries, message_curies):
+            if len(curies) > 0:
+                self._node_normalize_message(query.message, {curie: normalized_nodes.get(curie) for curie in curies})
+        return queries
+
+    def _node_normalize_message(self, message, normalized_nodes):
+        # Inverse mappings are kept per message, as the same normalized curie may stand for
+        # different passed curies in different queries. The message is referenced next to its
+        # mappings, so its id can not be reused by another object.
+        inverse_mappings = {}
         for origin_curie, normalized_node_dict in normalized_nodes.items():
+            if normalized_node_dict is None:
+                self.logger.info('Node normalizer does not know curie {}'.format(origin_curie))
+                continue
             normalized_preferred_curie = self._get_preferred_curie(normalized_node_dict)
             if normalized_preferred_curie is None:
-                self.query.info('Could not find a preferred curie in normalization of curie {}'.format(origin_curie))
+                self.logger.info('Could not find a preferred curie in normalization of curie {}'.format(origin_curie))
                 continue
             # Run Find and Replace over message
             message.find_and_replace(origin_curie, normalized_preferred_curie)
             # Save out curie mappings
             self.node_normalizer_mappings[origin_curie] = normalized_preferred_curie
-            self.node_normalizer_inverse_mappings[normalized_preferred_curie] = origin_curie
+            inverse_mappings[normalized_preferred_curie] = origin_curie
+        if len(inverse_mappings) > 0:
+            self.node_normalizer_inverse_mappings[id(message)] = (message, inverse_mappings)
         return message
 
+    def _restore_node_normalized_curies(self, response):
+        """ Replaces the normalized curies of a response message with the curies that were
+        passed in its query.
+        """
+        message = response.message
+        entry = self.node_normalizer_inverse_mappings.get(id(message))
+        if entry is None or entry[0] is not message:
+            return response
+        for normalized_curie, origin_curie in entry[1].items():
+            message.find_and_replace(normalized_curie, origin_curie)
+        return response
+
     def _determine_message_type(self, message):
         """ Currently only allows for one-hop queries between gene-drug, gene-disease and
-            drug-disease relationships.
+            drug-disease relationships. The query graph is compiled into a plan once here and
+            the handlers reuse that plan.
 
-            :returns: a query type (currently only onehops)
-            :rtype: string or None
+            :returns: a query type (currently only onehops) and the compiled query graph plan.
+            :rtype: tuple
         """
         if message is None:
             raise UnidentifiedQueryType
-        query_graph = message.query_graph
-
-        gene_nodes = []
-        disease_nodes = []
-        drug_nodes = []
-        wildcard_node_count = 0
-        wildcard_node = None
-
-        if message is not None:
-            qg = message.query_graph
-            for node_id, node in qg.nodes.items():
-               if node.categories is not None:
-                    if node.categories[0] == BIOLINK_GENE_ENTITY:
-                        gene_nodes.append(node_id)
-                        if node.ids is None:
-                            wildcard_node_count += 1
-                            wildcard_node = node_id
-                        else:
-                            for curie in node.ids:
-                                if curie in self.curies[BIOLINK_GENE_ENTITY]:
-                                    qg.nodes[node_id].set_ids(curie)
-                                else:
-                                    raise(UnidentifiedGeneCurie(node.ids))
-                    elif node.categories[0] == BIOLINK_DRUG_ENTITY:
-                        drug_nodes.append(node_id)
-                        if node.ids is None:
-                            wildcard_node_count += 1
-                            wildcard_node = node_id
-                        else:
-                            for curie in node.ids:
-                                if curie in self.curies[BIOLINK_DRUG_ENTITY]:
-                                    qg.nodes[node_id].set_ids(curie)
-                                else:
-                                    raise(UnidentifiedDrugCurie(node.ids))
-                    elif node.categories[0] == BIOLINK_DISEASE_ENTITY:
-                        disease_nodes.append(node_id)
-
-            num_total_nodes = len(gene_nodes) + len(disease_nodes) + len(drug_nodes)
-
-            if wildcard_node_count > 1:
-                raise(TooManyContributionNodes)
-
-            if num_total_nodes == 2:
-                return 'onehop'
-            else:
-                raise(UnidentifiedQueryType)
+        plan = compile_query_graph(message.query_graph, curies=self.curies)
+        return 'onehop', plan
 
     def get_conflation_map(self):
         return self.conflation_map
@@ -220,6 +250,12 @@ class TrapiInterface:
     def _get_conflation_map(self):
         return ConflationMap(conflation_map_filename=self.bkb_handler.conflation_map_path)
 
+    @property
+    def curies_db(self):
+        if self._curies_db is None:
+            self._curies_db = self._get_curies()
+        return self._curies_db
+
     def get_curies(self):
         return self.curies_db
 
@@ -264,6 +300,12 @@ class TrapiInterface:
                 bkb_handler=self.bkb_handler,
                 joint_reasoner=self.joint_reasoner,
                 dynamic_reasoner=self.dynamic_reasoner,
+                curies=self.curie_store,
+                reasoner_pool=self.reasoner_pool,
+                result_cache=self.result_cache,
+                query_plans=self.query_plans,
+                max_result_window=self.max_result_window,
+                two_hop_candidates=self.two_hop_candidates,
             )
         elif message_type is None:
             return BaseHandler()
@@ -301,8 +343,17 @@ class TrapiInterface:
         responses = []
         for message_type, handler in self.handlers.items():
             logger.info('Constructing TRAPI response(s) for {} type message(s).'.format(message_type))
-            responses.extend(handler.construct_trapi_responses())
+            responses.extend(self._restore_node_normalized_curies(response) for response in handler.construct_trapi_responses())
         return responses
 
+    def iter_trapi_responses(self):
+        """ Runs the built CHP queries and yields each trapi response as soon as it is
+        constructed. Replaces run_chp_queries followed by construct_trapi_responses.
+        """
+        for message_type, handler in self.handlers.items():
+            logger.info('Streaming TRAPI response(s) for {} type message(s).'.format(message_type))
+            for response in handler.iter_responses():
+                yield self._restore_node_normalized_curies(response)
+
     def get_name(self):
         return 'chp_core'
@@ -1,3 +1,13 @@
 from django.shortcuts import render
+from django.http import StreamingHttpResponse
+
+from chp.app_interface import iter_serialized_response
 
 # Create your views here.
+
+def get_streaming_response(consistent_queries):
+    """ Returns a response that streams the TRAPI responses of the consistent queries as
+    newline delimited JSON while they are reasoned over, see
+    chp.app_interface.iter_serialized_response.
+    """
+    return StreamingHttpResponse(iter_serialized_response(consistent_queries), content_type='application/x-ndjson')
@@ -10,7 +10,8 @@ __version__ = re.search(r'__version__\s*=\s*[\'"]([0-9]*\.[0-9]*\.[0-9]*)[\'"]',
                         io.open('chp/_version.py', encoding='utf_8_sig').read()).group(1)
 
 REQUIRED_PACKAGES = [
-    'pybkb'
+    'pybkb',
+    'scipy',
 ]
 
 setup(
@@ -0,0 +1,27 @@
+import random
+
+
+def get_gene_curies(num_genes):
+    return ['ENSEMBL:ENSG{}'.format(i) for i in range(num_genes)]
+
+def get_drug_curies(num_drugs):
+    return ['CHEMBL.COMPOUND:CHEMBL{}'.format(i) for i in range(num_drugs)]
+
+def make_raw_patient_data(num_patients=150, num_genes=6, num_drugs=4, curie_prob=0.4, seed=0):
+    """ Returns random raw patient data of the form {patient: {"survival_time": days,
+    "gene_curies": [...], "drug_curies": [...]}}, keyed by integer patient ids.
+    """
+    rng = random.Random(seed)
+    genes = get_gene_curies(num_genes)
+    drugs = get_drug_curies(num_drugs)
+    return {
+            patient: {
+                "survival_time": rng.randint(0, 3000),
+                "gene_curies": [gene for gene in genes if rng.random() < curie_prob],
+                "drug_curies": [drug for drug in drugs if rng.random() < curie_prob],
+                }
+            for patient in range(num_patients)
+            }
+
+def has_curie(patient_data, curie):
+    return curie in patient_data["gene_curies"] or curie in patient_data["drug_curies"]
@@ -0,0 +1,106 @@
+import unittest
+import threading
+import time
+from unittest import mock
+
+from chp import app_interface
+
+
+class StubLogger:
+
+    def __init__(self, name):
+        self.name = name
+
+    def to_dict(self):
+        return [{"message": self.name}]
+
+
+class StubInterface:
+    """ Disease interface that records the threads its stages ran in and can fail at a stage.
+    """
+    def __init__(self, name, fail_stage=None, reasoning_time=0, reasoner_pool=None):
+        self.name = name
+        self.fail_stage = fail_stage
+        self.reasoning_time = reasoning_time
+        self.reasoner_pool = reasoner_pool
+        self.logger = StubLogger(name)
+        self.threads = []
+
+    def _run_stage(self, stage):
+        self.threads.append(threading.current_thread())
+        if self.fail_stage == stage:
+            raise ValueError('{} failed at {}'.format(self.name, stage))
+
+    def setup_trapi_queries(self, queries):
+        self._run_stage('setup')
+
+    def build_chp_queries(self):
+        self._run_stage('build')
+
+    def run_chp_queries(self):
+        time.sleep(self.reasoning_time)
+        self._run_stage('reasoning')
+
+    def construct_trapi_responses(self):
+        return ['{} response'.format(self.name)]
+
+
+def get_response(interfaces, max_workers=2):
+    interface_dict = {interface: ['query'] for interface in interfaces}
+    with mock.patch.object(app_interface, 'setup_queries_based_on_disease_interfaces', return_value=interface_dict):
+        return app_interface.get_response(['query'], max_workers=max_workers)
+
+
+class TestGetResponse(unittest.TestCase):
+
+    def test_interface_order(self):
+        # The slower first interface still comes first
+        interfaces = [
+                StubInterface('brca', reasoning_time=0.05, reasoner_pool='pool'),
+                StubInterface('gbm', reasoner_pool='pool'),
+                ]
+        responses, app_logs, status, description = get_response(interfaces)
+        self.assertEqual(status, 'Success')
+        self.assertEqual(responses, ['brca response', 'gbm response'])
+        self.assertEqual(app_logs, [{"message": 'brca'}, {"message": 'gbm'}])
+        self.assertNotIn(threading.current_thread(), interfaces[0].threads + interfaces[1].threads)
+
+    def test_serial_without_reasoner_pool(self):
+        interfaces = [StubInterface('brca'), StubInterface('gbm')]
+        responses, _, status, _ = get_response(interfaces)
+        self.assertEqual(responses, ['brca response', 'gbm response'])
+        for interface in interfaces:
+            self.assertEqual(set(interface.threads), {threading.current_thread()})
+
+    def test_error_precedence(self):
+        for reasoner_pool in [None, 'pool']:
+            # The earliest failing stage is reported, whichever interface it failed in
+            interfaces = [
+                    StubInterface('brca', fail_stage='reasoning', reasoner_pool=reasoner_pool),
+                    StubInterface('gbm', fail_stage='build', reasoner_pool=reasoner_pool),
+                    ]
+            responses, app_logs, status, description = get_response(interfaces)
+            self.assertEqual(responses, [])
+            self.assertEqual(status, 'Bad request. See description.')
+            self.assertEqual(description, 'Problem during CHP query building. gbm failed at build')
+            self.assertEqual(app_logs, [{"message": 'brca'}, {"message": 'gbm'}])
+
+            interfaces = [
+                    StubInterface('brca', fail_stage='reasoning', reasoner_pool=reasoner_pool),
+                    StubInterface('gbm', fail_stage='setup', reasoner_pool=reasoner_pool),
+                    ]
+            responses, app_logs, status, description = get_response(interfaces)
+            self.assertEqual(description, 'Problem during interface setup. gbm failed at setup')
+            self.assertEqual(app_logs, [])
+
+            interfaces = [
+                    StubInterface('brca', reasoner_pool=reasoner_pool),
+                    StubInterface('gbm', fail_stage='reasoning', reasoner_pool=reasoner_pool),
+                    ]
+            responses, app_logs, status, description = get_response(interfaces)
+            self.assertEqual(status, 'Unexpected error. See description.')
+            self.assertEqual(description, 'Problem during reasoning. gbm failed at reasoning')
+
+
+if __name__ == '__main__':
+    unittest.main()
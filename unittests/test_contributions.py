@@ -0,0 +1,122 @@
+import unittest
+import tempfile
+import random
+import os
+from collections import defaultdict
+
+from patient_data_fixtures import make_raw_patient_data
+from chp.patient_index import PatientBitsetIndex, write_patient_index
+from chp.contributions import ContributionMatrix, PatientCurieMatrix, get_normalization_weight, to_relative_contributions, get_top_k_indices, rank_wildcard_contributions
+
+TRUTH_TARGET = ('EFO:0000714', '>= 978')
+FALSE_TARGET = ('EFO:0000714', '< 978')
+CONTRIBUTIONS = {
+        TRUTH_TARGET: {
+            ('ENSEMBL:ENSG1', 'True'): 0.2,
+            ('ENSEMBL:ENSG2', 'True'): 0.1,
+            ('ENSEMBL:ENSG2', 'False'): 0.5,
+            },
+        FALSE_TARGET: {
+            ('ENSEMBL:ENSG2', 'True'): 0.3,
+            ('ENSEMBL:ENSG3', 'True'): 0.4,
+            },
+        }
+
+
+class TestContributionMatrix(unittest.TestCase):
+
+    def test_relative_contributions(self):
+        truth_prob, false_prob = 0.4, 0.6
+        matrix = ContributionMatrix.from_joint_contributions(CONTRIBUTIONS)
+        relative = to_relative_contributions(
+                matrix.curies,
+                matrix.get_relative(TRUTH_TARGET, get_normalization_weight(truth_prob), get_normalization_weight(false_prob)),
+                )
+        self.assertEqual(set(relative), {'ENSEMBL:ENSG1', 'ENSEMBL:ENSG2', 'ENSEMBL:ENSG3'})
+        self.assertAlmostEqual(relative['ENSEMBL:ENSG1']['relative'], 0.2 / truth_prob)
+        self.assertAlmostEqual(relative['ENSEMBL:ENSG2']['relative'], 0.1 / truth_prob - 0.3 / false_prob)
+        self.assertAlmostEqual(relative['ENSEMBL:ENSG3']['relative'], -0.4 / false_prob)
+
+    def test_zero_normalization(self):
+        matrix = ContributionMatrix.from_joint_contributions(CONTRIBUTIONS)
+        relative = matrix.get_relative(TRUTH_TARGET, get_normalization_weight(0), get_normalization_weight(0.5))
+        self.assertAlmostEqual(relative[matrix.curies.index('ENSEMBL:ENSG1')], 0)
+        self.assertAlmostEqual(relative[matrix.curies.index('ENSEMBL:ENSG3')], -0.8)
+
+    def test_patient_contributions(self):
+        raw_patient_data = {
+                1: {"gene_curies": ['ENSEMBL:ENSG1', 'ENSEMBL:ENSG2']},
+                2: {"gene_curies": ['ENSEMBL:ENSG2']},
+                }
+        patient_contributions = {TRUTH_TARGET: {1: 0.25, 2: 0.5}, FALSE_TARGET: {2: 0.25}}
+        matrix = ContributionMatrix.from_patient_contributions(patient_contributions, raw_patient_data, 'gene_curies')
+        expected = defaultdict(lambda: defaultdict(int))
+        for target, patient_contribs in patient_contributions.items():
+            for patient, contrib in patient_contribs.items():
+                for curie in raw_patient_data[patient]["gene_curies"]:
+                    expected[curie][target] += contrib
+        for row, curie in enumerate(matrix.curies):
+            for col, target in enumerate(matrix.targets):
+                self.assertAlmostEqual(matrix.values[row, col], expected[curie][target])
+
+    def test_patient_curie_matrix(self):
+        random.seed(1)
+        raw_patient_data = make_raw_patient_data(num_patients=50, num_genes=20, curie_prob=0.15, seed=1)
+        patients = list(range(40))
+        # Contributing patients come in another order than the dataset
+        random.shuffle(patients)
+        patient_contributions = {
+                TRUTH_TARGET: {patient: random.random() for patient in patients[:30]},
+                FALSE_TARGET: {patient: random.random() for patient in patients[20:]},
+                }
+        expected = ContributionMatrix.from_patient_contributions(patient_contributions, raw_patient_data, 'gene_curies')
+        matrix = PatientCurieMatrix(raw_patient_data, 'gene_curies').get_contribution_matrix(patient_contributions)
+        # Curies keep the order the loops first see them in, which ties are ranked by
+        self.assertEqual(matrix.curies, expected.curies)
+        self.assertEqual(matrix.targets, expected.targets)
+        for row in range(len(matrix.curies)):
+            for col in range(len(matrix.targets)):
+                self.assertAlmostEqual(matrix.values[row, col], expected.values[row, col])
+        self.assertEqual(
+                [curie for _, curie in rank_wildcard_contributions(to_relative_contributions(matrix.curies, matrix.get_relative(TRUTH_TARGET, 1, 1)))],
+                [curie for _, curie in rank_wildcard_contributions(to_relative_contributions(expected.curies, expected.get_relative(TRUTH_TARGET, 1, 1)))],
+                )
+
+    def test_patient_index_curie_matrix(self):
+        random.seed(2)
+        raw_patient_data = make_raw_patient_data(num_patients=50, num_genes=20, curie_prob=0.15, seed=2)
+        raw_patient_data[3]["drug_curies"] *= 2
+        patient_index = PatientBitsetIndex(raw_patient_data)
+        for curies_key in ['gene_curies', 'drug_curies']:
+            patient_contributions = {TRUTH_TARGET: {patient: random.random() for patient in random.sample(range(50), 30)}}
+            expected = PatientCurieMatrix(raw_patient_data, curies_key).get_contribution_matrix(patient_contributions)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                patient_index_path = write_patient_index(os.path.join(tmp_dir, 'patient_index'), patient_index)
+                shared_index = PatientBitsetIndex.attach(patient_index_path)
+                patient_curie_matrix = PatientCurieMatrix.from_patient_index(shared_index, curies_key)
+                # The matrix is built on the mapped arrays
+                self.assertFalse(patient_curie_matrix.matrix.indices.flags.writeable)
+                matrix = patient_curie_matrix.get_contribution_matrix(patient_contributions)
+                self.assertEqual(matrix.curies, expected.curies)
+                self.assertEqual(matrix.values.tolist(), expected.values.tolist())
+                del patient_curie_matrix, shared_index
+
+    def test_empty(self):
+        matrix = ContributionMatrix.from_joint_contributions({})
+        self.assertEqual(len(matrix.get_relative(TRUTH_TARGET, 1, 1)), 0)
+
+    def test_top_k(self):
+        random.seed(0)
+        # Few distinct values so there are many ties
+        wildcard_contributions = {'curie{}'.format(i): {'relative': random.choice([-0.5, -0.25, 0, 0.25, 0.5])} for i in range(200)}
+        unsorted_wildcard_contributions = [(contrib_dict['relative'], wildcard) for wildcard, contrib_dict in wildcard_contributions.items()]
+        sorted_wildcard_contributions = sorted(unsorted_wildcard_contributions, key=lambda x: abs(x[0]), reverse=True)
+        for k in [0, 1, 10, 73, 200, 500, None]:
+            expected = sorted_wildcard_contributions if k is None else sorted_wildcard_contributions[:k]
+            self.assertEqual(rank_wildcard_contributions(wildcard_contributions, k), expected)
+        self.assertEqual(list(get_top_k_indices([1, -3, 2], 2)), [1, 2])
+        self.assertEqual(rank_wildcard_contributions({}, 10), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
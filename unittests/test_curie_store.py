@@ -0,0 +1,78 @@
+import unittest
+import tempfile
+import json
+import os
+
+from chp.curie_store import load_curie_store, get_curie_store_path
+
+CURIES = {
+        "biolink:Gene": {
+            "ENSEMBL:ENSG00000133703": ["KRAS"],
+            "ENSEMBL:ENSG00000141510": ["TP53"],
+            "ENSEMBL:ENSG00000155657": ["TTN"],
+            },
+        "biolink:Drug": {
+            "CHEMBL.COMPOUND:CHEMBL83": ["TAMOXIFEN"],
+            },
+        "biolink:Disease": {},
+        }
+
+
+class TestCurieStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.curies_path = os.path.join(self.tmp_dir.name, 'curies.json')
+        with open(self.curies_path, 'w') as f_:
+            json.dump(CURIES, f_)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_lookups(self):
+        curie_store = load_curie_store(self.curies_path, self.tmp_dir.name)
+        for entity_curie, entity_curies in CURIES.items():
+            self.assertIn(entity_curie, curie_store)
+            self.assertEqual(len(curie_store[entity_curie]), len(entity_curies))
+            self.assertEqual(dict(curie_store[entity_curie].items()), entity_curies)
+            for curie, names in entity_curies.items():
+                self.assertIn(curie, curie_store[entity_curie])
+                self.assertEqual(curie_store[entity_curie][curie], names)
+        self.assertNotIn('ENSEMBL:ENSG00000000000', curie_store["biolink:Gene"])
+        self.assertNotIn('ENSEMBL:ENSG00000133703', curie_store["biolink:Drug"])
+        self.assertNotIn('ENSEMBL:ENSG00000133703', curie_store["biolink:Disease"])
+        with self.assertRaises(KeyError):
+            curie_store["biolink:Gene"]['ENSEMBL:ENSG00000000000']
+
+    def test_rebuild(self):
+        load_curie_store(self.curies_path, self.tmp_dir.name)
+        store_mtime = os.stat(get_curie_store_path(self.tmp_dir.name, self.curies_path)).st_mtime_ns
+        # An unchanged curies file reuses the store
+        load_curie_store(self.curies_path, self.tmp_dir.name)
+        self.assertEqual(os.stat(get_curie_store_path(self.tmp_dir.name, self.curies_path)).st_mtime_ns, store_mtime)
+        # A changed curies file rebuilds it
+        curies = dict(CURIES, **{"biolink:Drug": {"CHEMBL.COMPOUND:CHEMBL1": ["DRUG"]}})
+        with open(self.curies_path, 'w') as f_:
+            json.dump(curies, f_)
+        curie_store = load_curie_store(self.curies_path, self.tmp_dir.name)
+        self.assertIn('CHEMBL.COMPOUND:CHEMBL1', curie_store["biolink:Drug"])
+        self.assertNotIn('CHEMBL.COMPOUND:CHEMBL83', curie_store["biolink:Drug"])
+
+    def test_same_basename(self):
+        # Curies files of other configurations with the same basename get their own store
+        other_dir = os.path.join(self.tmp_dir.name, 'other')
+        os.makedirs(other_dir)
+        other_curies_path = os.path.join(other_dir, 'curies.json')
+        with open(other_curies_path, 'w') as f_:
+            json.dump({"biolink:Gene": {"ENSEMBL:ENSG00000000001": ["OTHER"]}}, f_)
+        store_dir = os.path.join(self.tmp_dir.name, 'stores')
+        os.makedirs(store_dir)
+        self.assertNotEqual(get_curie_store_path(store_dir, self.curies_path), get_curie_store_path(store_dir, other_curies_path))
+        curie_store = load_curie_store(self.curies_path, store_dir)
+        other_curie_store = load_curie_store(other_curies_path, store_dir)
+        self.assertIn('ENSEMBL:ENSG00000133703', curie_store["biolink:Gene"])
+        self.assertNotIn('ENSEMBL:ENSG00000133703', other_curie_store["biolink:Gene"])
+
+
+if __name__ == '__main__':
+    unittest.main()
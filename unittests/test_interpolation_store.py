@@ -0,0 +1,77 @@
+import unittest
+import tempfile
+import pickle
+import os
+
+from chp.interpolation_store import load_interpolation_table, get_interpolation_table_path
+
+INTERPOLATIONS = {
+        "CHEMBL.COMPOUND:CHEMBL83": {
+            "CHEMBL.COMPOUND:CHEMBL1": 0.5,
+            "CHEMBL.COMPOUND:CHEMBL2": 0.25,
+            },
+        "CHEMBL.COMPOUND:CHEMBL1": {
+            "CHEMBL.COMPOUND:CHEMBL83": 1.0,
+            },
+        "CHEMBL.COMPOUND:CHEMBL3": {},
+        }
+
+
+class TestInterpolationStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.interpolations_path = os.path.join(self.tmp_dir.name, 'drug_interpolations.pk')
+        with open(self.interpolations_path, 'wb') as f_:
+            pickle.dump(INTERPOLATIONS, f_)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_lookups(self):
+        table = load_interpolation_table(self.interpolations_path, self.tmp_dir.name)
+        self.assertEqual(len(table), len(INTERPOLATIONS))
+        self.assertEqual(dict(table.items()), INTERPOLATIONS)
+        for curie, neighbors in INTERPOLATIONS.items():
+            self.assertIn(curie, table)
+            self.assertEqual(table[curie], neighbors)
+            neighbor_ids, weights = table.get_neighbors(curie)
+            self.assertEqual([table.get_curie(neighbor_id) for neighbor_id in neighbor_ids], list(neighbors.keys()))
+            self.assertEqual(weights.tolist(), list(neighbors.values()))
+        # Neighbors without a row of their own are interned but not keys
+        self.assertNotIn('CHEMBL.COMPOUND:CHEMBL2', table)
+        self.assertIsNone(table.get('CHEMBL.COMPOUND:CHEMBL2'))
+        with self.assertRaises(KeyError):
+            table['CHEMBL.COMPOUND:CHEMBL0']
+        # Pickles as a reference to the mapped file
+        self.assertEqual(dict(pickle.loads(pickle.dumps(table)).items()), INTERPOLATIONS)
+
+    def test_rebuild(self):
+        load_interpolation_table(self.interpolations_path, self.tmp_dir.name)
+        table_path = get_interpolation_table_path(self.tmp_dir.name, self.interpolations_path)
+        table_mtime = os.stat(table_path).st_mtime_ns
+        # An unchanged interpolations file reuses the table
+        load_interpolation_table(self.interpolations_path, self.tmp_dir.name)
+        self.assertEqual(os.stat(table_path).st_mtime_ns, table_mtime)
+        # A changed interpolations file rebuilds it
+        with open(self.interpolations_path, 'wb') as f_:
+            pickle.dump({"CHEMBL.COMPOUND:CHEMBL4": {"CHEMBL.COMPOUND:CHEMBL5": 0.75}}, f_)
+        table = load_interpolation_table(self.interpolations_path, self.tmp_dir.name)
+        self.assertEqual(dict(table.items()), {"CHEMBL.COMPOUND:CHEMBL4": {"CHEMBL.COMPOUND:CHEMBL5": 0.75}})
+
+    def test_same_basename(self):
+        # Interpolations of other configurations with the same basename get their own table
+        other_dir = os.path.join(self.tmp_dir.name, 'other')
+        os.makedirs(other_dir)
+        other_interpolations_path = os.path.join(other_dir, 'drug_interpolations.pk')
+        with open(other_interpolations_path, 'wb') as f_:
+            pickle.dump({"CHEMBL.COMPOUND:CHEMBL4": {"CHEMBL.COMPOUND:CHEMBL5": 0.75}}, f_)
+        table = load_interpolation_table(self.interpolations_path, self.tmp_dir.name)
+        other_table = load_interpolation_table(other_interpolations_path, self.tmp_dir.name)
+        self.assertNotEqual(table.interpolation_table_path, other_table.interpolation_table_path)
+        self.assertEqual(dict(table.items()), INTERPOLATIONS)
+        self.assertEqual(dict(other_table.items()), {"CHEMBL.COMPOUND:CHEMBL4": {"CHEMBL.COMPOUND:CHEMBL5": 0.75}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import tempfile
+import json
+import os
+
+from chp.node_normalizer import NodeNormalizer, NodeNormalizerStore, FileNodeNormalizerBackend
+
+NORMALIZED_NODES = {
+        "NCBIGene:3845": {
+            "id": {"identifier": "NCBIGene:3845", "label": "KRAS"},
+            "equivalent_identifiers": [
+                {"identifier": "NCBIGene:3845"},
+                {"identifier": "ENSEMBL:ENSG00000133703"},
+                ],
+            "type": ["biolink:Gene", "biolink:GeneOrGeneProduct"],
+            },
+        "UNKNOWN:1": None,
+        }
+
+
+class TestNodeNormalizer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backend_filename = os.path.join(self.tmp_dir.name, 'normalized_nodes.json')
+        with open(self.backend_filename, 'w') as f_:
+            json.dump(NORMALIZED_NODES, f_)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_file_backend(self):
+        normalizer = NodeNormalizer(backend=FileNodeNormalizerBackend(self.backend_filename))
+        normalized_nodes = normalizer.get_normalized_nodes(['NCBIGene:3845', 'UNKNOWN:1', 'NCBIGene:3845'])
+        self.assertEqual(normalized_nodes["NCBIGene:3845"]["equivalent_identifiers"], ['NCBIGene:3845', 'ENSEMBL:ENSG00000133703'])
+        self.assertEqual(normalized_nodes["NCBIGene:3845"]["types"], ['biolink:Gene', 'biolink:GeneOrGeneProduct'])
+        self.assertIsNone(normalized_nodes["UNKNOWN:1"])
+        # Known and unknown curies are both served from the cache
+        normalizer.get_normalized_nodes(['NCBIGene:3845', 'UNKNOWN:1'])
+        self.assertEqual(normalizer.backend_requests, 1)
+
+    def test_cache_size(self):
+        normalizer = NodeNormalizer(backend=FileNodeNormalizerBackend(self.backend_filename), cache_size=1)
+        normalizer.get_normalized_nodes(['NCBIGene:3845', 'UNKNOWN:1'])
+        # Only the most recent result is kept in process
+        normalizer.get_normalized_nodes(['UNKNOWN:1'])
+        self.assertEqual(normalizer.backend_requests, 1)
+        normalized_nodes = normalizer.get_normalized_nodes(['NCBIGene:3845'])
+        self.assertEqual(normalizer.backend_requests, 2)
+        self.assertEqual(normalized_nodes["NCBIGene:3845"]["equivalent_identifiers"], ['NCBIGene:3845', 'ENSEMBL:ENSG00000133703'])
+
+    def test_persistent_store(self):
+        store_path = os.path.join(self.tmp_dir.name, 'normalized_nodes.db')
+        normalizer = NodeNormalizer(
+                backend=FileNodeNormalizerBackend(self.backend_filename),
+                store=NodeNormalizerStore(store_path),
+                )
+        normalizer.get_normalized_nodes(['NCBIGene:3845', 'UNKNOWN:1'])
+        # A new normalizer (e.g. after a restart) only asks the backend for new curies
+        normalizer = NodeNormalizer(
+                backend=FileNodeNormalizerBackend(self.backend_filename),
+                store=NodeNormalizerStore(store_path),
+                )
+        normalized_nodes = normalizer.get_normalized_nodes(['NCBIGene:3845', 'UNKNOWN:1'])
+        self.assertEqual(normalizer.backend_requests, 0)
+        self.assertIsNone(normalized_nodes["UNKNOWN:1"])
+        normalizer.get_normalized_nodes(['NCBIGene:1'])
+        self.assertEqual(normalizer.backend_requests, 1)
+        self.assertEqual(len(normalizer.store), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+import unittest
+import tempfile
+import random
+import pickle
+import os
+from collections import Counter
+
+try:
+    from pybkb.python_base.reasoning.joint_reasoner import JointReasoner
+    from chp_data.bkb_handler import BkbDataHandler
+    from chp_data.patient_bkb_builder import PatientBkbBuilder
+except ImportError:
+    JointReasoner = None
+
+from patient_data_fixtures import make_raw_patient_data, has_curie
+from chp.patient_index import PatientBitsetIndex, EvidenceMaskCache, load_patient_index, write_patient_index, get_patient_index_path, pack_mask, popcount
+
+class TestPatientBitsetIndex(unittest.TestCase):
+
+    def test_pack_mask(self):
+        rng = random.Random(1)
+        for num_patients in [0, 1, 63, 64, 65, 200]:
+            mask = [rng.random() < 0.5 for _ in range(num_patients)]
+            words = pack_mask(mask)
+            self.assertEqual(len(words), (num_patients + 63) // 64)
+            self.assertEqual(popcount(words), sum(mask))
+
+    def test_compute_joint(self):
+        raw_patient_data = make_raw_patient_data()
+        patient_index = PatientBitsetIndex(raw_patient_data)
+        evidence = {'ENSEMBL:ENSG0': 'True', 'CHEMBL.COMPOUND:CHEMBL1': 'False'}
+        dynamic_evidence = {'ENSEMBL:ENSG2': {"op": '==', "value": 'True'}}
+        dynamic_targets = {'EFO:0000714': {"op": '>=', "value": 978}}
+        self.assertTrue(patient_index.supports(evidence, [], dynamic_evidence, dynamic_targets))
+        res, contrib = patient_index.compute_joint(
+                evidence,
+                [],
+                continuous_evidence=dynamic_evidence,
+                continuous_targets=dynamic_targets,
+                contribution_features='CHEMBL.COMPOUND',
+                )
+        matching = [
+                patient_data for patient_data in raw_patient_data.values()
+                if has_curie(patient_data, 'ENSEMBL:ENSG0') and has_curie(patient_data, 'ENSEMBL:ENSG2') and not has_curie(patient_data, 'CHEMBL.COMPOUND:CHEMBL1')
+                ]
+        for state, survived in [('>= 978', True), ('< 978', False)]:
+            target_patients = [patient_data for patient_data in matching if (patient_data["survival_time"] >= 978) == survived]
+            self.assertAlmostEqual(res[('EFO:0000714', state)], len(target_patients) / len(raw_patient_data))
+            for (curie, curie_state), prob in contrib[('EFO:0000714', state)].items():
+                self.assertTrue(curie.startswith('CHEMBL.COMPOUND'))
+                expected = len([patient_data for patient_data in target_patients if has_curie(patient_data, curie)])
+                self.assertAlmostEqual(prob, expected / len(raw_patient_data))
+
+    def test_extended_joints(self):
+        patient_index = PatientBitsetIndex(make_raw_patient_data())
+        evidence = {'ENSEMBL:ENSG0': 'True'}
+        dynamic_evidence = {'ENSEMBL:ENSG1': {"op": '==', "value": 'True'}}
+        dynamic_targets = {'EFO:0000714': {"op": '>=', "value": 978}}
+        extension_curies = ['CHEMBL.COMPOUND:CHEMBL{}'.format(i) for i in range(4)]
+        for extension_state in ['True', 'False']:
+            self.assertTrue(patient_index.supports_extensions(evidence, extension_curies, extension_state, [], dynamic_evidence, dynamic_targets))
+            extended_joints = patient_index.compute_extended_joints(
+                    evidence,
+                    extension_curies,
+                    extension_state,
+                    [],
+                    continuous_evidence=dynamic_evidence,
+                    continuous_targets=dynamic_targets,
+                    contribution_features='ENSEMBL',
+                    )
+            for curie, extended_joint in zip(extension_curies, extended_joints):
+                expected = patient_index.compute_joint(
+                        dict(evidence, **{curie: extension_state}),
+                        [],
+                        continuous_evidence=dynamic_evidence,
+                        continuous_targets=dynamic_targets,
+                        contribution_features='ENSEMBL',
+                        )
+                self.assertEqual(extended_joint, expected)
+        self.assertEqual(patient_index.compute_extended_joints(evidence, [], 'True', [], {}, dynamic_targets), [])
+        # Extensions that overlap the evidence are left to compute_joint
+        self.assertFalse(patient_index.supports_extensions(evidence, ['ENSEMBL:ENSG0'], 'False', [], {}, dynamic_targets))
+        self.assertFalse(patient_index.supports_extensions(evidence, ['ENSEMBL:ENSG1'], 'True', [], dynamic_evidence, dynamic_targets))
+
+    def test_survival_sweep(self):
+        patient_index = PatientBitsetIndex(make_raw_patient_data())
+        thresholds = [0, 500, 978, 978.5, 1500, 3000, 4000]
+        dynamic_evidence = {'ENSEMBL:ENSG2': {"op": '==', "value": 'True'}}
+        for evidence in [{}, {'ENSEMBL:ENSG0': 'True', 'CHEMBL.COMPOUND:CHEMBL1': 'False'}, {'ENSEMBL:UNKNOWN': 'True'}]:
+            for op in ['>=', '>', '<', '<=', '==']:
+                for contribution_features in [None, 'ENSEMBL', ['ENSEMBL', 'CHEMBL.COMPOUND']]:
+                    if 'ENSEMBL:UNKNOWN' in evidence:
+                        self.assertFalse(patient_index.supports(evidence, [], dynamic_evidence, {'EFO:0000714': {"op": op, "value": 0}}))
+                        continue
+                    joints = patient_index.compute_survival_sweep(
+                            evidence,
+                            op,
+                            thresholds,
+                            [],
+                            continuous_evidence=dynamic_evidence,
+                            contribution_features=contribution_features,
+                            )
+                    self.assertEqual(len(joints), len(thresholds))
+                    for threshold, (res, contrib) in zip(thresholds, joints):
+                        continuous_targets = {'EFO:0000714': {"op": op, "value": threshold}}
+                        expected_contrib = {}
+                        for prefix in ([contribution_features] if isinstance(contribution_features, str) else contribution_features or []):
+                            expected_res, prefix_contrib = patient_index.compute_joint(evidence, [], dynamic_evidence, continuous_targets, contribution_features=prefix)
+                            for target, target_contrib in prefix_contrib.items():
+                                expected_contrib.setdefault(target, {}).update(target_contrib)
+                        expected_res, _ = patient_index.compute_joint(evidence, [], dynamic_evidence, continuous_targets)
+                        self.assertEqual(res.keys(), expected_res.keys())
+                        for target, prob in expected_res.items():
+                            self.assertAlmostEqual(res[target], prob)
+                        self.assertEqual(contrib.keys(), expected_contrib.keys())
+                        for target, target_contrib in expected_contrib.items():
+                            self.assertEqual(contrib[target].keys(), target_contrib.keys())
+                            for feature, prob in target_contrib.items():
+                                self.assertAlmostEqual(contrib[target][feature], prob)
+        with self.assertRaises(ValueError):
+            patient_index.compute_survival_sweep({}, '!=', [100])
+
+    def test_evidence_cache(self):
+        raw_patient_data = make_raw_patient_data()
+        patient_index = PatientBitsetIndex(raw_patient_data, evidence_cache_size=0)
+        evidence_cache = EvidenceMaskCache(patient_index, maxsize=32)
+        context = {'ENSEMBL:ENSG0': 'True', 'ENSEMBL:ENSG1': 'True', 'ENSEMBL:ENSG2': 'False'}
+        for i, drug in enumerate(['CHEMBL.COMPOUND:CHEMBL{}'.format(i) for i in range(4)]):
+            evidence = dict(context, **{drug: 'True'})
+            misses = evidence_cache.misses
+            words = evidence_cache.get(evidence)
+            self.assertEqual(words.tolist(), patient_index.get_evidence_words(evidence).tolist())
+            self.assertFalse(words.flags.writeable)
+            self.assertEqual(evidence_cache.misses, misses + 1)
+            # Only the evidence set and the context it is built on are cached
+            self.assertIn(context, evidence_cache)
+            self.assertEqual(len(evidence_cache), i + 2)
+        hits = evidence_cache.hits
+        self.assertIs(evidence_cache.get(evidence), words)
+        self.assertEqual(evidence_cache.hits, hits + 1)
+        # The cache stays bounded
+        for i in range(6):
+            evidence_cache.get({'ENSEMBL:ENSG{}'.format(i): 'True', 'CHEMBL.COMPOUND:CHEMBL{}'.format(i % 4): 'False'})
+        self.assertLessEqual(len(evidence_cache), 32)
+
+    def test_shared_index(self):
+        raw_patient_data = make_raw_patient_data()
+        for patient, patient_data in raw_patient_data.items():
+            patient_data["age"] = 30 + patient % 50
+        data_version = {"bkb_major_version": 'darwin', "bkb_minor_version": '2.0', "disease": 'tcga'}
+        patient_index = PatientBitsetIndex(raw_patient_data)
+        self.assertEqual(sorted(patient_index.columns), ['age', 'survival_time'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Attaching never writes the index
+            self.assertIsNone(load_patient_index(tmp_dir, data_version))
+            self.assertFalse(os.path.exists(get_patient_index_path(tmp_dir, data_version)))
+            write_patient_index(get_patient_index_path(tmp_dir, data_version), patient_index, data_version=data_version)
+            # Other processes attach to the file without the raw patient data
+            shared_index = load_patient_index(tmp_dir, data_version)
+            self.assertFalse(shared_index.all_words.flags.writeable)
+            self.assertEqual(shared_index.patients, patient_index.patients)
+            for name, column in patient_index.columns.items():
+                self.assertEqual(shared_index.columns[name].tolist(), column.tolist())
+            for prefix in patient_index.feature_curies:
+                self.assertEqual(shared_index.feature_curies[prefix], patient_index.feature_curies[prefix])
+                self.assertEqual(shared_index.curie_indptr[prefix].tolist(), patient_index.curie_indptr[prefix].tolist())
+                self.assertEqual(shared_index.curie_indices[prefix].tolist(), patient_index.curie_indices[prefix].tolist())
+            evidence = {'ENSEMBL:ENSG0': 'True', 'CHEMBL.COMPOUND:CHEMBL1': 'False'}
+            dynamic_targets = {'EFO:0000714': {"op": '<', "value": 1000}}
+            self.assertEqual(
+                    shared_index.compute_joint(evidence, [], {}, dynamic_targets, contribution_features='ENSEMBL'),
+                    patient_index.compute_joint(evidence, [], {}, dynamic_targets, contribution_features='ENSEMBL'),
+                    )
+            # Other data has no index
+            other_data_version = dict(data_version, bkb_minor_version='2.1')
+            self.assertIsNone(load_patient_index(tmp_dir, other_data_version))
+            os.rename(get_patient_index_path(tmp_dir, data_version), get_patient_index_path(tmp_dir, other_data_version))
+            self.assertIsNone(load_patient_index(tmp_dir, other_data_version))
+
+    def test_supports(self):
+        patient_index = PatientBitsetIndex(make_raw_patient_data())
+        dynamic_targets = {'EFO:0000714': {"op": '>=', "value": 978}}
+        self.assertFalse(patient_index.supports({'ENSEMBL:UNKNOWN': 'True'}, [], {}, dynamic_targets))
+        self.assertFalse(patient_index.supports({}, [], {'ENSEMBL:ENSG0': {"op": '>=', "value": 1}}, dynamic_targets))
+        self.assertFalse(patient_index.supports({}, [], {}, {'AGE': {"op": '>=', "value": 50}}))
+        self.assertFalse(patient_index.supports({'ENSEMBL:ENSG0': 'Mutated'}, [], {}, dynamic_targets))
+        self.assertTrue(patient_index.supports({'ENSEMBL:ENSG0': 'True'}, [], {}, dynamic_targets))
+        # Interpolated queries are left to the pybkb joint reasoner
+        for interpolation_type in ['gene', 'drug']:
+            self.assertFalse(patient_index.supports({'ENSEMBL:ENSG0': 'True'}, [], {}, dynamic_targets, interpolation_type))
+            self.assertFalse(patient_index.supports_extensions({}, ['ENSEMBL:ENSG0'], 'True', [], {}, dynamic_targets, interpolation_type))
+
+    def test_supports_unmatched_evidence(self):
+        gene, drug = 'ENSEMBL:ENSG0', 'CHEMBL.COMPOUND:CHEMBL0'
+        # No patient carries both the gene and the drug
+        raw_patient_data = {
+                0: {"survival_time": 100, "gene_curies": [gene], "drug_curies": []},
+                1: {"survival_time": 1200, "gene_curies": [], "drug_curies": [drug]},
+                2: {"survival_time": 2000, "gene_curies": [gene], "drug_curies": []},
+                }
+        patient_index = PatientBitsetIndex(raw_patient_data)
+        dynamic_targets = {'EFO:0000714': {"op": '>=', "value": 978}}
+        # Evidence that matches no patient is represented, but left to the pybkb joint reasoner
+        self.assertTrue(patient_index.supports_query({gene: 'True', drug: 'True'}, [], {}, dynamic_targets))
+        self.assertFalse(patient_index.supports({gene: 'True', drug: 'True'}, [], {}, dynamic_targets))
+        self.assertFalse(patient_index.supports({gene: 'True'}, [], {drug: {"op": '==', "value": 'True'}}, dynamic_targets))
+        self.assertFalse(patient_index.supports_extensions({gene: 'True'}, [drug], 'True', [], {}, dynamic_targets))
+        self.assertTrue(patient_index.supports_extensions({gene: 'True'}, [drug], 'False', [], {}, dynamic_targets))
+
+@unittest.skipIf(JointReasoner is None, 'pybkb and chp_data are not installed.')
+class TestJointReasonerEquivalence(unittest.TestCase):
+    """ The bitset engine answers the queries it supports in place of the pybkb joint reasoner,
+    so both have to return the same probabilities and contributions on the same data.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(TestJointReasonerEquivalence, cls).setUpClass()
+        bkb_handler = BkbDataHandler()
+        with open(bkb_handler.patient_data_pk_path, 'rb') as f_:
+            raw_patient_data = pickle.load(f_)
+        with open(bkb_handler.gene_interpolations_path, 'rb') as f_:
+            gene_interpolations = pickle.load(f_)
+        with open(bkb_handler.drug_interpolations_path, 'rb') as f_:
+            drug_interpolations = pickle.load(f_)
+        cls.joint_reasoner = JointReasoner(
+                PatientBkbBuilder(raw_patient_data, bkb_handler).patient_data,
+                gene_interpolations=gene_interpolations,
+                drug_interpolations=drug_interpolations,
+                )
+        cls.patient_index = PatientBitsetIndex(raw_patient_data)
+        # The most common curies, so the evidence matches patients
+        gene_counts = Counter(curie for patient_data in raw_patient_data.values() for curie in patient_data["gene_curies"])
+        drug_counts = Counter(curie for patient_data in raw_patient_data.values() for curie in patient_data["drug_curies"])
+        cls.genes = [curie for curie, _ in gene_counts.most_common(3)]
+        cls.drugs = [curie for curie, _ in drug_counts.most_common(2)]
+
+    @staticmethod
+    def _normalize(res, contrib, prefix):
+        total = sum(res.values())
+        if total == 0:
+            return None, None
+        normalized_res = {target: prob / total for target, prob in res.items()}
+        normalized_contrib = {
+                target: {
+                    feature: prob / total for feature, prob in target_contrib.items()
+                    if feature[1] == 'True' and feature[0].startswith(prefix) and prob != 0
+                    }
+                for target, target_contrib in contrib.items()
+                } if prefix is not None else {}
+        return normalized_res, normalized_contrib
+
+    def test_compute_joint(self):
+        gene0, gene1, gene2 = self.genes
+        drug0, drug1 = self.drugs
+        queries = [
+                ({gene0: 'True'}, {}),
+                ({gene0: 'True', drug0: 'False'}, {}),
+                ({gene1: 'False'}, {gene2: {"op": '==', "value": 'True'}}),
+                ({drug1: 'True'}, {gene0: {"op": '==', "value": 'True'}}),
+                ]
+        for evidence, dynamic_evidence in queries:
+            for op, value in [('>=', 1000), ('<', 500)]:
+                dynamic_targets = {'EFO:0000714': {"op": op, "value": value}}
+                self.assertTrue(self.patient_index.supports(evidence, [], dynamic_evidence, dynamic_targets))
+                # The handlers ask for interpolations, which the bitset engine does not do
+                for interpolation_type in ['gene', 'drug']:
+                    self.assertFalse(self.patient_index.supports(evidence, [], dynamic_evidence, dynamic_targets, interpolation_type))
+                for prefix, interpolation_type in [(None, None), ('ENSEMBL', 'drug'), ('CHEMBL.COMPOUND', 'gene')]:
+                    bkb_res, bkb_contrib = self._normalize(*self.joint_reasoner.compute_joint(
+                            evidence,
+                            [],
+                            continuous_evidence=dynamic_evidence,
+                            continuous_targets=dynamic_targets,
+                            contribution_features=prefix,
+                            interpolation_type=interpolation_type,
+                            ), prefix)
+                    bitset_res, bitset_contrib = self._normalize(*self.patient_index.compute_joint(
+                            evidence,
+                            [],
+                            continuous_evidence=dynamic_evidence,
+                            continuous_targets=dynamic_targets,
+                            contribution_features=prefix,
+                            ), prefix)
+                    if bkb_res is None or bitset_res is None:
+                        self.assertEqual(bkb_res, bitset_res)
+                        continue
+                    self.assertEqual(set(bkb_res), set(bitset_res))
+                    for target, prob in bkb_res.items():
+                        self.assertAlmostEqual(bitset_res[target], prob)
+                    for target in set(bkb_contrib) | set(bitset_contrib):
+                        target_contrib = bkb_contrib.get(target, {})
+                        self.assertEqual(set(bitset_contrib.get(target, {})), set(target_contrib))
+                        for feature, prob in target_contrib.items():
+                            self.assertAlmostEqual(bitset_contrib[target][feature], prob)
+
+if __name__ == '__main__':
+    unittest.main()
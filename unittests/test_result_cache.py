@@ -0,0 +1,97 @@
+import unittest
+import tempfile
+import time
+import os
+
+from chp.query import Query
+from chp.result_cache import ResultCache, PersistentResultStore
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = ResultCache(maxsize=2, ttl=None)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Touch a so b is the least recently used
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_ttl(self):
+        cache = ResultCache(maxsize=2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_persistent_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_path = os.path.join(tmp_dir, 'results.db')
+            cache = ResultCache(maxsize=2, ttl=None, store=PersistentResultStore(store_path))
+            cache.set(('a', 1), {"result": {('EFO:0000714', '>= 978'): 0.5}})
+            # A new cache (e.g. in a restarted worker) finds the result in the store
+            cache = ResultCache(maxsize=2, ttl=None, store=PersistentResultStore(store_path))
+            self.assertEqual(cache.get(('a', 1)), {"result": {('EFO:0000714', '>= 978'): 0.5}})
+            self.assertEqual(cache.stats()["store_hits"], 1)
+            self.assertIsNone(cache.get(('b', 1)))
+
+    def test_persistent_store_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = PersistentResultStore(os.path.join(tmp_dir, 'results.db'), max_bytes=2500)
+            for i in range(5):
+                store.set(i, 'x' * 1000)
+            self.assertEqual(len(store), 2)
+            self.assertIsNone(store.get(0))
+            self.assertEqual(store.get(4), 'x' * 1000)
+            # The running size total follows replacements and evictions
+            store.set(4, 'x' * 10)
+            self.assertLess(store.get_size(), 1100)
+            store.clear()
+            self.assertEqual(store.get_size(), 0)
+
+    def test_persistent_store_access_batching(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = PersistentResultStore(os.path.join(tmp_dir, 'results.db'), max_bytes=2500, access_batch_size=100)
+            for i in range(2):
+                store.set(i, 'x' * 1000)
+            # Reads are only buffered, the next write records them before evicting
+            self.assertEqual(store.get(0), 'x' * 1000)
+            self.assertEqual(len(store._accessed), 1)
+            store.set(2, 'x' * 1000)
+            self.assertEqual(len(store._accessed), 0)
+            self.assertIsNone(store.get(1))
+            self.assertEqual(store.get(0), 'x' * 1000)
+
+    def test_persistent_store_ttl(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_path = os.path.join(tmp_dir, 'results.db')
+            store = PersistentResultStore(store_path, ttl=0.01)
+            store.set('a', 1)
+            time.sleep(0.02)
+            self.assertIsNone(store.get('a'))
+            # Expired results are dropped with the next write
+            store.set('b', 2)
+            self.assertEqual(len(store), 1)
+            self.assertEqual(store.get('b'), 2)
+
+    def test_query_fingerprint(self):
+        query1 = Query(name='query1')
+        query1.add_meta_evidence('ENSEMBL:ENSG00000155657', 'True')
+        query1.add_meta_evidence('CHEMBL.COMPOUND:CHEMBL83', 'True')
+        query1.add_dynamic_target('EFO:0000714', '>=', 978)
+        query2 = Query(name='query2')
+        query2.add_meta_evidence('CHEMBL.COMPOUND:CHEMBL83', 'True')
+        query2.add_meta_evidence('ENSEMBL:ENSG00000155657', 'True')
+        query2.add_dynamic_target('EFO:0000714', '>=', 978)
+        self.assertEqual(query1.get_fingerprint('gene'), query2.get_fingerprint('gene'))
+        self.assertNotEqual(query1.get_fingerprint('gene'), query2.get_fingerprint('drug'))
+        query2.add_dynamic_target('EFO:0000714', '>=', 970)
+        self.assertNotEqual(query1.get_fingerprint('gene'), query2.get_fingerprint('gene'))
+
+
+if __name__ == '__main__':
+    unittest.main()
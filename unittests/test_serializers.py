@@ -0,0 +1,173 @@
+import unittest
+import json
+import io
+
+from chp.serializers import TrapiResponseSerializer
+
+PROVENANCE_ATTRIBUTE = {
+        "attribute_type_id": "biolink:primary_knowledge_source",
+        "value": "infores:connections-hypothesis",
+        "value_type_id": "biolink:InformationResource",
+        "attributes": None,
+        }
+
+
+def get_response(num_edges):
+    nodes = {"n{}".format(i): {"name": "GENE{}".format(i), "categories": ["biolink:Gene"]} for i in range(num_edges + 1)}
+    edges = {
+            "e{}".format(i): {
+                "subject": "n0",
+                "object": "n{}".format(i + 1),
+                "predicate": "biolink:interacts_with",
+                "attributes": [
+                    {"attribute_type_id": "Contribution", "value": i / 10, "attributes": None},
+                    PROVENANCE_ATTRIBUTE,
+                    ],
+                }
+            for i in range(num_edges)
+            }
+    results = [{"node_bindings": {"n1": [{"id": "n{}".format(i + 1)}]}, "edge_bindings": {"e0": [{"id": "e{}".format(i)}]}} for i in range(num_edges)]
+    return {
+            "message": {
+                "query_graph": {"nodes": {}, "edges": {}},
+                "knowledge_graph": {"nodes": nodes, "edges": edges},
+                "results": results,
+                },
+            "logs": [{"level": "INFO", "message": "ünïcode"}],
+            "status": None,
+            }
+
+
+class Model:
+    """ Object with the to_dict protocol of trapi_model objects that counts its conversions.
+    """
+    conversions = []
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def to_dict(self):
+        self.conversions.append(self.name)
+        return {key: value.to_dict() if hasattr(value, 'to_dict') else value for key, value in self.fields.items()}
+
+class KnowledgeGraphModel(Model):
+
+    def __init__(self, nodes, edges):
+        super().__init__('knowledge_graph', {})
+        self.nodes = nodes
+        self.edges = edges
+
+    def to_dict(self):
+        self.conversions.append(self.name)
+        return {
+                "nodes": {key: node.to_dict() for key, node in self.nodes.items()},
+                "edges": {key: edge.to_dict() for key, edge in self.edges.items()},
+                }
+
+class ResultsModel(Model):
+
+    def __init__(self, results):
+        super().__init__('results', {})
+        self.results = results
+
+    def to_dict(self):
+        self.conversions.append(self.name)
+        return [result.to_dict() for result in self.results]
+
+class MessageModel(Model):
+
+    def __init__(self, query_graph, knowledge_graph, results):
+        super().__init__('message', {})
+        self.query_graph = query_graph
+        self.knowledge_graph = knowledge_graph
+        self.results = results
+
+    def to_dict(self):
+        self.conversions.append(self.name)
+        return {
+                "query_graph": self.query_graph,
+                "knowledge_graph": self.knowledge_graph.to_dict(),
+                "results": self.results.to_dict(),
+                }
+
+class ResponseModel(Model):
+
+    def __init__(self, message, logs, status):
+        super().__init__('response', {})
+        self.message = message
+        self.logs = logs
+        self.status = status
+
+    def to_dict(self):
+        self.conversions.append(self.name)
+        return {"message": self.message.to_dict(), "logs": self.logs, "status": self.status}
+
+
+def get_response_model(response):
+    message = response["message"]
+    knowledge_graph = KnowledgeGraphModel(
+            {key: Model('node', node) for key, node in message["knowledge_graph"]["nodes"].items()},
+            {key: Model('edge', edge) for key, edge in message["knowledge_graph"]["edges"].items()},
+            )
+    results = ResultsModel([Model('result', result) for result in message["results"]])
+    return ResponseModel(MessageModel(message["query_graph"], knowledge_graph, results), response["logs"], response["status"])
+
+
+class TestTrapiResponseSerializer(unittest.TestCase):
+
+    def test_json(self):
+        responses = [get_response(3), get_response(0), {"message": {"knowledge_graph": None, "results": None}}]
+        stream = TrapiResponseSerializer().write(responses, io.StringIO())
+        self.assertEqual(json.loads(stream.getvalue()), responses)
+
+    def test_ndjson(self):
+        responses = [get_response(2), get_response(5)]
+        stream = TrapiResponseSerializer().write(responses, io.StringIO(), ndjson=True)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], responses)
+
+    def test_models(self):
+        responses = [get_response(3), get_response(0)]
+        response_models = [get_response_model(response) for response in responses]
+        Model.conversions.clear()
+        stream = TrapiResponseSerializer().write(response_models, io.StringIO())
+        self.assertEqual(json.loads(stream.getvalue()), responses)
+        # The knowledge graph and results are never converted as a whole, only their elements
+        # one at a time
+        self.assertEqual(Model.conversions, [
+            'response', 'message', 'node', 'node', 'node', 'node', 'edge', 'edge', 'edge', 'result', 'result', 'result',
+            'response', 'message', 'node',
+            ])
+        self.assertEqual(response_models[0].message.knowledge_graph.nodes["n0"].to_dict(), responses[0]["message"]["knowledge_graph"]["nodes"]["n0"])
+
+    def test_attribute_fragments(self):
+        serializer = TrapiResponseSerializer()
+        list(serializer.iter_json([get_response(10)]))
+        # Fragments do not depend on attribute values
+        self.assertEqual(len(serializer._attribute_fragments), 2)
+
+    def test_attribute_value_types(self):
+        serializer = TrapiResponseSerializer()
+        attributes = [
+                {"attribute_type_id": "Contribution", "value": value, "original_attribute_name": name}
+                for value in [True, 1, 1.0, None, [[100, 0.5]]]
+                for name in [True, 1]
+                ]
+        for attribute in attributes * 2:
+            self.assertEqual(serializer._encode_attribute(attribute), json.dumps(attribute, ensure_ascii=False))
+        self.assertEqual(serializer._encode_attribute({"value": 1}), '{"value": 1}')
+        self.assertEqual(serializer._encode_attribute({"attribute_type_id": "a"}), '{"attribute_type_id": "a"}')
+
+    def test_records(self):
+        serializer = TrapiResponseSerializer()
+        response = get_response(2)
+        line = ''.join(serializer.iter_record(response, logs=[], status='Success', description=None))
+        self.assertTrue(line.endswith('\n'))
+        self.assertEqual(json.loads(line), {"response": response, "logs": [], "status": 'Success', "description": None})
+        line = ''.join(serializer.iter_record(None, status='No results.'))
+        self.assertEqual(json.loads(line), {"response": None, "status": 'No results.'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import tempfile
+import os
+from types import SimpleNamespace
+
+from chp.snapshot import write_snapshot, load_snapshot, get_snapshot_path, ReasonerSnapshot, SnapshotVersionError
+
+
+class TestReasonerSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.bkb_handler = SimpleNamespace(bkb_major_version='darwin', bkb_minor_version='2.0', disease='tcga_brca')
+        self.dynamic_reasoner = SimpleNamespace(
+                raw_patient_data={0: {"survival_time": 100, "gene_curies": ['ENSEMBL:ENSG0'], "drug_curies": []}},
+                patient_data={'patient': 0},
+                gene_prelinked_bkb='gene bkb',
+                drug_prelinked_bkb='drug bkb',
+                )
+        self.joint_reasoner = SimpleNamespace(
+                gene_interpolations={'ENSEMBL:ENSG0': {'ENSEMBL:ENSG1': 0.5}},
+                drug_interpolations=None,
+                )
+
+    def test_write_load(self):
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            self.assertIsNone(load_snapshot(snapshot_dir, self.bkb_handler))
+            write_snapshot(get_snapshot_path(snapshot_dir, self.bkb_handler), self.bkb_handler, self.dynamic_reasoner, self.joint_reasoner)
+            snapshot = load_snapshot(snapshot_dir, self.bkb_handler)
+            self.assertEqual(snapshot.get('raw_patient_data'), self.dynamic_reasoner.raw_patient_data)
+            self.assertEqual(snapshot.get('gene_prelinked_bkb'), 'gene bkb')
+            self.assertEqual(snapshot.get('gene_interpolations'), self.joint_reasoner.gene_interpolations)
+            self.assertIsNone(snapshot.get('drug_interpolations'))
+            other_bkb_handler = SimpleNamespace(bkb_major_version='darwin', bkb_minor_version='2.0', disease='tcga_gbm')
+            with self.assertRaises(SnapshotVersionError):
+                ReasonerSnapshot(get_snapshot_path(snapshot_dir, self.bkb_handler), bkb_handler=other_bkb_handler)
+
+    def test_shared_sections(self):
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            snapshot_path = write_snapshot(get_snapshot_path(snapshot_dir, self.bkb_handler), self.bkb_handler, self.dynamic_reasoner, self.joint_reasoner)
+            snapshot = ReasonerSnapshot(snapshot_path)
+            # Reasoners that request a section get the same unpickled copy until it is released
+            patient_data = snapshot.get('patient_data')
+            self.assertIs(snapshot.get('patient_data'), patient_data)
+            gene_prelinked_bkb = snapshot.get('gene_prelinked_bkb')
+            snapshot.release(['patient_data'])
+            self.assertIsNot(snapshot.get('patient_data'), patient_data)
+            self.assertIs(snapshot.get('gene_prelinked_bkb'), gene_prelinked_bkb)
+            snapshot.release()
+            self.assertEqual(snapshot.get('patient_data'), patient_data)
+
+
+if __name__ == '__main__':
+    unittest.main()
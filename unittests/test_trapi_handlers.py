@@ -0,0 +1,94 @@
+import unittest
+
+from chp.trapi_handlers import BaseHandler
+from chp.result_cache import ResultCache
+from chp.query import Query
+
+
+class StubHandler(BaseHandler):
+    """ Handler that runs queries on a stub reasoner and records what was run.
+    """
+    def _get_result_key(self, chp_query, query_type):
+        return chp_query.key
+
+    def _run_query(self, chp_query, query_type):
+        self.ran.append(chp_query.name)
+        chp_query.result = {'EFO:0000714': chp_query.key}
+        chp_query.ranked_wildcard_contributions = [('ENSEMBL:ENSG0', 0.5)]
+        return chp_query
+
+    def _construct_trapi_response(self, chp_query, query, query_type):
+        self.constructed.append(query)
+        return (query, chp_query.result)
+
+
+def make_handler(keys, result_cache=None):
+    handler = StubHandler.get_reasoning_handler()
+    handler.result_cache = result_cache
+    handler.ran = []
+    handler.constructed = []
+    handler.chp_query_dict = {'simple': []}
+    handler.queries_dict = {'simple': []}
+    for i, key in enumerate(keys):
+        chp_query = Query(name='query{}'.format(i))
+        chp_query.key = key
+        handler.chp_query_dict['simple'].append(chp_query)
+        handler.queries_dict['simple'].append('message{}'.format(i))
+    return handler
+
+
+class TestBaseHandler(unittest.TestCase):
+
+    def test_coalescing(self):
+        handler = make_handler(['a', 'b', 'a', None, None])
+        handler.run_queries()
+        # Duplicate keys are run once, queries without a key always run
+        self.assertEqual(handler.ran, ['query0', 'query1', 'query3', 'query4'])
+        chp_queries = handler.results['simple']
+        self.assertEqual([chp_query.name for chp_query in chp_queries], ['query{}'.format(i) for i in range(5)])
+        self.assertEqual(chp_queries[2].result, {'EFO:0000714': 'a'})
+
+    def test_fan_out_copies(self):
+        handler = make_handler(['a', 'a', 'a'])
+        handler.run_queries()
+        chp_queries = handler.results['simple']
+        chp_queries[1].result['EFO:0000714'] = 'changed'
+        chp_queries[1].ranked_wildcard_contributions.append(('ENSEMBL:ENSG1', 0.25))
+        # Mutating one response's result does not leak into the others
+        self.assertEqual(chp_queries[0].result, {'EFO:0000714': 'a'})
+        self.assertEqual(chp_queries[2].result, {'EFO:0000714': 'a'})
+        self.assertEqual(chp_queries[2].ranked_wildcard_contributions, [('ENSEMBL:ENSG0', 0.5)])
+
+    def test_cache_hits(self):
+        result_cache = ResultCache(maxsize=8, ttl=None)
+        handler = make_handler(['a', 'b'], result_cache=result_cache)
+        handler.run_queries()
+        handler.results['simple'][0].result['EFO:0000714'] = 'changed'
+        handler = make_handler(['b', 'c', 'a'], result_cache=result_cache)
+        handler.run_queries()
+        # Only the uncached query is run and the cache is not changed by earlier responses
+        self.assertEqual(handler.ran, ['query1'])
+        self.assertEqual([chp_query.result for chp_query in handler.results['simple']], [
+            {'EFO:0000714': 'b'},
+            {'EFO:0000714': 'c'},
+            {'EFO:0000714': 'a'},
+            ])
+        self.assertEqual(result_cache.stats()["hits"], 2)
+
+    def test_streaming_order(self):
+        handler = make_handler(['a', 'b', 'a', 'c'])
+        responses = handler.iter_responses()
+        # Each response is built as soon as its query is finished
+        self.assertEqual(next(responses), ('message0', {'EFO:0000714': 'a'}))
+        self.assertEqual(handler.ran, ['query0'])
+        self.assertEqual(handler.constructed, ['message0'])
+        self.assertEqual(list(responses), [
+            ('message1', {'EFO:0000714': 'b'}),
+            ('message2', {'EFO:0000714': 'a'}),
+            ('message3', {'EFO:0000714': 'c'}),
+            ])
+        self.assertEqual(handler.ran, ['query0', 'query1', 'query3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,7 +11,9 @@ from trapi_model.query import Query
 from chp_data.bkb_handler import BkbDataHandler
 
 from chp.trapi_interface import TrapiInterface
+from chp.query_plan import QueryPlans, compile_query_graph
 from chp.reasoner import ChpJointReasoner, ChpDynamicReasoner
+from chp.node_normalizer import NodeNormalizer
 from chp.exceptions import *
 
 logger = logging.getLogger(__name__)
@@ -53,6 +55,42 @@ class TestBaseHandler(unittest.TestCase):
         meta_kg = interface.get_meta_knowledge_graph()
         #print(meta_kg.json())
 
+    def test_meta_kg_index(self):
+        interface = TrapiInterface(
+                bkb_handler=self.bkb_handler,
+                dynamic_reasoner=self.dynamic_reasoner,
+                joint_reasoner=self.joint_reasoner,
+                )
+        meta_kg = interface.get_meta_knowledge_graph()
+        for biolink_entity, meta_node in meta_kg.nodes.items():
+            for prefix in meta_node.id_prefixes:
+                self.assertIn(prefix, meta_kg.nodes[interface._get_biolink_entity_if_supported_prefix(prefix)].id_prefixes)
+            normalized_node_dict = {
+                    "types": [biolink_entity.get_curie()],
+                    "equivalent_identifiers": ['NOT_SUPPORTED:1', '{}:1'.format(meta_node.id_prefixes[0])],
+                    }
+            self.assertEqual(interface._get_preferred_curie(normalized_node_dict), '{}:1'.format(meta_node.id_prefixes[0]))
+        self.assertIsNone(interface._get_biolink_entity_if_supported_prefix('NOT_SUPPORTED'))
+
+    def test_shared_components(self):
+        interface = TrapiInterface(
+                bkb_handler=self.bkb_handler,
+                dynamic_reasoner=self.dynamic_reasoner,
+                joint_reasoner=self.joint_reasoner,
+                )
+        warm_interface = TrapiInterface(
+                bkb_handler=self.bkb_handler,
+                dynamic_reasoner=self.dynamic_reasoner,
+                joint_reasoner=self.joint_reasoner,
+                base_handler=interface.base_handler,
+                curies_db=interface.curies_db,
+                meta_knowledge_graph=interface.meta_knowledge_graph,
+                conflation_map=interface.conflation_map,
+                )
+        self.assertIs(warm_interface.curies_db, interface.curies_db)
+        self.assertIs(warm_interface.meta_knowledge_graph, interface.meta_knowledge_graph)
+        self.assertIsNot(warm_interface.logger, interface.logger)
+
 class TestOneHopHandler(unittest.TestCase):
 
     @classmethod
@@ -68,12 +106,12 @@ class TestOneHopHandler(unittest.TestCase):
         cls.joint_reasoner = ChpJointReasoner(cls.bkb_handler)
 
 
-    def get_responses(self, queries=None, trapi_queries=None):
+    def get_responses(self, queries=None, trapi_queries=None, joint_reasoner=None):
         # Initialize interface
         interface = TrapiInterface(
                 bkb_handler=self.bkb_handler,
                 dynamic_reasoner=self.dynamic_reasoner,
-                joint_reasoner=self.joint_reasoner,
+                joint_reasoner=joint_reasoner if joint_reasoner is not None else self.joint_reasoner,
                 )
         # Load queries
         if trapi_queries is None:
@@ -111,11 +149,95 @@ class TestOneHopHandler(unittest.TestCase):
                     edge.subject = edge_object
                     edge.object = edge_subject
         responses = self.get_responses(trapi_queries=trapi_queries)
+
+    def test_query_plan(self):
+        standard_queries = copy.deepcopy(self.standard_queries)
+        descriptions = [query.pop("test_description", None) for query in standard_queries]
+        for query in standard_queries:
+            trapi_query = Query.load(query["trapi_version"], None, query=query)
+            plan = compile_query_graph(trapi_query.message.query_graph)
+            self.assertEqual(plan.onehop_type, 'standard')
+            self.assertIsNone(plan.wildcard_node_id)
+            with self.assertRaises(AttributeError):
+                plan.onehop_type = 'gene'
+            # Plans belong to their query object only
+            query_plans = QueryPlans()
+            query_plans.set(trapi_query, plan)
+            self.assertIs(query_plans.get(trapi_query), plan)
+            self.assertIsNone(query_plans.get(copy.deepcopy(trapi_query)))
+
+    def test_unmatched_gene_drug_query(self):
+        # Find a gene and drug pair that no patient carries together
+        genes = set()
+        drugs = set()
+        pairs = set()
+        for patient_data in self.joint_reasoner.raw_patient_data.values():
+            genes.update(patient_data["gene_curies"])
+            drugs.update(patient_data["drug_curies"])
+            pairs.update((gene, drug) for gene in patient_data["gene_curies"] for drug in patient_data["drug_curies"])
+        gene, drug = next((gene, drug) for gene in sorted(genes) for drug in sorted(drugs) if (gene, drug) not in pairs)
+        query = copy.deepcopy(self.standard_queries[2])
+        query.pop("test_description", None)
+        query["message"]["query_graph"]["nodes"]["n0"]["ids"] = [gene]
+        query["message"]["query_graph"]["nodes"]["n1"]["ids"] = [drug]
+        bitset_joint_reasoner = ChpJointReasoner(self.bkb_handler, joint_engine='bitset')
+        for joint_reasoner in [self.joint_reasoner, bitset_joint_reasoner]:
+            # Interpolated or empty results are normalized without dividing by zero
+            responses = self.get_responses(queries=[copy.deepcopy(query)], joint_reasoner=joint_reasoner)
+            self.assertEqual(len(responses), 1)
+            probabilities = [
+                    attribute.value
+                    for edge in responses[0].message.knowledge_graph.edges.values()
+                    for attribute in edge.attributes
+                    if attribute.attribute_type_id == 'Probability of Survival'
+                    ]
+            self.assertEqual(len(probabilities), 1)
+            self.assertTrue(probabilities[0] == -1 or 0 <= probabilities[0] <= 1)
+
+    def test_node_normalized_query(self):
+        gene = 'ENSEMBL:ENSG00000187889'
+        class StubBackend:
+            def get_normalized_nodes(self, curies):
+                return {curie: {"types": ['biolink:Gene'], "equivalent_identifiers": [curie, gene]} for curie in curies}
+        query = copy.deepcopy(self.standard_queries[0])
+        query.pop("test_description", None)
+        query["message"]["query_graph"]["nodes"]["n0"]["ids"] = ['NCBIGene:1']
+        interface = TrapiInterface(
+                bkb_handler=self.bkb_handler,
+                dynamic_reasoner=self.dynamic_reasoner,
+                joint_reasoner=self.joint_reasoner,
+                node_normalizer=NodeNormalizer(backend=StubBackend()),
+                )
+        interface.setup_trapi_queries([Query.load(query["trapi_version"], None, query=query)])
+        self.assertEqual(interface.node_normalizer_mappings, {'NCBIGene:1': gene})
+        interface.build_chp_queries()
+        interface.run_chp_queries()
+        responses = interface.construct_trapi_responses()
+        # The response holds the passed curie instead of the normalized one
+        self.assertEqual(responses[0].message.query_graph.nodes["n0"].ids, ['NCBIGene:1'])
+        response_json = json.dumps(responses[0].to_dict())
+        self.assertIn('NCBIGene:1', response_json)
+        self.assertNotIn(gene, response_json)
+
     def test_wildcard_query(self):
         wildcard_queries = copy.deepcopy(self.wildcard_queries)
         descriptions = [query.pop("test_description", None) for query in self.wildcard_queries]
         responses = self.get_responses(queries=wildcard_queries)
 
+    def test_streaming_responses(self):
+        wildcard_queries = copy.deepcopy(self.wildcard_queries)
+        descriptions = [query.pop("test_description", None) for query in wildcard_queries]
+        interface = TrapiInterface(
+                bkb_handler=self.bkb_handler,
+                dynamic_reasoner=self.dynamic_reasoner,
+                joint_reasoner=self.joint_reasoner,
+                )
+        trapi_queries = [Query.load(query["trapi_version"], None, query=query) for query in wildcard_queries]
+        interface.setup_trapi_queries(trapi_queries)
+        interface.build_chp_queries()
+        streamed_responses = list(interface.iter_trapi_responses())
+        self.assertEqual(len(streamed_responses), len(trapi_queries))
+
 
 if __name__ == '__main__':
     unittest.main()